@@ -0,0 +1,59 @@
+"""
+Checks that an optimizer step with gradient accumulation (see util.train_val.accumulate_and_step) matches one
+on the whole batch: from the same weights, the batch split into micro-batches, whose size need not divide the
+batch size, must give the same parameter update as the batch at once.
+
+The updates are compared with SGD at a learning rate of 1, so that they are the (negative) gradients. To make
+the check deterministic, the approximate posterior is a point estimate and the model is in eval mode (batch norm
+with running statistics, no dropout), so use a single-level model, whose initial state is the prior mean.
+
+Run from the repository root, for instance:
+    python benchmarks/accumulation_equivalence.py --dataset 'mnist' --model_type 'single_level' --data_path '/path/to/data/' \
+        --micro_batch_size 24
+"""
+import argparse
+import torch
+
+from common import add_config_args, load_config, get_data, process_batch
+from lib.models import get_model
+from util.train_val import train_on_batch, accumulate_and_step
+
+arg_parser = add_config_args(argparse.ArgumentParser())
+arg_parser.set_defaults(model_type='single_level')
+arg_parser.add_argument('--cuda_device', default='', help='GPU to run on, or cpu, overrides the config if given')
+arg_parser.add_argument('--micro_batch_size', type=int, default=24, help='micro-batch size, need not divide the batch size')
+arg_parser.add_argument('--seed', type=int, default=0, help='random seed')
+args = arg_parser.parse_args()
+
+train_config, arch = load_config(args.dataset, args.model_type, args.inference_type)
+if args.cuda_device != '':
+    train_config['cuda_device'] = None if args.cuda_device == 'cpu' else int(args.cuda_device)
+train_config['average_gradient'] = True
+train_config['encoder_decoder_train_multiple'] = 1
+arch['posterior_form'] = 'point_estimate'
+train_loader, _ = get_data(train_config, args.data_path)
+
+updates = []
+batch = None
+for micro_batch_size in [None, args.micro_batch_size]:
+    torch.manual_seed(args.seed)
+    model = get_model(train_config, arch, train_loader)
+    model.eval()
+    if batch is None:
+        batch = process_batch(model, next(iter(train_loader))[0], train_config)
+    optimizers = (torch.optim.SGD(model.encoder_parameters(), lr=1.), torch.optim.SGD(model.decoder_parameters(), lr=1.))
+    params = model.encoder_parameters() + model.decoder_parameters()
+    initial = [param.data.clone() for param in params]
+    if micro_batch_size is None:
+        train_on_batch(model, batch, train_config['n_iterations'], optimizers, train_config, arch)
+    else:
+        accumulate_and_step(model, list(batch.split(micro_batch_size)), optimizers, train_config, arch)
+    updates.append([param.data - initial_data for param, initial_data in zip(params, initial)])
+
+max_update = max([update.abs().max() for update in updates[0]])
+max_diff = max([(accumulated - whole).abs().max() for whole, accumulated in zip(*updates)])
+print 'Micro-batch sizes: ' + str([micro_batch.size()[0] for micro_batch in batch.split(args.micro_batch_size)])
+print 'Update: max. %.3g, max. difference %.3g' % (max_update, max_diff)
+
+passed = max_update > 0 and max_diff <= 1e-5 * max_update
+print 'Accumulation: ' + ('PASS' if passed else 'FAIL')
@@ -0,0 +1,75 @@
+"""
+Checks that a model survives a save and load of its state dict checkpoint (see util.logs.save_checkpoint):
+every encoder and decoder parameter must be in the state dict, the loaded tensors must equal the saved
+ones, and the loaded model must give the same ELBO as the saved one. The default config is a conv model.
+
+Run from the repository root, for instance:
+    python benchmarks/checkpoint_round_trip.py --dataset 'cifar10' --model_type 'hierarchical' --data_path '/path/to/data/'
+"""
+import argparse
+import os
+import tempfile
+import torch
+
+from common import add_config_args, load_config, get_data, process_batch
+from lib.models import get_model
+from util.logs import snapshot
+from util.optimizers import get_optimizers
+from util.train_val import train_on_batch, run_on_batch
+
+arg_parser = add_config_args(argparse.ArgumentParser())
+arg_parser.set_defaults(dataset='cifar10')
+arg_parser.add_argument('--cuda_device', default='', help='GPU to run on, or cpu, overrides the config if given')
+arg_parser.add_argument('--n_batches', type=int, default=2, help='training batches before saving, to move the weights and batch norm statistics')
+arg_parser.add_argument('--seed', type=int, default=0, help='random seed')
+args = arg_parser.parse_args()
+
+train_config, arch = load_config(args.dataset, args.model_type, args.inference_type)
+if args.cuda_device != '':
+    train_config['cuda_device'] = None if args.cuda_device == 'cpu' else int(args.cuda_device)
+train_loader, val_loader = get_data(train_config, args.data_path)
+
+torch.manual_seed(args.seed)
+model = get_model(train_config, arch, train_loader)
+(enc_opt, _), (dec_opt, _), _ = get_optimizers(train_config, arch, model)
+model.train()
+for batch_num, (batch, _) in enumerate(train_loader):
+    if batch_num == args.n_batches:
+        break
+    train_on_batch(model, process_batch(model, batch, train_config), train_config['n_iterations'],
+                   (enc_opt, dec_opt), train_config, arch)
+
+state_dict = model.state_dict()
+stored = set([tensor.data_ptr() for tensor in state_dict.values()])
+missing = [param for param in model.encoder_parameters() + model.decoder_parameters()
+           if param.data.data_ptr() not in stored]
+print 'Parameters missing from the state dict: ' + str(len(missing))
+
+file_descriptor, file_name = tempfile.mkstemp(suffix='.ckpt')
+os.close(file_descriptor)
+torch.save({'model': snapshot(state_dict)}, file_name)
+checkpoint = torch.load(file_name, map_location=lambda storage, location: storage)
+os.remove(file_name)
+
+# a different seed, so that anything not loaded differs
+torch.manual_seed(args.seed + 1)
+loaded_model = get_model(train_config, arch, train_loader)
+loaded_model.load_state_dict(checkpoint['model'])
+loaded_state_dict = loaded_model.state_dict()
+max_diff = max([(state_dict[name].cpu().float() - loaded_state_dict[name].cpu().float()).abs().max()
+                for name in state_dict])
+print 'Tensors: ' + str(len(state_dict)) + ', max. difference %.3g' % max_diff
+
+batch = process_batch(model, next(iter(val_loader))[0], train_config)
+elbos = []
+for checked_model in [model, loaded_model]:
+    checked_model.freeze_for_inference()
+    torch.manual_seed(args.seed)
+    output_dict = run_on_batch(checked_model, batch, train_config['n_iterations'], train_config, arch)
+    elbos.append(output_dict['total_elbo'].mean(axis=0)[-1])
+elbo_diff = abs(elbos[0] - elbos[1])
+print 'ELBO: saved %.4f, loaded %.4f' % (elbos[0], elbos[1])
+
+passed = len(missing) == 0 and set(state_dict.keys()) == set(loaded_state_dict.keys()) and max_diff == 0 \
+    and elbo_diff <= 1e-4 * abs(elbos[0])
+print 'Round trip: ' + ('PASS' if passed else 'FAIL')
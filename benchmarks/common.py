@@ -0,0 +1,69 @@
+import os
+import sys
+import imp
+import time
+import torch
+from torch.autograd import Variable
+
+root_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if root_path not in sys.path:
+    sys.path.insert(0, root_path)
+
+from util.data.load_data import load_data
+
+
+def add_config_args(arg_parser):
+    """Adds the arguments used to select a config under cfg/ and the data location."""
+    arg_parser.add_argument('--dataset', default='mnist', help='data set, cifar10 or mnist')
+    arg_parser.add_argument('--model_type', default='hierarchical', help='model type, single_level or hierarchical')
+    arg_parser.add_argument('--inference_type', default='iterative', help='inference type, standard or iterative')
+    arg_parser.add_argument('--data_path', default='', help='path to data directory root')
+    return arg_parser
+
+
+def load_config(dataset, model_type, inference_type):
+    """Loads copies of train_config and arch from the config file under cfg/."""
+    config_file = os.path.join(root_path, 'cfg', dataset, model_type, inference_type, 'config.py')
+    config = imp.load_source('_'.join(['config', dataset, model_type, inference_type]), config_file)
+    train_config, arch = dict(config.train_config), dict(config.arch)
+    train_config['resume_experiment'] = None
+    return train_config, arch
+
+
+def get_data(train_config, data_path, worker_init_fn=None):
+    """Loads the train and validation data loaders for a config."""
+    train_loader, val_loader, _ = load_data(train_config['dataset'], data_path, train_config['batch_size'],
+                                            cuda_device=train_config['cuda_device'],
+                                            num_workers=train_config['num_workers'],
+                                            worker_init_fn=worker_init_fn)
+    return train_loader, val_loader
+
+
+def process_batch(model, batch, train_config):
+    """Places a batch on the device and binarizes/dequantizes it, as in training."""
+    batch = Variable(batch)
+    if train_config['cuda_device'] is not None:
+        batch = batch.cuda(train_config['cuda_device'])
+    if model.output_distribution == 'bernoulli':
+        batch = 255. * torch.bernoulli(batch / 255.)
+    elif model.output_distribution == 'gaussian':
+        rand_values = Variable(batch.data.new(batch.data.shape).uniform_(-0.5, 0.5))
+        batch = torch.clamp(batch + rand_values, 0., 255.)
+    return batch
+
+
+def synchronize(train_config):
+    """Waits for device work to finish so that timings are accurate."""
+    if train_config['cuda_device'] is not None:
+        torch.cuda.synchronize()
+
+
+def timed(func, train_config, n_repeats=1):
+    """Runs func n_repeats times, returning the list of outputs and the average time per run in seconds."""
+    outputs = []
+    synchronize(train_config)
+    tic = time.time()
+    for _ in range(n_repeats):
+        outputs.append(func())
+    synchronize(train_config)
+    return outputs, (time.time() - tic) / n_repeats
@@ -0,0 +1,60 @@
+"""
+Trains the model in a config on the same data batches, with each batch split into a range of micro-batch sizes
+whose gradients are accumulated over one optimizer step (see micro_batch_size and n_accumulation in the config),
+reporting the training throughput and ELBO of each configuration.
+
+Run from the repository root, for instance:
+    python benchmarks/gradient_accumulation.py --dataset 'mnist' --model_type 'hierarchical' --data_path '/path/to/data/' \
+        --batch_size 256 --micro_batch_sizes 32 64 128 256
+"""
+import argparse
+import numpy as np
+import torch
+
+from common import add_config_args, load_config, get_data, process_batch, timed
+from lib.models import get_model
+from util.optimizers import get_optimizers
+from util.train_val import accumulate_and_step
+
+arg_parser = add_config_args(argparse.ArgumentParser())
+arg_parser.add_argument('--batch_size', type=int, default=None, help='batch size per optimizer step, the config batch_size if not given')
+arg_parser.add_argument('--micro_batch_sizes', type=int, nargs='+', default=[16, 32, 64], help='micro-batch sizes, dividing the batch size')
+arg_parser.add_argument('--n_steps', type=int, default=20, help='number of timed optimizer steps')
+arg_parser.add_argument('--seed', type=int, default=0, help='random seed for the weights and samples')
+args = arg_parser.parse_args()
+
+train_config, arch = load_config(args.dataset, args.model_type, args.inference_type)
+if args.batch_size is not None:
+    train_config['batch_size'] = args.batch_size
+batch_size = train_config['batch_size']
+for micro_batch_size in args.micro_batch_sizes:
+    assert batch_size % micro_batch_size == 0, 'Micro-batch sizes must divide the batch size.'
+
+train_loader, _ = get_data(train_config, args.data_path)
+torch.manual_seed(args.seed)
+batches = []
+for batch, _ in train_loader:
+    if len(batches) == args.n_steps:
+        break
+    if batch.size()[0] == batch_size:
+        batches.append(batch)
+
+print 'Micro-batch'.ljust(13) + 'Accumulation'.rjust(14) + 'Examples / s'.rjust(14) + 'ELBO'.rjust(12)
+for micro_batch_size in sorted(args.micro_batch_sizes):
+    n_accumulation = batch_size // micro_batch_size
+    torch.manual_seed(args.seed)
+    model = get_model(train_config, arch, train_loader)
+    (enc_opt, _), (dec_opt, _), _ = get_optimizers(train_config, arch, model)
+    micro_batches = [process_batch(model, batch, train_config).split(micro_batch_size) for batch in batches]
+
+    def train_steps():
+        elbos = []
+        for batch in micro_batches:
+            for output_dict in accumulate_and_step(model, list(batch), (enc_opt, dec_opt), train_config, arch):
+                elbos.append(output_dict['elbo'])
+        return np.mean(elbos)
+
+    (elbo,), total_time = timed(train_steps, train_config)
+    throughput = len(batches) * batch_size / total_time
+    print str(micro_batch_size).ljust(13) + str(n_accumulation).rjust(14) + ('%.1f' % throughput).rjust(14) + \
+        ('%.3f' % elbo).rjust(12)
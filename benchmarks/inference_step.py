@@ -0,0 +1,46 @@
+"""
+Times one inference iteration (encode, decode, losses, and backward to the state) of the model in a config,
+and the full training step on a batch, to track per-iteration overhead.
+
+Run from the repository root, for instance:
+    python benchmarks/inference_step.py --dataset 'mnist' --model_type 'hierarchical' --data_path '/path/to/data/'
+"""
+import argparse
+
+from common import add_config_args, load_config, get_data, process_batch, timed
+from lib.models import get_model
+from util.optimizers import get_optimizers
+from util.train_val import train_on_batch
+
+arg_parser = add_config_args(argparse.ArgumentParser())
+arg_parser.add_argument('--n_repeats', type=int, default=50, help='number of timed runs')
+args = arg_parser.parse_args()
+
+train_config, arch = load_config(args.dataset, args.model_type, args.inference_type)
+train_loader, _ = get_data(train_config, args.data_path)
+model = get_model(train_config, arch, train_loader)
+(enc_opt, _), (dec_opt, _), _ = get_optimizers(train_config, arch, model)
+batch = process_batch(model, next(iter(train_loader))[0], train_config)
+
+model.not_trainable_decoder()
+model.decode(generate=True, batch_size=batch.size()[0])
+model.reset_state(batch_size=batch.size()[0])
+model.decode()
+(-model.elbo(batch, averaged=True)).backward(retain_graph=True)
+model.not_trainable_state()
+
+
+def inference_iteration():
+    model.encode(batch)
+    model.decode()
+    elbo, _, _ = model.losses(batch, averaged=True)
+    (-elbo).backward(retain_graph=True)
+
+
+inference_iteration()
+_, iteration_time = timed(inference_iteration, train_config, args.n_repeats)
+model.trainable_decoder()
+_, step_time = timed(lambda: train_on_batch(model, batch, train_config['n_iterations'], (enc_opt, dec_opt),
+                                            train_config, arch), train_config, args.n_repeats)
+print 'Inference iteration (ms): %.3f' % (1000. * iteration_time)
+print 'Training step, %d iterations (ms): %.3f' % (train_config['n_iterations'], 1000. * step_time)
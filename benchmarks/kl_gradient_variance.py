@@ -0,0 +1,58 @@
+"""
+Compares the variance of the model's parameter gradients per unit of compute when the lower levels use
+the sampled (Monte Carlo) KL divergence and when they use the analytical KL divergence.
+
+Run from the repository root, for instance:
+    python benchmarks/kl_gradient_variance.py --dataset 'mnist' --model_type 'hierarchical' --data_path '/path/to/data/'
+"""
+import argparse
+import numpy as np
+
+from common import add_config_args, load_config, get_data, process_batch, timed
+from lib.models import get_model
+
+arg_parser = add_config_args(argparse.ArgumentParser())
+arg_parser.add_argument('--n_trials', type=int, default=50, help='number of gradient estimates per setting')
+arg_parser.add_argument('--n_samples', type=int, nargs='+', default=[1, 5, 10], help='numbers of samples to compare')
+args = arg_parser.parse_args()
+
+train_config, arch = load_config(args.dataset, args.model_type, args.inference_type)
+train_loader, _ = get_data(train_config, args.data_path)
+model = get_model(train_config, arch, train_loader)
+batch = process_batch(model, next(iter(train_loader))[0], train_config)
+params = model.encoder_parameters() + model.decoder_parameters()
+
+
+def gradient_estimate(n_samples):
+    """Single-iteration gradient estimate of the negative ELBO with respect to all parameters."""
+    for param in params:
+        if param.grad is not None:
+            param.grad.data.zero_()
+    model.decode(generate=True, batch_size=batch.size()[0])
+    model.reset_state(batch_size=batch.size()[0])
+    model.encode(batch)
+    model.decode(n_samples=n_samples)
+    (-model.elbo(batch, averaged=True)).backward()
+    return np.concatenate([param.grad.data.cpu().numpy().reshape(-1) for param in params if param.grad is not None])
+
+
+print 'KL Form'.ljust(12) + 'Samples'.rjust(8) + 'Grad. Variance'.rjust(18) + 'Time (s)'.rjust(12) + 'Variance x Time'.rjust(18)
+n_levels = len(arch['n_latent'])
+for kl_form in ['sampled', 'analytical']:
+    model.analytical_kl = [kl_form == 'analytical'] * (n_levels - 1) + [True]
+    for n_samples in args.n_samples:
+        # running mean and sum of squared deviations (Welford) over the gradient estimates
+        mean = sq_dev = None
+        total_time = 0.
+        for trial in range(args.n_trials):
+            (grad,), trial_time = timed(lambda: gradient_estimate(n_samples), train_config)
+            total_time += trial_time
+            if mean is None:
+                mean, sq_dev = grad.astype(float), np.zeros(grad.shape)
+            else:
+                delta = grad - mean
+                mean += delta / (trial + 1)
+                sq_dev += delta * (grad - mean)
+        variance = np.mean(sq_dev / (args.n_trials - 1))
+        ave_time = total_time / args.n_trials
+        print kl_form.ljust(12) + str(n_samples).rjust(8) + ('%.4e' % variance).rjust(18) + ('%.4f' % ave_time).rjust(12) + ('%.4e' % (variance * ave_time)).rjust(18)
@@ -0,0 +1,87 @@
+"""
+Predicts the peak device and host memory of training with a config, before training. Two training steps (the
+second with the optimizer states allocated) are run at each of two small batch sizes, and their peak memory,
+which grows linearly with the batch size at a fixed n_samples and n_iterations, is extrapolated to the batch
+size of the config (or to micro_batch_size, if set). batch_size, n_samples, and n_iterations can be overridden,
+to find settings that fit before starting a run.
+
+Run from the repository root, for instance:
+    python benchmarks/memory_estimate.py --dataset 'mnist' --model_type 'hierarchical' --data_path '/path/to/data/' \
+        --n_iterations 5 --n_samples 10
+"""
+import gc
+import argparse
+import torch
+
+from common import add_config_args, load_config, get_data, process_batch
+from lib.models import get_model
+from util.memory import MemoryProfiler, DeviceMemory, host_memory, megabyte
+from util.optimizers import get_optimizers
+from util.train_val import train_on_batch
+
+arg_parser = add_config_args(argparse.ArgumentParser())
+arg_parser.add_argument('--cuda_device', default='', help='GPU to run on, or cpu, overrides the config if given')
+arg_parser.add_argument('--batch_size', type=int, default=None, help='batch size to predict for, the config batch_size if not given')
+arg_parser.add_argument('--n_samples', type=int, default=None, help='number of samples, the config n_samples if not given')
+arg_parser.add_argument('--n_iterations', type=int, default=None, help='inference iterations, the config n_iterations if not given')
+arg_parser.add_argument('--dry_batch_sizes', type=int, nargs=2, default=[4, 16], help='the two batch sizes of the dry runs')
+args = arg_parser.parse_args()
+
+train_config, arch = load_config(args.dataset, args.model_type, args.inference_type)
+if args.cuda_device != '':
+    train_config['cuda_device'] = None if args.cuda_device == 'cpu' else int(args.cuda_device)
+for key in ['batch_size', 'n_samples', 'n_iterations']:
+    if getattr(args, key) is not None:
+        train_config[key] = getattr(args, key)
+cuda_device = train_config['cuda_device']
+# the largest batch of a training step
+batch_size = train_config['micro_batch_size'] or train_config['batch_size']
+dry_batch_sizes = sorted(args.dry_batch_sizes)
+assert dry_batch_sizes[0] < dry_batch_sizes[1], 'The dry run batch sizes must differ.'
+
+train_loader, _ = get_data(dict(train_config, batch_size=dry_batch_sizes[1]), args.data_path)
+data = next(iter(train_loader))[0]
+
+# memory used before building any model, subtracted from the peaks, after creating the CUDA context,
+# which would otherwise be counted in the first dry run (and without which NVML does not list the process)
+if cuda_device is not None:
+    torch.zeros(1).cuda(cuda_device)
+device_base, _ = DeviceMemory(cuda_device).sample()
+host_base, _ = host_memory()
+device_base, host_base = device_base or 0, host_base or 0
+
+print 'Profile of a training step at batch size ' + str(dry_batch_sizes[1]) + ':'
+measured = []
+for dry_batch_size in dry_batch_sizes:
+    dry_config = dict(train_config, batch_size=dry_batch_size, micro_batch_size=None)
+    profiler = MemoryProfiler(cuda_device)
+    model = get_model(dry_config, arch, train_loader)
+    model.phase_timer = profiler
+    (enc_opt, _), (dec_opt, _), _ = get_optimizers(dry_config, arch, model)
+    batch = process_batch(model, data[:dry_batch_size], dry_config)
+    for _ in range(2):
+        train_on_batch(model, batch, dry_config['n_iterations'], (enc_opt, dec_opt), dry_config, arch)
+    device_peak, host_peak = profiler.peak()
+    measured.append((dry_batch_size,
+                     None if device_peak is None else device_peak - device_base,
+                     None if host_peak is None else host_peak - host_base))
+    if dry_batch_size == dry_batch_sizes[1]:
+        print profiler.memory_table()
+    # release the dry run's memory, also from the allocator cache, so that the next one starts from the base
+    del model, enc_opt, dec_opt, batch, profiler
+    gc.collect()
+    if cuda_device is not None:
+        torch.cuda.empty_cache()
+
+print
+print 'Memory (MB)'.ljust(13) + ''.join(('Batch ' + str(size)).rjust(13) for size in dry_batch_sizes) + \
+    'Fixed'.rjust(13) + 'Per example'.rjust(13) + ('Batch ' + str(batch_size)).rjust(13)
+for index, name in [(1, 'Device'), (2, 'Host RSS')]:
+    small, large = measured[0][index], measured[1][index]
+    if small is None or large is None:
+        print name.ljust(13) + 'not available'.rjust(13)
+        continue
+    per_example = max(large - small, 0) * 1. / (dry_batch_sizes[1] - dry_batch_sizes[0])
+    fixed = small - per_example * dry_batch_sizes[0]
+    print name.ljust(13) + ''.join(('%.1f' % (value / megabyte)).rjust(13) for value in [small, large, fixed]) + \
+        ('%.3f' % (per_example / megabyte)).rjust(13) + ('%.1f' % ((fixed + per_example * batch_size) / megabyte)).rjust(13)
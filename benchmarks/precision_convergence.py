@@ -0,0 +1,77 @@
+"""
+Compares training with float32 and reduced precision encoder and decoder matmuls and convolutions:
+half precision (float16, GPU only), or bfloat16 numerics, emulated by rounding the inputs and weights in
+float32 (see DenseLatentVariableModel.emulate_bfloat16). torch has no bfloat16 kernels, so the bfloat16
+run only checks convergence, and its time per batch is that of the emulation, not of bfloat16 hardware.
+Both models start from the same weights and train on the same batches; the running average
+training ELBO of each is printed, with the relative difference checked against a tolerance.
+
+Run from the repository root, for instance:
+    python benchmarks/precision_convergence.py --dataset 'mnist' --model_type 'single_level' --data_path '/path/to/data/'
+On the CPU, check bfloat16 numerics:
+    python benchmarks/precision_convergence.py --dataset 'mnist' --model_type 'single_level' --data_path '/path/to/data/' --cuda_device 'cpu' --precision 'bfloat16'
+"""
+import argparse
+import numpy as np
+import torch
+
+from common import add_config_args, load_config, get_data, process_batch, timed
+from lib.models import get_model
+from util.optimizers import get_optimizers
+from util.train_val import train_on_batch
+
+arg_parser = add_config_args(argparse.ArgumentParser())
+arg_parser.add_argument('--n_batches', type=int, default=2000, help='number of training batches')
+arg_parser.add_argument('--display_iter', type=int, default=200, help='batches per reported average')
+arg_parser.add_argument('--tolerance', type=float, default=0.01, help='maximum relative difference in average ELBO')
+arg_parser.add_argument('--seed', type=int, default=0, help='random seed for the initial weights and batches')
+arg_parser.add_argument('--precision', type=str, default='float16', help="reduced precision, 'float16', or 'bfloat16' (emulated)")
+arg_parser.add_argument('--cuda_device', default='', help='GPU to run on, or cpu, overrides the config if given')
+args = arg_parser.parse_args()
+
+train_config, arch = load_config(args.dataset, args.model_type, args.inference_type)
+if args.cuda_device != '':
+    train_config['cuda_device'] = None if args.cuda_device == 'cpu' else int(args.cuda_device)
+assert args.precision in ['float16', 'bfloat16'], 'Precision not recognized.'
+assert args.precision != 'float16' or train_config['cuda_device'] is not None, 'Half precision matmuls require a GPU.'
+train_loader, _ = get_data(train_config, args.data_path)
+
+# the same (binarized/dequantized) batches are used for both precisions
+torch.manual_seed(args.seed)
+batches = []
+while len(batches) < args.n_batches:
+    for batch, _ in train_loader:
+        batches.append(batch)
+        if len(batches) == args.n_batches:
+            break
+
+elbos = {}
+times = {}
+for precision in ['float32', args.precision]:
+    torch.manual_seed(args.seed)
+    train_config['precision'] = 'float32' if precision == 'bfloat16' else precision
+    model = get_model(train_config, arch, train_loader)
+    if precision == 'bfloat16':
+        model.emulate_bfloat16()
+    (enc_opt, _), (dec_opt, _), _ = get_optimizers(train_config, arch, model)
+    torch.manual_seed(args.seed)
+    elbos[precision] = np.zeros(args.n_batches)
+    total_time = 0.
+    for batch_num, batch in enumerate(batches):
+        batch = process_batch(model, batch, train_config)
+        (output_dict,), batch_time = timed(lambda: train_on_batch(model, batch, train_config['n_iterations'],
+                                                                  (enc_opt, dec_opt), train_config, arch), train_config)
+        elbos[precision][batch_num] = output_dict['elbo']
+        total_time += batch_time
+    times[precision] = total_time / args.n_batches
+
+print 'Batches'.ljust(10) + 'float32 ELBO'.rjust(16) + (args.precision + ' ELBO').rjust(16) + 'Rel. Diff.'.rjust(14)
+max_diff = 0.
+for start in range(0, args.n_batches, args.display_iter):
+    ave_32 = elbos['float32'][start:start + args.display_iter].mean()
+    ave_reduced = elbos[args.precision][start:start + args.display_iter].mean()
+    diff = abs(ave_reduced - ave_32) / abs(ave_32)
+    max_diff = max(max_diff, diff)
+    print str(start + args.display_iter).ljust(10) + ('%.3f' % ave_32).rjust(16) + ('%.3f' % ave_reduced).rjust(16) + ('%.4f' % diff).rjust(14)
+print 'Time per batch (s): float32 %.4f, %s %.4f' % (times['float32'], args.precision, times[args.precision])
+print 'Max. relative difference %.4f, tolerance %.4f: %s' % (max_diff, args.tolerance, 'PASS' if max_diff <= args.tolerance else 'FAIL')
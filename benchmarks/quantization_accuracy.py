@@ -0,0 +1,79 @@
+"""
+Compares the per-iteration ELBO of a model with float encoders and decoders against the same model with
+int8-quantized encoders and decoders (see DenseLatentVariableModel.quantize_for_inference), and optionally
+exports the quantized model, which lib.models.load_inference_model loads.
+
+Run from the repository root, for instance:
+    python benchmarks/quantization_accuracy.py --dataset 'mnist' --model_type 'hierarchical' --data_path '/path/to/data/' \
+        --checkpoint '/path/to/log/checkpoints/epoch_100.ckpt' --export_path '/path/to/quantized_model.ckpt'
+"""
+import argparse
+import dill
+import numpy as np
+import torch
+
+from common import add_config_args, load_config, get_data, process_batch, timed
+from lib.models import get_model, save_inference_model
+from util.train_val import run_on_batch
+
+arg_parser = add_config_args(argparse.ArgumentParser())
+arg_parser.add_argument('--checkpoint', default='', help='model checkpoint (state dict or pickled model), an untrained model is used if not given')
+arg_parser.add_argument('--export_path', default='', help='where to save the quantized model')
+arg_parser.add_argument('--n_batches', type=int, default=10, help='number of validation batches')
+arg_parser.add_argument('--seed', type=int, default=0, help='random seed for the weights and samples')
+args = arg_parser.parse_args()
+
+train_config, arch = load_config(args.dataset, args.model_type, args.inference_type)
+_, val_loader = get_data(train_config, args.data_path)
+
+
+def load_model():
+    torch.manual_seed(args.seed)
+    if args.checkpoint != '':
+        model = torch.load(args.checkpoint, pickle_module=dill)
+        if isinstance(model, dict):
+            # state dict checkpoint, see util.logs.save_checkpoint
+            checkpoint, model = model, get_model(train_config, arch, val_loader)
+            model.load_state_dict(checkpoint['model'])
+            return model
+        if train_config['cuda_device'] is not None:
+            model.cuda(train_config['cuda_device'])
+        else:
+            model.cpu()
+        return model
+    return get_model(train_config, arch, val_loader)
+
+
+models = {'float': load_model(), 'int8': load_model()}
+models['float'].freeze_for_inference()
+models['int8'].quantize_for_inference()
+
+torch.manual_seed(args.seed)
+batches = []
+for batch_num, (batch, _) in enumerate(val_loader):
+    if batch_num == args.n_batches:
+        break
+    batches.append(process_batch(models['float'], batch, train_config))
+
+elbos = {}
+times = {}
+for name, model in models.items():
+    elbos[name] = []
+    times[name] = 0.
+    torch.manual_seed(args.seed)
+    for batch in batches:
+        (output_dict,), batch_time = timed(lambda: run_on_batch(model, batch, train_config['n_iterations'],
+                                                                train_config, arch), train_config)
+        elbos[name].append(output_dict['total_elbo'])
+        times[name] += batch_time / len(batches)
+    elbos[name] = np.concatenate(elbos[name], axis=0).mean(axis=0)
+
+print 'Iteration'.ljust(11) + 'Float ELBO'.rjust(14) + 'Int8 ELBO'.rjust(14) + 'Difference'.rjust(14)
+for iteration in range(len(elbos['float'])):
+    print str(iteration).ljust(11) + ('%.3f' % elbos['float'][iteration]).rjust(14) + \
+        ('%.3f' % elbos['int8'][iteration]).rjust(14) + ('%.3f' % (elbos['int8'][iteration] - elbos['float'][iteration])).rjust(14)
+print 'Time per batch (s): float %.4f, int8 %.4f' % (times['float'], times['int8'])
+
+if args.export_path != '':
+    save_inference_model(models['int8'], train_config, arch, args.export_path)
+    print 'Saved quantized model to ' + args.export_path
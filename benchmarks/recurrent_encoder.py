@@ -0,0 +1,53 @@
+"""
+Compares the time per inference iteration of the recurrent and feedforward encoders at equal width.
+Each iteration steps the encoder once on the same input; the backward pass runs through all iterations.
+
+Run from the repository root, for instance:
+    python benchmarks/recurrent_encoder.py --n_in 1024 --n_units 1024 --n_layers 2 --connection_type 'highway'
+"""
+import argparse
+import torch
+from torch.autograd import Variable
+
+from common import timed
+from lib.modules import MultiLayerPerceptron, MultiLayerRecurrent
+
+arg_parser = argparse.ArgumentParser()
+arg_parser.add_argument('--n_in', type=int, default=1024, help='encoder input size')
+arg_parser.add_argument('--n_units', type=int, default=1024, help='units per layer')
+arg_parser.add_argument('--n_layers', type=int, default=2, help='number of layers')
+arg_parser.add_argument('--connection_type', default='highway', help='sequential, residual, highway, concat_input, or concat')
+arg_parser.add_argument('--batch_size', type=int, default=64, help='batch size')
+arg_parser.add_argument('--n_iterations', type=int, default=5, help='inference iterations per batch')
+arg_parser.add_argument('--n_repeats', type=int, default=20, help='number of timed batches')
+arg_parser.add_argument('--cuda_device', type=int, default=None, help='GPU to run on, runs on the CPU if not set')
+args = arg_parser.parse_args()
+
+train_config = {'cuda_device': args.cuda_device}
+input = Variable(torch.randn(args.batch_size, args.n_in))
+encoders = {'feedforward': MultiLayerPerceptron(args.n_in, args.n_units, args.n_layers, non_linearity='elu',
+                                                connection_type=args.connection_type),
+            'recurrent': MultiLayerRecurrent(args.n_in, args.n_layers, args.n_units,
+                                             connection_type=args.connection_type)}
+if args.cuda_device is not None:
+    input = input.cuda(args.cuda_device)
+    for encoder in encoders.values():
+        encoder.cuda(args.cuda_device)
+
+
+def run_batch(encoder):
+    """Steps the encoder once per inference iteration, then backpropagates through all iterations."""
+    if hasattr(encoder, 'reset'):
+        encoder.reset()
+    encoder.zero_grad()
+    output = 0.
+    for _ in range(args.n_iterations):
+        output = output + encoder(input).sum()
+    output.backward()
+
+
+print 'Encoder'.ljust(14) + 'Time / iteration (ms)'.rjust(24)
+for name in ['feedforward', 'recurrent']:
+    run_batch(encoders[name])
+    _, batch_time = timed(lambda: run_batch(encoders[name]), train_config, args.n_repeats)
+    print name.ljust(14) + ('%.3f' % (1000. * batch_time / args.n_iterations)).rjust(24)
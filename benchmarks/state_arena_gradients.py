@@ -0,0 +1,60 @@
+"""
+Checks that keeping the approximate posterior in the state arena (see lib.models.PosteriorStateArena) does not
+change training: from the same seed, a model with the arena and one without it must give the same state gradient
+magnitudes and ELBOs on every batch, and the same parameters after training.
+
+Run from the repository root, for instance:
+    python benchmarks/state_arena_gradients.py --dataset 'MNIST' --model_type 'hierarchical' --data_path '/path/to/data/'
+"""
+import argparse
+import numpy as np
+import torch
+
+from common import add_config_args, load_config, get_data, process_batch
+from lib.models import get_model
+from util.optimizers import get_optimizers
+from util.train_val import train_on_batch
+
+arg_parser = add_config_args(argparse.ArgumentParser())
+arg_parser.add_argument('--cuda_device', default='', help='GPU to run on, or cpu, overrides the config if given')
+arg_parser.add_argument('--n_batches', type=int, default=3, help='training batches to compare')
+arg_parser.add_argument('--seed', type=int, default=0, help='random seed')
+args = arg_parser.parse_args()
+
+train_config, arch = load_config(args.dataset, args.model_type, args.inference_type)
+if args.cuda_device != '':
+    train_config['cuda_device'] = None if args.cuda_device == 'cpu' else int(args.cuda_device)
+train_loader, _ = get_data(train_config, args.data_path)
+batches = []
+for batch_num, (batch, _) in enumerate(train_loader):
+    if batch_num == args.n_batches:
+        break
+    batches.append(batch)
+
+results = []
+for use_arena in [True, False]:
+    torch.manual_seed(args.seed)
+    model = get_model(train_config, arch, train_loader)
+    if not use_arena:
+        model.unbind_state_arena()
+    (enc_opt, _), (dec_opt, _), _ = get_optimizers(train_config, arch, model)
+    model.train()
+    state_grad_mags, elbos = [], []
+    for batch in batches:
+        output_dict = train_on_batch(model, process_batch(model, batch, train_config), train_config['n_iterations'],
+                                     (enc_opt, dec_opt), train_config, arch)
+        state_grad_mags.append(output_dict['state_grad_mags'])
+        elbos.append(output_dict['elbo'])
+    params = [param.data.cpu() for param in model.encoder_parameters() + model.decoder_parameters()]
+    results.append((np.array(state_grad_mags), np.array(elbos), params))
+
+(arena_grads, arena_elbos, arena_params), (plain_grads, plain_elbos, plain_params) = results
+grad_diff = np.abs(arena_grads - plain_grads).max() / max(np.abs(plain_grads).max(), 1e-12)
+elbo_diff = np.abs(arena_elbos - plain_elbos).max() / max(np.abs(plain_elbos).max(), 1e-12)
+param_diff = max([(arena_param - plain_param).abs().max() for arena_param, plain_param in zip(arena_params, plain_params)])
+print 'State gradient magnitudes: max. relative difference %.3g' % grad_diff
+print 'ELBO: max. relative difference %.3g' % elbo_diff
+print 'Parameters: max. difference %.3g' % param_diff
+
+passed = grad_diff <= 1e-5 and elbo_diff <= 1e-5 and param_diff <= 1e-5
+print 'Arena gradients: ' + ('PASS' if passed else 'FAIL')
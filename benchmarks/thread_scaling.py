@@ -0,0 +1,54 @@
+"""
+Times a CPU training step of the model in a config for a range of compute thread counts, reporting the
+speedup and parallel efficiency relative to the smallest thread count.
+
+Run from the repository root, for instance:
+    python benchmarks/thread_scaling.py --dataset 'mnist' --model_type 'hierarchical' --data_path '/path/to/data/' \
+        --n_threads 1 2 4 8 --pin_threads
+"""
+import argparse
+import torch
+
+from common import add_config_args, load_config, get_data, process_batch, timed
+from lib.models import get_model
+from util.cpu import configure_cpu
+from util.optimizers import get_optimizers
+from util.train_val import train_on_batch
+
+arg_parser = add_config_args(argparse.ArgumentParser())
+arg_parser.add_argument('--n_threads', type=int, nargs='+', default=[1, 2, 4, 8], help='compute thread counts')
+arg_parser.add_argument('--pin_threads', action='store_true', help='pin compute threads and data loader workers')
+arg_parser.add_argument('--numa_node', type=int, default=None, help='NUMA node to run on')
+arg_parser.add_argument('--n_repeats', type=int, default=20, help='number of timed training steps')
+args = arg_parser.parse_args()
+
+train_config, arch = load_config(args.dataset, args.model_type, args.inference_type)
+train_config['cuda_device'] = None
+train_config['precision'] = 'float32'
+train_config['pin_threads'] = args.pin_threads
+train_config['numa_node'] = args.numa_node
+# pin once for the largest thread count, smaller counts then use a subset of those cores
+train_config['n_threads'] = max(args.n_threads)
+worker_init_fn = configure_cpu(train_config)
+
+train_loader, _ = get_data(train_config, args.data_path, worker_init_fn)
+model = get_model(train_config, arch, train_loader)
+(enc_opt, _), (dec_opt, _), _ = get_optimizers(train_config, arch, model)
+batch = process_batch(model, next(iter(train_loader))[0], train_config)
+
+
+def train_step():
+    train_on_batch(model, batch, train_config['n_iterations'], (enc_opt, dec_opt), train_config, arch)
+
+
+print 'Threads'.ljust(10) + 'Time / step (ms)'.rjust(18) + 'Speedup'.rjust(10) + 'Efficiency'.rjust(12)
+base_threads = base_time = None
+for n_threads in sorted(args.n_threads):
+    torch.set_num_threads(n_threads)
+    train_step()
+    _, step_time = timed(train_step, train_config, args.n_repeats)
+    if base_time is None:
+        base_threads, base_time = n_threads, step_time
+    speedup = base_time / step_time
+    print str(n_threads).ljust(10) + ('%.3f' % (1000. * step_time)).rjust(18) + ('%.2f' % speedup).rjust(10) + \
+        ('%.2f' % (speedup * base_threads / n_threads)).rjust(12)
@@ -14,14 +14,30 @@ train_config = {
     'kl_min': 0,
     'kl_warm_up': False,
     'cuda_device': 1,
+    'precision': 'float32',  # 'float32', or 'float16' for half precision encoder/decoder matmuls and convolutions (GPU only)
+    'n_threads': None,  # CPU compute (intra-op) threads, None uses the cores not taken by data loader workers
+    'num_workers': 1,  # data loader worker processes
+    'pin_threads': False,  # pin CPU compute threads and data loader workers to separate cores
+    'numa_node': None,  # run on the cores of this NUMA node only (CPU), for runs sharing a host
+    'world_size': 1,  # number of worker processes for data-parallel training, see util/distributed.py
+    'dist_url': 'file:///tmp/iterative_inference_rendezvous',  # rendezvous of the worker processes
+    'micro_batch_size': None,  # split each data batch into micro-batches of this size, None for whole batches
+    'n_accumulation': 1,  # micro-batches whose gradients are accumulated per optimizer step
     'display_iter': 30,
+    'n_checkpoints': 3,  # number of most recent checkpoints kept, besides the one with the best validation ELBO
+    'checkpoint_iter': 200,  # optimizer steps between step checkpoints, for resuming part way through an epoch, None for none
+    'plot_sink': 'visdom',  # 'visdom', or 'file' to record the plots to plots.jsonl in the log directory
+    'plot_queue_size': 100,  # plotting calls queued for the background sender, before plots are dropped
+    'phase_timing': False,  # time the phases of training and validation, writing traces/epoch_<epoch>.json, see util/timing.py
+    'phase_timing_sync': False,  # wait for the GPU at each phase boundary, for per-phase GPU times
+    'memory_profiling': False,  # also sample device and host memory after each phase, see util/memory.py
     'eval_iter': 2000,
     'resume_experiment': None
 }
 
 # model architecture
 arch = {
-    'model_form': 'dense',  # 'dense', 'conv'
+    'model_form': 'conv',  # 'dense', 'conv'
 
     'encoder_type': 'inference_model',  # 'em', 'inference_model'
 
@@ -29,7 +45,7 @@ arch = {
     'encoding_form': ['posterior', 'layer_norm_mean_gradient', 'layer_norm_log_var_gradient', 'mean', 'log_var'],
     'variable_update_form': 'highway',
 
-    'concat_variables': True,
+    'concat_variables': False,
     'posterior_form': 'gaussian',
     'whiten_input': False,
     'constant_prior_variances': False,
@@ -37,7 +53,8 @@ arch = {
     'learn_top_prior': False,
     'top_size': 1,
 
-    'n_latent': [1024],
+    'n_latent': [8],  # conv: channels per level
+    'analytical_kl': [True],  # per level, closed-form (True) or sampled (False) KL
 
     'n_det_enc': [0],
     'n_det_dec': [0],
@@ -45,8 +62,11 @@ arch = {
     'n_layers_enc': [3, 0],
     'n_layers_dec': [1, 1],
 
-    'n_units_enc': [2048, 0],
-    'n_units_dec': [2048, 1],
+    'n_units_enc': [64, 0],  # conv: filters per layer
+    'n_units_dec': [64, 1],
+
+    'filter_size': 3,
+    'downsample': [2],  # conv: stride of each level's input convolution
 
     'non_linearity_enc': 'elu',
     'non_linearity_dec': 'elu',
@@ -1,9 +1,22 @@
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 import numpy as np
 from torch.autograd import Variable
 
 
+def match_samples(param):
+    """
+    Adds a singleton sample dimension to a (batch_size x n_variables) parameter, which is then
+    broadcast against (batch_size x n_samples x n_variables) samples rather than copied.
+    :param param: the parameter, of size (batch_size x n_variables) or (batch_size x n_samples x n_variables)
+    :return: the parameter with a sample dimension
+    """
+    if len(param.size()) == 2:
+        return param.unsqueeze(1)
+    return param
+
+
 class PointEstimate(object):
 
     def __init__(self, mean=None):
@@ -64,19 +77,23 @@ class DiagonalGaussian(object):
         self._sample = None
         self._cuda_device = None
 
-    def sample(self, n_samples=1, resample=False):
+    def sample(self, n_samples=1, resample=False, batch_size=None):
         """
         Draws a tensor of samples.
         :param n_samples: number of samples to draw
         :param resample: whether to resample or just use current sample
+        :param batch_size: batch size to broadcast (1 x n_variables) parameters to, defaults to that of the mean
         :return: a (batch_size x n_samples x n_variables) tensor of samples
         """
         if self._sample is None or resample:
             mean = self.mean
             std = self.log_var.mul(0.5).exp_()
             if len(self.mean.size()) == 2:
-                mean = mean.unsqueeze(1).repeat(1, n_samples, 1)
-                std = std.unsqueeze(1).repeat(1, n_samples, 1)
+                if batch_size is None:
+                    batch_size = mean.size()[0]
+                size = (batch_size, n_samples, mean.size()[1])
+                mean = mean.unsqueeze(1).expand(*size)
+                std = std.unsqueeze(1).expand(*size)
             rand_normal = Variable(mean.data.new(mean.size()).normal_())
             self._sample = rand_normal.mul_(std).add_(mean)
         return self._sample
@@ -90,15 +107,7 @@ class DiagonalGaussian(object):
         if sample is None:
             sample = self.sample()
         assert self.mean is not None and self.log_var is not None, 'Mean or log variance are None.'
-        n_samples = sample.size()[1]
-        if len(self.mean.data.shape) == 2:
-            mean = self.mean.unsqueeze(1).repeat(1, n_samples, 1)
-        else:
-            mean = self.mean
-        if len(self.log_var.data.shape) == 2:
-            log_var = self.log_var.unsqueeze(1).repeat(1, n_samples, 1)
-        else:
-            log_var = self.log_var
+        mean, log_var = match_samples(self.mean), match_samples(self.log_var)
         return -0.5 * (log_var + np.log(2 * np.pi) + torch.pow(sample - mean, 2) / (torch.exp(log_var) + 1e-5))
 
     def reset_mean(self, value=None):
@@ -194,17 +203,52 @@ class DiagonalGaussian(object):
 
 class Bernoulli(object):
 
-    def __init__(self, n_variables, mean=None):
+    _mean = None
+    _logits = None
+
+    def __init__(self, n_variables, mean=None, logits=None):
         """
-        Creates a Bernoulli distribution.
+        Creates a Bernoulli distribution, parameterized by either its mean or its logits.
         :param n_variables: the size (number of dimensions) of the distribution.
         :param mean: mean of the Bernoulli distribution.
+        :param logits: logits (pre-sigmoid mean) of the Bernoulli distribution.
         """
         self.n_variables = n_variables
         self.mean = mean
+        if logits is not None:
+            self.logits = logits
         self._sample = None
         self._cuda_device = None
 
+    def __setstate__(self, state):
+        # distributions pickled before the logits parameterization hold the mean as a plain attribute,
+        # which the mean property would otherwise hide
+        if 'mean' in state:
+            state['_mean'] = state.pop('mean')
+        self.__dict__.update(state)
+
+    @property
+    def mean(self):
+        """The mean of the distribution, computed from the logits on first access if needed."""
+        if self._mean is None and self._logits is not None:
+            self._mean = torch.sigmoid(self._logits)
+        return self._mean
+
+    @mean.setter
+    def mean(self, value):
+        self._mean = value
+        self._logits = None
+
+    @property
+    def logits(self):
+        """The logits of the distribution, or None if parameterized by the mean."""
+        return self._logits
+
+    @logits.setter
+    def logits(self, value):
+        self._logits = value
+        self._mean = None
+
     def sample(self, n_samples=1, resample=False):
         """
         Draws a tensor of samples.
@@ -226,12 +270,12 @@ class Bernoulli(object):
         """
         if sample is None:
             sample = self.sample()
+        if self.logits is not None:
+            # log sigmoid(l) = l - softplus(l), log (1 - sigmoid(l)) = -softplus(l)
+            logits = match_samples(self.logits)
+            return sample * logits - F.softplus(logits)
         assert self.mean is not None, 'Mean is None.'
-        n_samples = sample.size()[1]
-        if len(self.mean.data.shape) == 2:
-            mean = self.mean.unsqueeze(1).repeat(1, n_samples, 1)
-        else:
-            mean = self.mean
+        mean = match_samples(self.mean)
         return sample * torch.log(mean + 1e-7) + (1 - sample) * torch.log(1 - mean + 1e-7)
 
     def reset_mean(self, value=None):
@@ -276,7 +320,9 @@ class Bernoulli(object):
         :param device_id: device on which to place the distribution
         :return: None
         """
-        if self.mean is not None:
+        if self.logits is not None:
+            self.logits = Variable(self.logits.data.cuda(device_id), requires_grad=self.logits.requires_grad)
+        elif self.mean is not None:
             self.mean = Variable(self.mean.data.cuda(device_id), requires_grad=self.mean.requires_grad)
         self._cuda_device = device_id
 
@@ -285,7 +331,9 @@ class Bernoulli(object):
         Places the distribution on the CPU.
         :return: None
         """
-        if self.mean is not None:
+        if self.logits is not None:
+            self.logits = self.logits.cpu()
+        elif self.mean is not None:
             self.mean = self.mean.cpu()
         self._cuda_device = None
 
@@ -1,41 +1,204 @@
 import torch
+import torch.nn.functional as F
 from torch.autograd import Variable
 import torch.optim as opt
 import numpy as np
 
-from util.logs import load_model_checkpoint
+from util.logs import load_model_checkpoint, load_checkpoint
+from util.timing import phase
 from distributions import DiagonalGaussian, Bernoulli, Multinomial
-from modules import Dense, MultiLayerPerceptron, DenseGaussianVariable, DenseLatentLevel, RecurrentLatentLevel
+from modules import Dense, Conv, MultiLayerPerceptron, MultiLayerConv, DenseGaussianVariable, DenseLatentLevel, \
+    ConvLatentLevel, RecurrentLatentLevel, freeze_layers, precision_layers, \
+    quantize_layers
 
 
 def get_model(train_config, arch, data_loader):
+    checkpoint = None
     if train_config['resume_experiment'] != '' and train_config['resume_experiment'] is not None:
-        model = load_model_checkpoint(cuda_device=train_config['cuda_device'])
-        model.cuda(train_config['cuda_device'])
-        return model
-    elif arch['model_form'] == 'dense':
-        return DenseLatentVariableModel(train_config, arch, data_loader)
+        checkpoint = load_checkpoint()
+        if checkpoint is None:
+            # the experiment only has pickled model checkpoints
+            model = load_model_checkpoint(cuda_device=train_config['cuda_device'])
+            if train_config['cuda_device'] is not None:
+                model.cuda(train_config['cuda_device'])
+            else:
+                model.cpu()
+            return model
+    if arch['model_form'] == 'dense':
+        model = DenseLatentVariableModel(train_config, arch, data_loader)
     elif arch['model_form'] == 'conv':
-        return ConvLatentVariableModel(train_config, arch, data_loader)
+        model = ConvLatentVariableModel(train_config, arch, data_loader)
+    if checkpoint is not None:
+        model.load_state_dict(checkpoint['model'])
+    return model
+
+
+def load_inference_model(file_name, data_loader, cuda_device=None):
+    """
+    Loads a model exported for inference, see save_inference_model.
+    :param file_name: the exported file
+    :param data_loader: a data loader, for the input size
+    :param cuda_device: the GPU to place the model on, None for the CPU
+    :return: the model, frozen (or quantized) for inference
+    """
+    export = torch.load(file_name, map_location=lambda storage, location: storage)
+    train_config = dict(export['train_config'])
+    train_config['resume_experiment'] = None
+    train_config['cuda_device'] = cuda_device
+    model = get_model(train_config, export['arch'], data_loader)
+    if export['quantized']:
+        model.quantize_for_inference()
+    else:
+        model.freeze_for_inference()
+    model.load_inference_state_dict(export['model'])
+    return model
+
+
+def save_inference_model(model, train_config, arch, file_name, quantized=True):
+    """
+    Exports a model frozen (or quantized) for inference: its config and inference_state_dict, without the
+    float weights of the frozen layers or the optimizers.
+    :param model: the model, after freeze_for_inference or quantize_for_inference
+    :param train_config: the model's train config
+    :param arch: the model's architecture config
+    :param file_name: where to save the model
+    :param quantized: whether the model was quantized
+    :return: None
+    """
+    torch.save({'train_config': train_config, 'arch': arch, 'quantized': quantized,
+                'model': model.inference_state_dict()}, file_name)
+
+
+class PosteriorStateArena(object):
+
+    # latent variables bound onto the buffers, and whether their parameters reference the state buffer, see bind
+    latents = ()
+    state_bound = False
+
+    def __init__(self, batch_size, level_sizes, n_params):
+        """
+        Contiguous, preallocated storage for the approximate posterior parameters and their gradients at all levels.
+        Each level's parameters are contiguous (batch_size x n_latent) segments of a single flat buffer.
+        :param batch_size: the initial batch size, see resize
+        :param level_sizes: list of the number of latent variables at each level
+        :param n_params: number of posterior parameters per variable (2 for Gaussian, 1 for point estimate)
+        """
+        self.level_sizes = list(level_sizes)
+        self.n_params = n_params
+        self.state = torch.zeros(1)
+        self.grad = torch.zeros(1)
+        self.segment_ids = torch.LongTensor(1)
+        self.resize(batch_size)
+
+    def resize(self, batch_size):
+        """
+        Reallocates the buffers, on their current device, for a batch size.
+        Views from views() are invalidated and have to be bound again.
+        :param batch_size: the batch size
+        """
+        self.batch_size = batch_size
+        self.size = batch_size * self.n_params * sum(self.level_sizes)
+        self.state = self.state.new(self.size).zero_()
+        self.grad = self.grad.new(self.size).zero_()
+        # whether posterior parameters have been bound onto the state buffer since it was allocated, see renew_state
+        self.state_bound = False
+
+        # segment index of each element, used to reduce all segments at once
+        self.segment_sizes = []
+        for n_latent in self.level_sizes:
+            self.segment_sizes.extend([batch_size * n_latent] * self.n_params)
+        self.segment_ids = torch.cat([self.segment_ids.new(size).fill_(segment) for segment, size in enumerate(self.segment_sizes)])
+
+    def views(self, buffer, level):
+        """
+        Gets the views into a buffer for one level.
+        :param buffer: the flat state or gradient buffer
+        :param level: the level index
+        :return: list of (batch_size x n_latent) views, one per posterior parameter
+        """
+        offset = self.batch_size * self.n_params * sum(self.level_sizes[:level])
+        n_latent = self.level_sizes[level]
+        views = []
+        for _ in range(self.n_params):
+            views.append(buffer.narrow(0, offset, self.batch_size * n_latent).view(self.batch_size, n_latent))
+            offset += self.batch_size * n_latent
+        return views
+
+    def bind(self, latents):
+        """
+        Places each latent variable's approximate posterior parameters and gradients into the buffers.
+        :param latents: list of the latent variables, one per level
+        :return: None
+        """
+        self.latents = list(latents)
+        for level, latent in enumerate(self.latents):
+            latent.set_state_buffers(self.views(self.state, level), self.views(self.grad, level), arena=self)
+
+    def renew_state(self):
+        """
+        Moves the state into a freshly allocated buffer and rebinds the latent variables' state views onto it.
+        Posterior parameters bound onto the old buffer, and the graphs that saved them, keep the old buffer, so
+        that writing the state never changes a tensor that a backward pass may still read.
+        :return: None
+        """
+        self.state = self.state.clone()
+        self.state_bound = False
+        for level, latent in enumerate(self.latents):
+            latent.renew_state_buffers(self.views(self.state, level))
+
+    def reset(self):
+        """Zeros the state and gradients of all levels."""
+        self.state.zero_()
+        self.grad.zero_()
+
+    def grad_magnitudes(self):
+        """
+        Calculates the average absolute gradient of each posterior parameter at each level.
+        :return: array of size (n_levels x n_params)
+        """
+        sums = self.grad.new(len(self.segment_sizes)).zero_().index_add_(0, self.segment_ids, self.grad.abs())
+        sums = sums.cpu().numpy() / np.array(self.segment_sizes, dtype=float)
+        return sums.reshape((len(self.level_sizes), self.n_params))
+
+    def cuda(self, device_id=0):
+        self.state = self.state.cuda(device_id)
+        self.grad = self.grad.cuda(device_id)
+        self.segment_ids = self.segment_ids.cuda(device_id)
+
+    def cpu(self):
+        self.state = self.state.cpu()
+        self.grad = self.grad.cpu()
+        self.segment_ids = self.segment_ids.cpu()
 
 
 class DenseLatentVariableModel(object):
 
+    # shared storage for the approximate posterior parameters, see PosteriorStateArena
+    state_arena = None
+
+    # precision of the encoder and decoder matmuls, see set_precision
+    precision = 'float32'
+
+    # closed-form (True) or sampled (False) KL divergence, per level or for all levels
+    analytical_kl = False
+
+    # timer of the encoding and decoding phases of each level, see util/timing.py, None when not timing
+    phase_timer = None
+
     def __init__(self, train_config, arch, data_loader):
 
         self.encoding_form = arch['encoding_form']
         self.constant_variances = arch['constant_prior_variances']
         self.single_output_variance = arch['single_output_variance']
         self.posterior_form = arch['posterior_form']
-        self.batch_size = train_config['batch_size']
         self.n_training_samples = train_config['n_samples']
         self.kl_min = train_config['kl_min']
         self.concat_variables = arch['concat_variables']
         self.top_size = arch['top_size']
+        self.analytical_kl = arch['analytical_kl']
         self.input_size = np.prod(tuple(next(iter(data_loader))[0].size()[1:])).astype(int)
         assert train_config['output_distribution'] in ['bernoulli', 'gaussian', 'multinomial'], 'Output distribution not recognized.'
         self.output_distribution = train_config['output_distribution']
-        self.reconstruction = None
         self.kl_weight = 1.
 
         # construct the model
@@ -44,9 +207,16 @@ class DenseLatentVariableModel(object):
         self.state_optimizer = None
         self.__construct__(arch)
 
+        # the approximate posterior parameters of all levels live in one buffer
+        n_params = 2 if self.posterior_form == 'gaussian' else 1
+        level_sizes = [latent_level.latent.n_variables for latent_level in self.levels]
+        self.state_arena = PosteriorStateArena(train_config['batch_size'], level_sizes, n_params)
+        self.bind_state_arena()
+
         self._cuda_device = None
         if train_config['cuda_device'] is not None:
             self.cuda(train_config['cuda_device'])
+        self.set_precision(train_config['precision'])
 
     def __construct__(self, arch):
         """
@@ -61,7 +231,9 @@ class DenseLatentVariableModel(object):
         const_prior_var = arch['constant_prior_variances']
         posterior_form = arch['posterior_form']
 
-        latent_level_type = RecurrentLatentLevel if arch['encoder_type'] == 'recurrent' else DenseLatentLevel
+        latent_level_type = DenseLatentLevel
+        if arch['encoder_type'] == 'inference_model' and arch['inference_model_type'] == 'recurrent':
+            latent_level_type = RecurrentLatentLevel
 
         encoder_arch = None
         if arch['encoder_type'] == 'inference_model':
@@ -97,8 +269,8 @@ class DenseLatentVariableModel(object):
 
             learn_prior = True if arch['learn_top_prior'] else (level != len(arch['n_latent'])-1)
 
-            self.levels[level] = latent_level_type(self.batch_size, encoder_arch, decoder_arch, n_latent, n_det,
-                                                  encoding_form, const_prior_var, variable_update_form, posterior_form, learn_prior)
+            self.levels[level] = latent_level_type(encoder_arch, decoder_arch, n_latent, n_det, encoding_form,
+                                                  const_prior_var, variable_update_form, posterior_form, learn_prior)
 
         # construct the output decoder
         decoder_arch['n_in'] = self.decoder_input_size(-1, arch)
@@ -106,27 +278,44 @@ class DenseLatentVariableModel(object):
         decoder_arch['n_layers'] = arch['n_layers_dec'][0]
         self.output_decoder = MultiLayerPerceptron(**decoder_arch)
 
-        # construct the output distribution
+        self.construct_output_distribution(arch)
+
+        # make the state trainable if encoder_type is EM
+        if arch['encoder_type'] in ['em', 'EM']:
+            self.trainable_state()
+
+    def construct_output_distribution(self, arch):
+        """
+        Construct the output distribution and the layers that output its parameters.
+        :param arch: architecture dictionary
+        :return None
+        """
         if self.output_distribution == 'bernoulli':
+            # outputs logits, the likelihood is evaluated in logit space
             self.output_dist = Bernoulli(self.input_size, None)
-            self.mean_output = Dense(arch['n_units_dec'][0], self.input_size, non_linearity='sigmoid', weight_norm=arch['weight_norm_dec'])
+            self.mean_output = self.output_layer(arch, non_linearity='linear')
         elif self.output_distribution == 'multinomial':
             self.output_dist = Multinomial(self.input_size, None)
-            self.mean_output = Dense(arch['n_units_dec'][0], self.input_size, non_linearity='linear', weight_norm=arch['weight_norm_dec'])
+            self.mean_output = self.output_layer(arch, non_linearity='linear')
         elif self.output_distribution == 'gaussian':
             self.output_dist = DiagonalGaussian(self.input_size, None, None)
-            self.mean_output = Dense(arch['n_units_dec'][0], self.input_size, non_linearity='sigmoid', weight_norm=arch['weight_norm_dec'])
+            self.mean_output = self.output_layer(arch, non_linearity='sigmoid')
             if self.constant_variances:
                 if arch['single_output_variance']:
                     self.trainable_log_var = Variable(torch.zeros(1), requires_grad=True)
                 else:
                     self.trainable_log_var = Variable(torch.normal(torch.zeros(self.input_size), 0.25), requires_grad=True)
             else:
-                self.log_var_output = Dense(arch['n_units_dec'][0], self.input_size, weight_norm=arch['weight_norm_dec'])
+                self.log_var_output = self.output_layer(arch)
 
-        # make the state trainable if encoder_type is EM
-        if arch['encoder_type'] in ['em', 'EM']:
-            self.trainable_state()
+    def output_layer(self, arch, non_linearity=None):
+        """
+        Creates a layer that maps the output decoder to an output distribution parameter.
+        :param arch: architecture dictionary
+        :param non_linearity: the non-linearity of the layer
+        :return: a Dense layer with input_size outputs
+        """
+        return Dense(arch['n_units_dec'][0], self.input_size, non_linearity=non_linearity, weight_norm=arch['weight_norm_dec'])
 
     def encoder_input_size(self, level_num, arch):
         """
@@ -293,8 +482,7 @@ class DenseLatentVariableModel(object):
             if self.output_distribution == 'gaussian':
                 norm_error = error / torch.exp(self.output_dist.log_var.detach().mean(dim=1))
             elif self.output_distribution == 'bernoulli':
-                mean = self.output_dist.mean.detach().mean(dim=1)
-                norm_error = error * torch.exp(- torch.log(mean + 1e-5) - torch.log(1 - mean + 1e-5))
+                norm_error = error * self.output_precision()
             encoding = norm_error if encoding is None else torch.cat((encoding, norm_error), dim=1)
         if 'norm_bottom_norm_error' in self.encoding_form:
             error = input - self.output_dist.mean.detach().mean(dim=1)
@@ -302,12 +490,19 @@ class DenseLatentVariableModel(object):
             if self.output_distribution == 'gaussian':
                 norm_error = error / torch.exp(self.output_dist.log_var.detach().mean(dim=1))
             elif self.output_distribution == 'bernoulli':
-                mean = self.output_dist.mean.detach().mean(dim=1)
-                norm_error = error * torch.exp(- torch.log(mean + 1e-5) - torch.log(1 - mean + 1e-5))
+                norm_error = error * self.output_precision()
             norm_norm_error = norm_error / torch.norm(norm_error, 2, 1, True)
             encoding = norm_norm_error if encoding is None else torch.cat((encoding, norm_norm_error), dim=1)
         return encoding
 
+    def output_precision(self):
+        """
+        Inverse variance of the Bernoulli output distribution, 1 / (mean * (1 - mean)), averaged over samples.
+        :return: the output precision
+        """
+        mean = self.output_dist.mean.detach().mean(dim=1)
+        return 1. / ((mean + 1e-5) * (1 - mean + 1e-5))
+
     def encode(self, input):
         """
         Encodes the input into an updated posterior estimate.
@@ -320,53 +515,84 @@ class DenseLatentVariableModel(object):
             input = self.process_input(input.view(-1, self.input_size))
 
             h = self.get_input_encoding(input)
-            for latent_level in self.levels:
-                if self.concat_variables:
-                    h = torch.cat([h, latent_level.encode(h)], dim=1)
-                else:
-                    h = latent_level.encode(h)
+            for level_num, latent_level in enumerate(self.levels):
+                with phase(self.phase_timer, 'encode', level_num):
+                    if self.concat_variables:
+                        h = torch.cat([h, latent_level.encode(h)], dim=1)
+                    else:
+                        h = latent_level.encode(h)
 
-    def decode(self, n_samples=0, generate=False):
+    def decode(self, n_samples=0, generate=False, batch_size=None):
         """
         Decodes the posterior (prior) estimate to get a reconstruction (sample).
         :param n_samples: number of samples to decode
         :param generate: flag to generate or reconstruct the data
+        :param batch_size: the batch size to generate at, defaults to that of the posterior estimate, which is
+                           always used when reconstructing
         :return output distribution of reconstruction/sample
         """
         if n_samples == 0:
             n_samples = self.n_training_samples
-        h = Variable(torch.zeros(self.batch_size, n_samples, self.top_size))
-        if self._cuda_device is not None:
-            h = h.cuda(self._cuda_device)
-        concat = False
-        for latent_level in self.levels[::-1]:
-            if self.concat_variables and concat:
-                h = torch.cat([h, latent_level.decode(h, n_samples, generate)], dim=2)
-            else:
-                h = latent_level.decode(h, n_samples, generate)
-            concat = True
-
-        h = h.view(-1, h.size()[2])
-        h = self.output_decoder(h)
-        mean_out = self.mean_output(h)
-        mean_out = mean_out.view(self.batch_size, n_samples, self.input_size)
-        self.output_dist.mean = mean_out
+        if not generate or batch_size is None:
+            batch_size = self.state_batch_size()
+        h = self.decode_levels(batch_size, n_samples, generate)
+        with phase(self.phase_timer, 'decode_output'):
+            h = self.output_decoder(h)
+            mean_out = self.flatten_output(self.mean_output(h), n_samples)
+        if self.output_distribution == 'bernoulli' and self.mean_output.non_linearity is None:
+            self.output_dist.logits = mean_out
+        else:
+            # includes Bernoulli models pickled before the logit output, whose output layer has a sigmoid
+            self.output_dist.mean = mean_out
 
         if self.output_distribution == 'gaussian':
             if self.constant_variances:
-                if self.single_output_variance:
-                    self.output_dist.log_var = torch.clamp(self.trainable_log_var * Variable(torch.ones(self.batch_size, n_samples, self.input_size).cuda(self._cuda_device)), -7, 15)
-                else:
-                    self.output_dist.log_var = torch.clamp(self.trainable_log_var.view(1, 1, -1).repeat(self.batch_size, n_samples, 1), -7., 15)
+                # a single output variance or one per input dimension
+                self.output_dist.log_var = torch.clamp(self.trainable_log_var.view(1, 1, -1).expand_as(mean_out), -7., 15)
             else:
-                log_var_out = self.log_var_output(h)
-                log_var_out = log_var_out.view(self.batch_size, n_samples, self.input_size)
+                log_var_out = self.flatten_output(self.log_var_output(h), n_samples)
                 self.output_dist.log_var = torch.clamp(log_var_out, -7., 15)
+        return self.output_dist
+
+    def decode_levels(self, batch_size, n_samples, generate=False):
+        """
+        Decodes from the top latent level down to the input of the output decoder.
+        :param batch_size: the batch size
+        :param n_samples: number of samples to decode
+        :param generate: flag to generate or reconstruct the data
+        :return the input to the output decoder, with samples in the batch dimension
+        """
+        h = Variable(torch.zeros(batch_size, n_samples, self.top_size))
+        if self._cuda_device is not None:
+            h = h.cuda(self._cuda_device)
+        concat = False
+        for level_num in range(len(self.levels))[::-1]:
+            with phase(self.phase_timer, 'decode', level_num):
+                if self.concat_variables and concat:
+                    h = torch.cat([h, self.levels[level_num].decode(h, n_samples, generate)], dim=2)
+                else:
+                    h = self.levels[level_num].decode(h, n_samples, generate)
+            concat = True
+        return h.view(-1, h.size()[2])
+
+    def flatten_output(self, output, n_samples):
+        """
+        Reshapes the output of an output layer into (batch_size x n_samples x input_size).
+        :param output: the output, with samples in the batch dimension
+        :param n_samples: number of samples in the output
+        :return the reshaped output
+        """
+        return output.view(-1, n_samples, self.input_size)
 
-        self.reconstruction = self.output_dist.mean[:, 0, :]
+    @property
+    def reconstruction(self):
+        """The (scaled) mean of the output distribution for the first sample, computed on access."""
+        if self.output_dist is None or self.output_dist.mean is None:
+            return None
+        reconstruction = self.output_dist.mean[:, 0, :]
         if self.output_distribution in ['gaussian', 'bernoulli']:
-            self.reconstruction = self.reconstruction * 255.
-        return self.output_dist
+            reconstruction = reconstruction * 255.
+        return reconstruction
 
     def kl_divergences(self, averaged=False):
         """
@@ -375,10 +601,15 @@ class DenseLatentVariableModel(object):
         :return list of KL divergences at each level
         """
         kl = []
-        for latent_level in range(len(self.levels)-1):
-            # for latent_level in range(len(self.levels)):
-            kl.append(torch.clamp(self.levels[latent_level].kl_divergence(), min=self.kl_min).sum(dim=2))
-        kl.append(self.levels[-1].latent.analytical_kl().sum(dim=2))
+        for level_num, latent_level in enumerate(self.levels):
+            analytical_kl = self.analytical_kl[level_num] if isinstance(self.analytical_kl, list) else self.analytical_kl
+            if analytical_kl:
+                level_kl = latent_level.latent.analytical_kl()
+            else:
+                level_kl = latent_level.kl_divergence()
+            if level_num < len(self.levels) - 1:
+                level_kl = torch.clamp(level_kl, min=self.kl_min)
+            kl.append(level_kl.sum(dim=2))
         if averaged:
             return [level_kl.mean() for level_kl in kl]
         else:
@@ -393,10 +624,9 @@ class DenseLatentVariableModel(object):
         """
         if self._cuda_device is not None:
             input = input.cuda(self._cuda_device)
+        # the input is broadcast against the output samples
         input = input.view(-1, 1, self.input_size) / 255.
         # input = self.process_input(input.view(-1, self.input_size))
-        n_samples = self.output_dist.mean.data.shape[1]
-        input = input.repeat(1, n_samples, 1)
         log_prob = self.output_dist.log_prob(sample=input)
         if self.output_distribution == 'gaussian':
             log_prob = log_prob - np.log(256.)
@@ -447,10 +677,49 @@ class DenseLatentVariableModel(object):
             state_grads[level_num] = latent_level.state_gradients()
         return state_grads
 
-    def reset_state(self, mean=None, log_var=None, from_prior=True):
-        """Resets the posterior estimate."""
+    def state_gradient_magnitudes(self):
+        """
+        Get the average magnitudes of the gradients for the approximate posterior parameters.
+        :return: array of size (n_levels x 2), the second column is zero for point estimates
+        """
+        grad_mags = np.zeros((len(self.levels), 2))
+        if self.state_arena is not None:
+            grad_mags[:, :self.state_arena.n_params] = self.state_arena.grad_magnitudes()
+            return grad_mags
+        for level_num, latent_level in enumerate(self.levels):
+            grads = latent_level.state_gradients()
+            for param_num, grad in enumerate(grads):
+                grad_mags[level_num, param_num] = grad.abs().mean().data.cpu().numpy()[0]
+        return grad_mags
+
+    def bind_state_arena(self):
+        """Places each level's approximate posterior parameters and gradients into the state arena."""
+        self.state_arena.bind([latent_level.latent for latent_level in self.levels])
+
+    def unbind_state_arena(self):
+        """Keeps each level's approximate posterior parameters and gradients in their own tensors instead."""
+        self.state_arena = None
+        for latent_level in self.levels:
+            latent_level.latent.set_state_buffers(None, None)
+
+    def reset_state(self, mean=None, log_var=None, from_prior=True, batch_size=None):
+        """
+        Resets the posterior estimate, resizing the state arena if the batch size has changed.
+        :param batch_size: the batch size of the estimate, that of the data, required to reset from the prior;
+                           defaults to that of the given mean otherwise
+        """
+        if batch_size is None:
+            assert not from_prior, 'The batch size is required to reset the state from the prior.'
+            batch_size = mean.size()[0]
+        if self.state_arena is not None and self.state_arena.batch_size != batch_size:
+            self.state_arena.resize(batch_size)
+            self.bind_state_arena()
         for latent_level in self.levels:
-            latent_level.reset(mean=mean, log_var=log_var, from_prior=from_prior)
+            latent_level.reset(mean=mean, log_var=log_var, from_prior=from_prior, batch_size=batch_size)
+
+    def state_batch_size(self):
+        """Gets the batch size of the posterior estimate."""
+        return self.state_parameters()[0].size()[0]
 
     def trainable_state(self):
         """Makes the posterior estimate trainable."""
@@ -462,6 +731,16 @@ class DenseLatentVariableModel(object):
         for latent_level in self.levels:
             latent_level.not_trainable_state()
 
+    def trainable_decoder(self):
+        """Makes the decoder parameters trainable."""
+        for param in self.decoder_parameters():
+            param.requires_grad = True
+
+    def not_trainable_decoder(self):
+        """Makes the decoder parameters not trainable (excluded from autograd)."""
+        for param in self.decoder_parameters():
+            param.requires_grad = False
+
     def parameters(self):
         """Returns a list containing all parameters."""
         return self.encoder_parameters() + self.decoder_parameters() + self.state_parameters()
@@ -494,6 +773,54 @@ class DenseLatentVariableModel(object):
             states.extend(list(latent_level.state_parameters()))
         return states
 
+    def named_modules(self):
+        """Returns a list of the (name, module) pairs of all levels and the output layers."""
+        modules = []
+        for level_num, latent_level in enumerate(self.levels):
+            prefix = 'levels.' + str(level_num) + '.'
+            modules.extend([(prefix + name, module) for name, module in latent_level.named_modules()])
+        modules.extend([('output_decoder', self.output_decoder), ('mean_output', self.mean_output)])
+        if self.output_distribution == 'gaussian' and not self.constant_variances:
+            modules.append(('log_var_output', self.log_var_output))
+        return modules
+
+    def named_variables(self):
+        """Returns a list of the (name, variable) pairs of the trainable variables outside of the modules."""
+        variables = []
+        for level_num, latent_level in enumerate(self.levels):
+            prefix = 'levels.' + str(level_num) + '.'
+            variables.extend([(prefix + name, variable) for name, variable in latent_level.named_variables()])
+        if self.output_distribution == 'gaussian' and self.constant_variances:
+            variables.append(('trainable_log_var', self.trainable_log_var))
+        return variables
+
+    def state_dict(self):
+        """
+        Gets the parameters and buffers (batch norm running statistics) of the model, by name.
+        The tensors are those of the model, not copies.
+        :return: dict of tensors
+        """
+        state_dict = dict()
+        for name, module in self.named_modules():
+            module.state_dict(state_dict, prefix=name + '.')
+        for name, variable in self.named_variables():
+            state_dict[name] = variable.data
+        return state_dict
+
+    def load_state_dict(self, state_dict):
+        """
+        Copies parameters and buffers from a state dict into the model, which must have the same architecture.
+        The tensors are copied onto the model's device.
+        :param state_dict: dict of tensors, as given by state_dict
+        :return: None
+        """
+        for name, module in self.named_modules():
+            prefix = name + '.'
+            module.load_state_dict({key[len(prefix):]: value for key, value in state_dict.items()
+                                    if key.startswith(prefix)})
+        for name, variable in self.named_variables():
+            variable.data.copy_(state_dict[name])
+
     def eval(self):
         """Puts the model into eval mode (affects batch_norm and dropout)."""
         for latent_level in self.levels:
@@ -514,6 +841,109 @@ class DenseLatentVariableModel(object):
             if not self.constant_variances:
                 self.log_var_output.train()
 
+    def freeze_for_inference(self):
+        """
+        Puts the model into eval mode and folds the batch norm running statistics into the
+        Dense layer weights at every level, removing batch norm and dropout from the forward pass.
+        Calling train() reverts this. Call after placing the model on its device.
+        """
+        self.eval()
+        for latent_level in self.levels:
+            latent_level.freeze_for_inference()
+        freeze_layers(self.output_decoder, self.mean_output)
+        if self.output_distribution == 'gaussian' and not self.constant_variances:
+            freeze_layers(self.log_var_output)
+
+    def set_precision(self, precision):
+        """
+        Sets the precision of the matmuls and convolutions in the Dense and Conv layers of the encoders and
+        decoders. The parameters are kept in float32 (master weights), as are the approximate posterior and its
+        gradients, the posterior and prior heads, the output layers, the KL divergences, and the log likelihood.
+        :param precision: 'float32', or 'float16' for half precision (GPU only)
+        :return None
+        """
+        assert precision in ['float32', 'float16'], 'Precision not recognized.'
+        assert precision == 'float32' or self._cuda_device is not None, 'Half precision matmuls require a GPU.'
+        self.precision = precision
+        precision_layers(precision, *self.encoder_decoder_modules())
+
+    def emulate_bfloat16(self, enabled=True):
+        """
+        Rounds the inputs and weights of the encoder and decoder matmuls and convolutions to bfloat16, computing
+        them in float32, to check how training converges with bfloat16 numerics (see
+        benchmarks/precision_convergence.py). This is not a training precision: torch has no bfloat16 type or
+        kernels, so it is slower than float32 and saves no memory.
+        :param enabled: whether to round to bfloat16, or to go back to the precision of set_precision
+        :return None
+        """
+        assert self.precision == 'float32', 'bfloat16 emulation replaces float32 matmuls only.'
+        precision_layers('bfloat16' if enabled else self.precision, *self.encoder_decoder_modules())
+
+    def encoder_decoder_modules(self):
+        """
+        Gets the encoder and decoder networks of all levels and the output decoder,
+        excluding the layers that output the distribution parameters.
+        :return list of modules (None for missing deterministic layers)
+        """
+        modules = []
+        for latent_level in self.levels:
+            modules.extend([latent_level.encoder, latent_level.decoder,
+                            latent_level.deterministic_encoder, latent_level.deterministic_decoder])
+        modules.append(self.output_decoder)
+        return modules
+
+    def quantize_for_inference(self):
+        """
+        Freezes the model for inference, then quantizes the Dense layers of the encoders and decoders to
+        int8 weights, with inputs quantized dynamically per batch. The posterior and prior heads, the output
+        layers, and the posterior and likelihood arithmetic stay in float. Calling train() reverts this.
+        """
+        self.freeze_for_inference()
+        quantize_layers(*self.encoder_decoder_modules())
+
+    def frozen_layers(self):
+        """
+        Gets the Dense and Conv layers that were frozen for inference, see freeze_for_inference.
+        :return list of (name, layer) pairs
+        """
+        layers = []
+        for name, module in self.named_modules():
+            layers.extend([(layer_name, layer) for layer_name, layer in module.named_modules(prefix=name)
+                           if isinstance(layer, (Dense, Conv)) and layer._frozen_params is not None])
+        return layers
+
+    def inference_state_dict(self):
+        """
+        Gets the tensors used for inference after freeze_for_inference or quantize_for_inference: the folded
+        weights and biases of the frozen layers, or their int8 weights and scales, in place of their float
+        weights and batch norm statistics, and the other parameters and buffers as in state_dict.
+        :return: dict of tensors
+        """
+        frozen_layers = self.frozen_layers()
+        prefixes = tuple(name + '.' for name, _ in frozen_layers)
+        state_dict = {key: value for key, value in self.state_dict().items() if not key.startswith(prefixes)}
+        for name, layer in frozen_layers:
+            for key, value in layer.inference_state().items():
+                state_dict[name + '.' + key] = value
+        return state_dict
+
+    def load_inference_state_dict(self, state_dict):
+        """
+        Loads the tensors of inference_state_dict into a model with the same architecture, which must have been
+        frozen (or quantized) for inference. The tensors are copied onto the model's device.
+        :param state_dict: dict of tensors, as given by inference_state_dict
+        :return: None
+        """
+        frozen_layers = self.frozen_layers()
+        for name, layer in frozen_layers:
+            prefix = name + '.'
+            layer.load_inference_state({key[len(prefix):]: value for key, value in state_dict.items()
+                                        if key.startswith(prefix)})
+        prefixes = tuple(name + '.' for name, _ in frozen_layers)
+        for key, value in self.state_dict().items():
+            if not key.startswith(prefixes):
+                value.copy_(state_dict[key])
+
     def random_re_init(self, re_init_fraction=0.05):
         """Randomly re-initializes a fraction of all of the weights in the model."""
         for level in self.levels:
@@ -527,6 +957,9 @@ class DenseLatentVariableModel(object):
     def cuda(self, device_id=0):
         """Places the model on the GPU."""
         self._cuda_device = device_id
+        if self.state_arena is not None:
+            self.state_arena.cuda(device_id)
+            self.bind_state_arena()
         for latent_level in self.levels:
             latent_level.cuda(device_id)
         self.output_decoder = self.output_decoder.cuda(device_id)
@@ -535,13 +968,17 @@ class DenseLatentVariableModel(object):
         if self.output_distribution == 'gaussian':
             if self.constant_variances:
                 self.trainable_log_var = Variable(self.trainable_log_var.data.cuda(device_id), requires_grad=True)
-                self.log_var_output = self.trainable_log_var.unsqueeze(0).repeat(self.batch_size, 1)
             else:
                 self.log_var_output = self.log_var_output.cuda(device_id)
 
     def cpu(self):
         """Places the model on the CPU."""
         self._cuda_device = None
+        if self.precision == 'float16':
+            self.set_precision('float32')
+        if self.state_arena is not None:
+            self.state_arena.cpu()
+            self.bind_state_arena()
         for latent_level in self.levels:
             latent_level.cpu()
         self.output_decoder = self.output_decoder.cpu()
@@ -550,6 +987,172 @@ class DenseLatentVariableModel(object):
         if self.output_distribution == 'gaussian':
             if self.constant_variances:
                 self.trainable_log_var = self.trainable_log_var.cpu()
-                self.log_var_output = self.trainable_log_var.unsqueeze(0).repeat(self.batch_size, 1)
             else:
                 self.log_var_output = self.log_var_output.cpu()
+
+
+class ConvLatentVariableModel(DenseLatentVariableModel):
+
+    """
+    Latent variable model with convolutional latent levels and output decoder.
+    Data and outputs stay flattened channels-last (height x width x channels), as given by the data loader;
+    they are permuted to (channels x height x width) maps at the first encoder and the output layers.
+    """
+
+    # input encoding forms of get_input_encoding, each contributing one image
+    input_encoding_forms = ['posterior', 'bottom_error', 'norm_bottom_error', 'log_bottom_error', 'sign_bottom_error',
+                            'bottom_norm_error', 'norm_bottom_norm_error']
+
+    def __init__(self, train_config, arch, data_loader):
+        # height x width x channels
+        self.input_shape = tuple(next(iter(data_loader))[0].size()[1:])
+        assert len(self.input_shape) == 3, 'Convolutional model requires image inputs.'
+        super(ConvLatentVariableModel, self).__init__(train_config, arch, data_loader)
+
+    def __construct__(self, arch):
+        """
+        Construct the model from the architecture dictionary.
+        :param arch: architecture dictionary
+        :return None
+        """
+        assert not self.concat_variables, 'Concatenating variables is not supported by the convolutional model.'
+        assert arch['encoder_type'] == 'inference_model', 'Convolutional model requires an inference model.'
+
+        encoding_form = arch['encoding_form']
+        variable_update_form = arch['variable_update_form']
+        const_prior_var = arch['constant_prior_variances']
+        posterior_form = arch['posterior_form']
+        self.downsample = arch['downsample']
+        n_levels = len(arch['n_latent'])
+
+        # the spatial size of each level, downsampled from the level below
+        height, width = self.input_shape[:2]
+        self.spatial_sizes = []
+        for stride in self.downsample:
+            assert height % stride == 0 and width % stride == 0, 'Downsampling must divide the input size.'
+            height, width = height // stride, width // stride
+            self.spatial_sizes.append((height, width))
+
+        encoder_arch = dict()
+        encoder_arch['filter_size'] = arch['filter_size']
+        encoder_arch['non_linearity'] = arch['non_linearity_enc']
+        encoder_arch['connection_type'] = arch['connection_type_enc']
+        encoder_arch['batch_norm'] = arch['batch_norm_enc']
+        encoder_arch['weight_norm'] = arch['weight_norm_enc']
+        encoder_arch['dropout'] = arch['dropout_enc']
+
+        decoder_arch = dict()
+        decoder_arch['filter_size'] = arch['filter_size']
+        decoder_arch['non_linearity'] = arch['non_linearity_dec']
+        decoder_arch['connection_type'] = arch['connection_type_dec']
+        decoder_arch['batch_norm'] = arch['batch_norm_dec']
+        decoder_arch['weight_norm'] = arch['weight_norm_dec']
+        decoder_arch['dropout'] = arch['dropout_dec']
+
+        # construct a ConvLatentLevel for each level of latent variables
+        for level in range(n_levels):
+            encoder_arch['n_in'] = self.encoder_input_size(level, arch)
+            encoder_arch['n_filters'] = arch['n_units_enc'][level]
+            encoder_arch['n_layers'] = arch['n_layers_enc'][level]
+            encoder_arch['stride'] = self.downsample[level]
+
+            decoder_arch['n_in'] = self.decoder_input_size(level, arch)
+            decoder_arch['n_filters'] = arch['n_units_dec'][level+1]
+            decoder_arch['n_layers'] = arch['n_layers_dec'][level+1]
+            decoder_arch['upsample'] = self.downsample[level+1] if level < n_levels - 1 else 1
+
+            n_latent = arch['n_latent'][level]
+            n_det = [arch['n_det_enc'][level], arch['n_det_dec'][level]]
+
+            learn_prior = True if arch['learn_top_prior'] else (level != n_levels-1)
+
+            self.levels[level] = ConvLatentLevel(encoder_arch, decoder_arch, n_latent, self.spatial_sizes[level], n_det,
+                                                 encoding_form, const_prior_var, variable_update_form, posterior_form,
+                                                 learn_prior)
+
+        # construct the output decoder
+        decoder_arch.pop('upsample')
+        decoder_arch['n_in'] = self.decoder_input_size(-1, arch)
+        decoder_arch['n_filters'] = arch['n_units_dec'][0]
+        decoder_arch['n_layers'] = arch['n_layers_dec'][0]
+        self.output_decoder = MultiLayerConv(**decoder_arch)
+
+        self.construct_output_distribution(arch)
+
+    def encoder_input_size(self, level_num, arch):
+        """
+        Calculates the number of channels of the encoding input to a level.
+        The posterior state encodings are added within the level, see ConvLatentLevel.
+        :param level_num: the index of the level
+        :param arch: architecture dictionary
+        :return: the number of input channels of this level's encoder
+        """
+        if level_num == 0:
+            n_images = len([form for form in self.input_encoding_forms if form in self.encoding_form])
+            return self.input_shape[2] * n_images
+        n_maps = ConvLatentLevel.n_encoding_maps(self.encoding_form, 'out', self.posterior_form)
+        return arch['n_det_enc'][level_num-1] + arch['n_latent'][level_num-1] * n_maps
+
+    def output_layer(self, arch, non_linearity=None):
+        """
+        Creates a layer that maps the output decoder to an output distribution parameter.
+        :param arch: architecture dictionary
+        :param non_linearity: the non-linearity of the layer
+        :return: a Conv layer with one output channel per input channel
+        """
+        return Conv(self.output_decoder.n_out, arch['filter_size'], self.input_shape[2], non_linearity=non_linearity,
+                    weight_norm=arch['weight_norm_dec'])
+
+    def image_to_maps(self, input):
+        """
+        Reshapes flattened channels-last images into maps.
+        :param input: tensor of size (batch_size x (n_images * height * width * n_channels))
+        :return tensor of size (batch_size x (n_images * n_channels) x height x width)
+        """
+        height, width, n_channels = self.input_shape
+        maps = input.view(input.size()[0], -1, height, width, n_channels).permute(0, 1, 4, 2, 3).contiguous()
+        return maps.view(maps.size()[0], -1, height, width)
+
+    def flatten_output(self, output, n_samples):
+        """
+        Reshapes the output maps of an output layer into flattened channels-last images.
+        :param output: tensor of size ((batch_size * n_samples) x n_channels x height x width)
+        :param n_samples: number of samples in the output
+        :return tensor of size (batch_size x n_samples x input_size)
+        """
+        return output.permute(0, 2, 3, 1).contiguous().view(-1, n_samples, self.input_size)
+
+    def encode(self, input):
+        """
+        Encodes the input into an updated posterior estimate.
+        :param input: the data input
+        :return None
+        """
+        if self.state_optimizer is None:
+            if self._cuda_device is not None:
+                input = input.cuda(self._cuda_device)
+            input = self.process_input(input.view(-1, self.input_size))
+
+            h = self.image_to_maps(self.get_input_encoding(input))
+            for level_num, latent_level in enumerate(self.levels):
+                with phase(self.phase_timer, 'encode', level_num):
+                    h = latent_level.encode(h)
+
+    def decode_levels(self, batch_size, n_samples, generate=False):
+        """
+        Decodes from the top latent level down to the input of the output decoder.
+        :param batch_size: the batch size
+        :param n_samples: number of samples to decode
+        :param generate: flag to generate or reconstruct the data
+        :return the input maps to the output decoder, with samples in the batch dimension
+        """
+        height, width = self.spatial_sizes[-1]
+        h = Variable(torch.zeros(batch_size * n_samples, self.top_size, height, width))
+        if self._cuda_device is not None:
+            h = h.cuda(self._cuda_device)
+        for level_num in range(len(self.levels))[::-1]:
+            with phase(self.phase_timer, 'decode', level_num):
+                h = self.levels[level_num].decode(h, n_samples, generate)
+        if self.downsample[0] > 1:
+            h = F.upsample(h, scale_factor=self.downsample[0], mode='nearest')
+        return h
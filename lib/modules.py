@@ -1,8 +1,182 @@
+import numpy as np
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 from torch.nn import init, Parameter
 from torch.autograd import Variable
-from distributions import DiagonalGaussian, PointEstimate
+from distributions import DiagonalGaussian, PointEstimate, match_samples
+
+
+def effective_weight(layer):
+    """
+    Gets the weight tensor actually applied by a linear or convolutional layer, including weight normalization.
+    :param layer: an nn.Linear or nn.Conv2d layer, possibly weight normalized
+    :return: the weight tensor
+    """
+    if hasattr(layer, 'weight_g'):
+        v = layer.weight_v.data
+        norm = v.view(v.size()[0], -1).norm(2, 1, keepdim=True).view(*([-1] + [1] * (v.dim() - 1)))
+        return v * (layer.weight_g.data / norm)
+    return layer.weight.data
+
+
+def fold_batch_norm(weight, bias, bn):
+    """
+    Folds batch normalization running statistics into the preceding weights and bias.
+    :param weight: weight tensor, with output units along the first dimension
+    :param bias: bias tensor
+    :param bn: the batch normalization layer
+    :return: tuple of folded weight and bias tensors
+    """
+    scale = bn.weight.data / torch.sqrt(bn.running_var + bn.eps)
+    weight = weight * scale.view(*([-1] + [1] * (weight.dim() - 1)))
+    bias = (bias - bn.running_mean) * scale + bn.bias.data
+    return weight, bias
+
+
+def round_to_bfloat16(input):
+    """
+    Rounds a float tensor to the nearest bfloat16 value (8 significant bits, ties to even), keeping it in float32.
+    This only emulates bfloat16 numerics, to check convergence (see DenseLatentVariableModel.emulate_bfloat16):
+    torch has no bfloat16 type, so it is slower than float32 and saves no memory. The rounding is done on the
+    input's device without reading the bits, by scaling each value to [128, 256) by its power of two. Zeros,
+    infinities, and NaNs are kept, and values that round past the largest float become infinite. The rounding
+    is skipped in the backward pass (straight-through), so that the float weights receive float gradients.
+    :param input: the input, a Variable
+    :return: the rounded input
+    """
+    data = input.data
+    kept = (data == 0) | (data != data) | (data.abs() == float('inf'))
+    value = data.clone().masked_fill_(kept, 1.).abs()
+    exponent = torch.floor(torch.log(value) / np.log(2.))
+    # the logarithm can be off by one next to powers of two, which the mantissa corrects
+    mantissa = value / torch.pow(2., exponent)
+    exponent += (mantissa >= 2.).type_as(data) - (mantissa < 1.).type_as(data)
+    # subnormals keep the spacing of the smallest normal exponent
+    scale = torch.pow(2., exponent.clamp_(min=-126.) - 7.)
+    scaled = data.clone().masked_fill_(kept, 1.) / scale
+    rounded = torch.round(scaled)
+    # torch.round rounds ties away from zero, round them to even instead
+    tie = ((rounded - scaled).abs() == 0.5).type_as(data)
+    rounded = (rounded + tie * (2. * torch.round(scaled / 2.) - rounded)) * scale
+    rounded = rounded.masked_fill_(kept, 0.) + data.clone().masked_fill_(1 - kept, 0.)
+    return input + Variable(rounded - data)
+
+
+def precision_operands(input, weight, bias, precision):
+    """
+    Gets the operands of a matmul or convolution in a reduced precision. In half precision, the input, weight,
+    and bias are cast to half. In bfloat16 (numerics emulation only, see round_to_bfloat16), the input and
+    weight are rounded to bfloat16 in float32, and the bias and accumulation stay in float32.
+    :param input: the input
+    :param weight: the weight
+    :param bias: the bias, or None
+    :param precision: 'float32', 'float16', or 'bfloat16'
+    :return: (input, weight, bias)
+    """
+    if precision == 'float16':
+        return input.half(), weight.half(), bias.half() if bias is not None else None
+    if precision == 'bfloat16':
+        return round_to_bfloat16(input), round_to_bfloat16(weight), bias
+    return input, weight, bias
+
+
+def linear(input, weight, bias=None, precision='float32'):
+    """
+    Applies a linear map, optionally computing the matmul in a reduced precision, see precision_operands.
+    In half precision, the output is cast back to float, so that the (float) weights receive float gradients.
+    :param input: the input
+    :param weight: the weight matrix
+    :param bias: the bias, or None
+    :param precision: 'float32', 'float16', or 'bfloat16'
+    :return: the output
+    """
+    output = F.linear(*precision_operands(input, weight, bias, precision))
+    return output.float() if precision == 'float16' else output
+
+
+def conv2d(input, weight, bias, stride, padding, precision='float32'):
+    """
+    Applies a convolution, optionally in a reduced precision, see linear.
+    :param input: the input
+    :param weight: the filters
+    :param bias: the bias, or None
+    :param stride: the stride
+    :param padding: the padding
+    :param precision: 'float32', 'float16', or 'bfloat16'
+    :return: the output
+    """
+    input, weight, bias = precision_operands(input, weight, bias, precision)
+    output = F.conv2d(input, weight, bias, stride=stride, padding=padding)
+    return output.float() if precision == 'float16' else output
+
+
+def precision_layers(precision, *modules):
+    """
+    Sets the precision of the matmuls and convolutions of all Dense and Conv layers within the modules.
+    :param precision: 'float32', 'float16', or 'bfloat16'
+    :param modules: modules to search for Dense and Conv layers (None entries are skipped)
+    :return: None
+    """
+    for module in modules:
+        if module is None:
+            continue
+        for layer in module.modules():
+            if isinstance(layer, (Dense, Conv)):
+                layer.set_precision(precision)
+
+
+def activation_scale(*inputs):
+    """
+    Gets the symmetric int8 scale of the inputs from their largest magnitude (dynamic quantization), so that
+    the blocks of a concatenated input share a single scale.
+    :param inputs: the inputs
+    :return: the scale
+    """
+    largest = torch.stack([input.abs().max() for input in inputs]).max()
+    return largest.clamp(min=1e-8) / 127.
+
+
+def quantize_activations(input, scale=None):
+    """
+    Rounds the input to int8 levels, using a symmetric scale from its largest magnitude (dynamic quantization).
+    The rounding is skipped in the backward pass (straight-through), so that state gradients still flow.
+    :param input: the input
+    :param scale: the scale, see activation_scale, by default that of the input
+    :return: the quantized input, in float
+    """
+    if scale is None:
+        scale = activation_scale(input)
+    quantized = torch.round(input / scale) * scale
+    return input + (quantized - input).detach()
+
+
+def quantize_layers(*modules):
+    """
+    Quantizes all Dense layers within the modules to int8 for inference, see Dense.quantize.
+    :param modules: modules to search for Dense layers (None entries are skipped)
+    :return: None
+    """
+    for module in modules:
+        if module is None:
+            continue
+        for layer in module.modules():
+            if isinstance(layer, Dense):
+                layer.quantize()
+
+
+def freeze_layers(*modules):
+    """
+    Freezes all Dense and Conv layers within the modules for inference.
+    :param modules: modules to search for Dense and Conv layers (None entries are skipped)
+    :return: None
+    """
+    for module in modules:
+        if module is None:
+            continue
+        for layer in module.modules():
+            if isinstance(layer, (Dense, Conv)):
+                layer.freeze()
 
 
 class Dense(nn.Module):
@@ -65,11 +239,100 @@ class Dense(nn.Module):
 
         init.constant(self.linear.bias, 0.)
 
+    # folded (weight, bias) used in place of linear + batch norm after freeze()
+    _frozen_params = None
+
+    # precision of the matmul, see set_precision()
+    _precision = 'float32'
+
+    # (int8 weight, per unit scale) after quantize()
+    _quantized_weight = None
+
     def random_re_init(self, re_init_fraction):
         pass
 
-    def forward(self, input):
-        output = self.linear(input)
+    def set_precision(self, precision):
+        """
+        Computes the matmul in 'float16' from the float weights, which are cast on the fly, in 'float32', or in
+        float32 on inputs and weights rounded to 'bfloat16' (numerics emulation only, see round_to_bfloat16).
+        Batch norm, the non-linearity, and dropout are applied in float. Weight normalized layers stay in float.
+        """
+        self._precision = precision
+
+    def freeze(self):
+        """Folds the batch norm running statistics into the linear weights and drops batch norm and dropout."""
+        weight, bias = fold_batch_norm(effective_weight(self.linear), self.linear.bias.data, self.bn) if self.bn \
+            else (effective_weight(self.linear).clone(), self.linear.bias.data.clone())
+        self._frozen_params = (Variable(weight), Variable(bias))
+
+    def unfreeze(self):
+        """Reverts freeze() and quantize(), using the linear layer, batch norm, and dropout again."""
+        self._frozen_params = None
+        self._quantized_weight = None
+
+    def quantize(self):
+        """
+        Freezes the layer, then quantizes the frozen weights to int8 with a symmetric scale per output unit.
+        The input is quantized to int8 on each forward pass with a scale from the input (dynamic quantization).
+        The matmul itself is computed in float on the dequantized values.
+        """
+        if self._frozen_params is None:
+            self.freeze()
+        weight, bias = self._frozen_params
+        scale = weight.data.abs().max(1, keepdim=True)[0].clamp(min=1e-8) / 127.
+        self._quantized_weight = (torch.round(weight.data / scale).char(), scale)
+        self._frozen_params = (Variable(self._quantized_weight[0].float() * scale), bias)
+
+    def inference_state(self):
+        """
+        Gets the tensors applied by the layer after freeze() or quantize(): the folded weight and bias, or the
+        int8 weight, its scale, and the folded bias.
+        :return: dict of tensors
+        """
+        weight, bias = self._frozen_params
+        if self._quantized_weight is not None:
+            return {'quantized_weight': self._quantized_weight[0], 'weight_scale': self._quantized_weight[1],
+                    'bias': bias.data}
+        return {'weight': weight.data, 'bias': bias.data}
+
+    def load_inference_state(self, state):
+        """
+        Uses the tensors of inference_state in place of the linear layer, batch norm, and dropout.
+        The tensors are copied onto the layer's device.
+        :param state: dict of tensors, as given by inference_state
+        :return: None
+        """
+        device = self.linear.bias.data
+        bias = state['bias'].type_as(device)
+        if 'quantized_weight' in state:
+            quantized_weight = state['quantized_weight'].cuda(device.get_device()) if device.is_cuda \
+                else state['quantized_weight'].cpu()
+            scale = state['weight_scale'].type_as(device)
+            self._quantized_weight = (quantized_weight, scale)
+            self._frozen_params = (Variable(quantized_weight.float() * scale), Variable(bias))
+        else:
+            self._quantized_weight = None
+            self._frozen_params = (Variable(state['weight'].type_as(device)), Variable(bias))
+
+    def train(self, mode=True):
+        if mode:
+            self.unfreeze()
+        return super(Dense, self).train(mode)
+
+    def fusable(self):
+        """Whether the linear weights can be stacked with other layers' weights (not weight normalized)."""
+        return self._frozen_params is not None or not hasattr(self.linear, 'weight_g')
+
+    def linear_params(self):
+        """Gets the weight and bias of the linear map applied by this layer."""
+        if self._frozen_params is not None:
+            return self._frozen_params
+        return self.linear.weight, self.linear.bias
+
+    def post_linear(self, output):
+        """Applies batch normalization, non-linearity, and dropout to the output of the linear layer."""
+        if self._frozen_params is not None:
+            return self.non_linearity(output) if self.non_linearity else output
         if self.bn:
             output = self.bn(output)
         if self.non_linearity:
@@ -78,22 +341,87 @@ class Dense(nn.Module):
             output = self.dropout(output)
         return output
 
+    def forward(self, input):
+        if self._frozen_params is not None or (self._precision != 'float32' and self.fusable()):
+            weight, bias = self.linear_params()
+            if self._quantized_weight is not None:
+                input = quantize_activations(input)
+            return self.post_linear(linear(input, weight, bias, self._precision))
+        return self.post_linear(self.linear(input))
+
+    def forward_blocks(self, inputs):
+        """
+        Applies the layer to the concatenation of a list of inputs without forming the concatenation.
+        Each input block is multiplied by the matching columns of the weight matrix and accumulated,
+        so the blocks are read in place and only the (shared) blocks are saved for the backward pass.
+        :param inputs: list of inputs, whose concatenation along dim 1 is the layer input
+        :return: the layer output
+        """
+        if not self.fusable():
+            return self.forward(torch.cat(inputs, dim=1))
+        layer_weight, layer_bias = self.linear_params()
+        if self._quantized_weight is not None:
+            scale = activation_scale(*inputs)
+        output = None
+        start = 0
+        for input in inputs:
+            n_in = input.size()[1]
+            weight = layer_weight.narrow(1, start, n_in)
+            if self._quantized_weight is not None:
+                input = quantize_activations(input, scale)
+            input, weight, bias = precision_operands(input, weight, layer_bias, self._precision)
+            if output is None:
+                output = F.linear(input, weight, bias)
+            else:
+                output = torch.addmm(output, input, weight.t())
+            start += n_in
+        if self._precision == 'float16':
+            output = output.float()
+        return self.post_linear(output)
+
+
+def fused_dense(layers, input):
+    """
+    Applies several Dense layers to the same input using a single matrix multiply.
+    The layers' weights are stacked along the output dimension, the result is
+    split, and each layer's batch norm, non-linearity, and dropout are applied.
+    :param layers: list of Dense layers sharing the same input size
+    :param input: the input to the layers
+    :return: list of outputs, one per layer
+    """
+    if not all([layer.fusable() for layer in layers]):
+        return [layer(input) for layer in layers]
+    params = [layer.linear_params() for layer in layers]
+    weight = torch.cat([weight for weight, _ in params], 0)
+    bias = torch.cat([bias for _, bias in params], 0)
+    if any([layer._quantized_weight is not None for layer in layers]):
+        input = quantize_activations(input)
+    precisions = set([layer._precision for layer in layers])
+    output = linear(input, weight, bias, precisions.pop() if len(precisions) == 1 else 'float32')
+    outputs = []
+    start = 0
+    for layer in layers:
+        n_out = layer.linear.out_features
+        outputs.append(layer.post_linear(output.narrow(1, start, n_out)))
+        start += n_out
+    return outputs
+
 
 class Conv(nn.Module):
 
     """Basic convolutional layer with optional batch normalization, non-linearity, weight normalization and dropout."""
 
-    def __init__(self, n_in, filter_size, n_out, non_linearity=None, batch_norm=False, weight_norm=False, dropout=0., initialize='glorot_uniform'):
+    def __init__(self, n_in, filter_size, n_out, non_linearity=None, batch_norm=False, weight_norm=False, dropout=0., initialize='glorot_uniform', stride=1):
         super(Conv, self).__init__()
 
-        self.conv = nn.Conv2d(n_in, n_out, filter_size, padding=int(np.ceil(filter_size/2)))
+        self.conv = nn.Conv2d(n_in, n_out, filter_size, stride=stride, padding=int(np.ceil(filter_size/2)))
         self.bn = None
         if batch_norm:
             self.bn = nn.BatchNorm2d(n_out)
         if weight_norm:
             self.conv = nn.utils.weight_norm(self.conv, name='weight')
 
-        if non_linearity is None:
+        if non_linearity is None or non_linearity == 'linear':
             self.non_linearity = None
         elif non_linearity == 'relu':
             self.non_linearity = nn.ReLU()
@@ -108,6 +436,7 @@ class Conv(nn.Module):
         else:
             raise Exception('Non-linearity ' + str(non_linearity) + ' not found.')
 
+        self.dropout = None
         if dropout > 0.:
             self.dropout = nn.Dropout2d(dropout)
 
@@ -134,8 +463,59 @@ class Conv(nn.Module):
 
         init.constant(self.conv.bias, 0.)
 
-    def forward(self, input):
-        output = self.conv(input)
+    # folded (weight, bias) used in place of conv + batch norm after freeze()
+    _frozen_params = None
+
+    # precision of the convolution, see set_precision()
+    _precision = 'float32'
+
+    def set_precision(self, precision):
+        """
+        Computes the convolution in 'float16' from the float filters, which are cast on the fly, in 'float32',
+        or on rounded 'bfloat16' inputs and filters (numerics emulation only, see round_to_bfloat16). Weight
+        normalized layers stay in float, see Dense.set_precision.
+        """
+        self._precision = precision
+
+    def freeze(self):
+        """Folds the batch norm running statistics into the convolution weights and drops batch norm and dropout."""
+        weight, bias = fold_batch_norm(effective_weight(self.conv), self.conv.bias.data, self.bn) if self.bn \
+            else (effective_weight(self.conv).clone(), self.conv.bias.data.clone())
+        self._frozen_params = (Variable(weight), Variable(bias))
+
+    def unfreeze(self):
+        """Reverts freeze(), using the convolution, batch norm, and dropout again."""
+        self._frozen_params = None
+
+    def inference_state(self):
+        """Gets the folded weight and bias applied by the layer after freeze(), see Dense.inference_state."""
+        weight, bias = self._frozen_params
+        return {'weight': weight.data, 'bias': bias.data}
+
+    def load_inference_state(self, state):
+        """Uses the tensors of inference_state in place of the convolution, batch norm, and dropout."""
+        device = self.conv.bias.data
+        self._frozen_params = (Variable(state['weight'].type_as(device)), Variable(state['bias'].type_as(device)))
+
+    def train(self, mode=True):
+        if mode:
+            self.unfreeze()
+        return super(Conv, self).train(mode)
+
+    def fusable(self):
+        """Whether the convolution weights can be sliced or stacked (not weight normalized)."""
+        return self._frozen_params is not None or not hasattr(self.conv, 'weight_g')
+
+    def conv_params(self):
+        """Gets the weight and bias of the convolution applied by this layer."""
+        if self._frozen_params is not None:
+            return self._frozen_params
+        return self.conv.weight, self.conv.bias
+
+    def post_conv(self, output):
+        """Applies batch normalization, non-linearity, and dropout to the output of the convolution."""
+        if self._frozen_params is not None:
+            return self.non_linearity(output) if self.non_linearity else output
         if self.bn:
             output = self.bn(output)
         if self.non_linearity:
@@ -144,6 +524,58 @@ class Conv(nn.Module):
             output = self.dropout(output)
         return output
 
+    def forward(self, input):
+        if self._frozen_params is not None or (self._precision != 'float32' and self.fusable()):
+            weight, bias = self.conv_params()
+            return self.post_conv(conv2d(input, weight, bias, self.conv.stride, self.conv.padding, self._precision))
+        return self.post_conv(self.conv(input))
+
+    def forward_blocks(self, inputs):
+        """
+        Applies the convolution to the channel-wise concatenation of a list of inputs without forming the concatenation.
+        :param inputs: list of inputs, whose concatenation along dim 1 (channels) is the layer input
+        :return: the layer output
+        """
+        if not self.fusable():
+            return self.forward(torch.cat(inputs, dim=1))
+        layer_weight, layer_bias = self.conv_params()
+        output = None
+        start = 0
+        for input in inputs:
+            n_in = input.size()[1]
+            weight = layer_weight.narrow(1, start, n_in)
+            bias = layer_bias if output is None else None
+            block_output = conv2d(input, weight, bias, self.conv.stride, self.conv.padding, self._precision)
+            output = block_output if output is None else output + block_output
+            start += n_in
+        return self.post_conv(output)
+
+
+def fused_conv(layers, input):
+    """
+    Applies several Conv layers to the same input using a single convolution.
+    The layers' filters are stacked along the output channels, the result is
+    split, and each layer's batch norm, non-linearity, and dropout are applied.
+    :param layers: list of Conv layers sharing the same input channels, filter size, and stride
+    :param input: the input to the layers
+    :return: list of outputs, one per layer
+    """
+    if not all([layer.fusable() for layer in layers]):
+        return [layer(input) for layer in layers]
+    params = [layer.conv_params() for layer in layers]
+    weight = torch.cat([weight for weight, _ in params], 0)
+    bias = torch.cat([bias for _, bias in params], 0)
+    conv = layers[0].conv
+    precisions = set([layer._precision for layer in layers])
+    output = conv2d(input, weight, bias, conv.stride, conv.padding, precisions.pop() if len(precisions) == 1 else 'float32')
+    outputs = []
+    start = 0
+    for layer in layers:
+        n_out = layer.conv.out_channels
+        outputs.append(layer.post_conv(output.narrow(1, start, n_out)))
+        start += n_out
+    return outputs
+
 
 class Recurrent(nn.Module):
 
@@ -225,7 +657,9 @@ class MultiLayerPerceptron(nn.Module):
 
     def forward(self, input):
 
-        input_orig = input.clone()
+        # for concat connections, the features are kept as a list of blocks that
+        # each layer reads in place; they are only concatenated once at the output
+        features = [input]
 
         for layer_num, layer in enumerate(self.layers):
             if self.connection_type == 'sequential':
@@ -236,16 +670,20 @@ class MultiLayerPerceptron(nn.Module):
                 else:
                     input = input + layer(input)
             elif self.connection_type == 'highway':
-                gate = self.gates[layer_num]
+                # gate, transform (and initial carry projection) share one matmul
                 if layer_num == 0:
-                    input = gate(input) * self.initial_dense(input) + (1 - gate(input)) * layer(input)
+                    gate, transform, carry = fused_dense([self.gates[layer_num], layer, self.initial_dense], input)
                 else:
-                    input = gate(input) * input + (1 - gate(input)) * layer(input)
+                    gate, transform = fused_dense([self.gates[layer_num], layer], input)
+                    carry = input
+                input = gate * carry + (1 - gate) * transform
             elif self.connection_type == 'concat_input':
-                input = torch.cat((input_orig, layer(input)), dim=1)
+                features = [features[0], layer.forward_blocks(features)]
             elif self.connection_type == 'concat':
-                input = torch.cat((input, layer(input)), dim=1)
+                features.append(layer.forward_blocks(features))
 
+        if self.connection_type in ['concat_input', 'concat']:
+            return torch.cat(features, dim=1)
         return input
 
 
@@ -265,8 +703,10 @@ class MultiLayerConv(nn.Module):
         if self.connection_type in ['residual', 'highway']:
             self.initial_conv = Conv(n_in, filter_size, n_filters, batch_norm=batch_norm, weight_norm=weight_norm)
 
+        output_size = n_in
+
         for _ in range(n_layers):
-            layer = Conv(n_in, n_units, non_linearity=non_linearity, batch_norm=batch_norm, weight_norm=weight_norm, dropout=dropout)
+            layer = Conv(n_in, filter_size, n_filters, non_linearity=non_linearity, batch_norm=batch_norm, weight_norm=weight_norm, dropout=dropout)
             self.layers.append(layer)
 
             if self.connection_type == 'highway':
@@ -280,9 +720,15 @@ class MultiLayerConv(nn.Module):
             elif self.connection_type == 'concat':
                 n_in += n_filters
 
+            output_size = n_in
+
+        self.n_out = output_size
+
     def forward(self, input):
 
-        input_orig = input.clone()
+        # for concat connections, the feature maps are kept as a list of blocks that
+        # each layer reads in place; they are only concatenated once at the output
+        features = [input]
 
         for layer_num, layer in enumerate(self.layers):
             if self.connection_type == 'sequential':
@@ -295,72 +741,138 @@ class MultiLayerConv(nn.Module):
                     input = input + layer(input)
 
             elif self.connection_type == 'highway':
-                gate = self.gates[layer_num]
+                # gate, transform (and initial carry projection) share one convolution
                 if layer_num == 0:
-                    input = gate * self.initial_conv(input) + (1 - gate) * layer(input)
+                    gate, transform, carry = fused_conv([self.gates[layer_num], layer, self.initial_conv], input)
                 else:
-                    input = gate * input + (1 - gate) * layer(input)
+                    gate, transform = fused_conv([self.gates[layer_num], layer], input)
+                    carry = input
+                input = gate * carry + (1 - gate) * transform
 
             elif self.connection_type == 'concat_input':
-                input = torch.cat((input_orig, layer(input)), dim=1)
+                features = [features[0], layer.forward_blocks(features)]
 
             elif self.connection_type == 'concat':
-                input = torch.cat((input, layer(input)), dim=1)
+                features.append(layer.forward_blocks(features))
 
+        if self.connection_type in ['concat_input', 'concat']:
+            return torch.cat(features, dim=1)
         return input
 
 
 class MultiLayerRecurrent(nn.Module):
 
+    """
+    Multi-layer LSTM, stepped once per call, that keeps its state across calls until reset.
+    The hidden-to-hidden weights of all layers are packed and applied with one batched matrix multiply.
+    Each layer's input weights are packed with its highway gate and input map weights, so that each
+    layer reads its input with one matrix multiply.
+    """
+
     def __init__(self, n_in, n_layers, n_units, connection_type='sequential', **kwargs):
         super(MultiLayerRecurrent, self).__init__()
+        assert connection_type in ['sequential', 'residual', 'highway', 'concat_input', 'concat'], 'Connection type not found.'
+        assert n_layers > 0, 'Recurrent network requires at least one layer.'
         self.n_layers = n_layers
+        self.n_units = n_units
         self.connection_type = connection_type
-        self.layers = nn.ModuleList([])
-        self.layers.append(Recurrent(n_in, n_units))
-        for _ in range(1, self.n_layers):
-            self.layers.append(Recurrent(n_units, n_units))
-        if connection_type == 'residual':
-            self.input_map = Dense(n_in, n_units)
-        if connection_type == 'highway':
-            self.gates = nn.ModuleList([])
-            self.input_map = Dense(n_in, n_units)
-            self.gates.append(Dense(n_in, n_units, non_linearity='sigmoid'))
-            for _ in range(1, self.n_layers):
-                self.gates.append(Dense(n_units, n_units, non_linearity='sigmoid'))
+
+        # per layer input weights, rows ordered as LSTM gates (input, forget, cell, output), highway gate, input map
+        self.weight_ih = nn.ParameterList([])
+        self.bias_ih = nn.ParameterList([])
+        n_in_orig = n_in
+        for layer_num in range(n_layers):
+            n_out = 4 * n_units
+            if self.connection_type == 'highway':
+                n_out += n_units
+            if layer_num == 0 and self.connection_type in ['residual', 'highway']:
+                n_out += n_units
+            self.weight_ih.append(Parameter(torch.Tensor(n_out, n_in)))
+            self.bias_ih.append(Parameter(torch.Tensor(n_out)))
+
+            if self.connection_type in ['sequential', 'residual', 'highway']:
+                n_in = n_units
+            elif self.connection_type == 'concat_input':
+                n_in = n_units + n_in_orig
+            elif self.connection_type == 'concat':
+                n_in += n_units
+
+        self.n_out = n_in
+
+        # hidden-to-hidden weights of all layers, (n_layers x n_units x 4 * n_units)
+        self.weight_hh = Parameter(torch.Tensor(n_layers, n_units, 4 * n_units))
+        self.initial_hidden = Parameter(torch.zeros(n_layers, 1, n_units))
+        self.initial_cell = Parameter(torch.zeros(n_layers, 1, n_units))
+        self.reset_parameters()
+
+        self.hidden_state = None
+        self.cell_state = None
+
+    def reset_parameters(self):
+        # same initialization as nn.LSTMCell
+        std = 1. / np.sqrt(self.n_units)
+        for param in list(self.weight_ih) + list(self.bias_ih) + [self.weight_hh]:
+            param.data.uniform_(-std, std)
 
     def forward(self, input):
-        input_orig = input.clone()
-        for layer_num, layer in enumerate(self.layers):
-            layer_output = layer(input)
+        n_units = self.n_units
+        if self.hidden_state is None:
+            # the initial state is shared across the batch, so its recurrent
+            # contribution is computed once and broadcast rather than repeated
+            batch_size = input.size()[0]
+            recurrent = torch.bmm(self.initial_hidden, self.weight_hh).expand(self.n_layers, batch_size, 4 * n_units)
+            cell_state = self.initial_cell.expand(self.n_layers, batch_size, n_units)
+        else:
+            recurrent = torch.bmm(self.hidden_state, self.weight_hh)
+            cell_state = self.cell_state
+
+        input_orig = input
+        hidden, cell = [], []
+        for layer_num in range(self.n_layers):
+            projection = F.linear(input, self.weight_ih[layer_num], self.bias_ih[layer_num])
+            gates = projection.narrow(1, 0, 4 * n_units) + recurrent[layer_num]
+            in_gate, forget_gate, cell_gate, out_gate = gates.chunk(4, 1)
+            layer_cell = F.sigmoid(forget_gate) * cell_state[layer_num] + F.sigmoid(in_gate) * F.tanh(cell_gate)
+            layer_output = F.sigmoid(out_gate) * F.tanh(layer_cell)
+            hidden.append(layer_output)
+            cell.append(layer_cell)
+
             if self.connection_type == 'sequential':
                 input = layer_output
             elif self.connection_type == 'residual':
-                if layer_num == 0:
-                    input = self.input_map(input) + layer_output
-                else:
-                    input = input + layer_output
+                carry = projection.narrow(1, 4 * n_units, n_units) if layer_num == 0 else input
+                input = carry + layer_output
             elif self.connection_type == 'highway':
-                gate = self.gates[layer_num](input)
-                if layer_num == 0:
-                    input = self.input_map(input)
-                input = gate * input + (1. - gate) * layer_output
+                gate = F.sigmoid(projection.narrow(1, 4 * n_units, n_units))
+                carry = projection.narrow(1, 5 * n_units, n_units) if layer_num == 0 else input
+                input = gate * carry + (1. - gate) * layer_output
             elif self.connection_type == 'concat':
                 input = torch.cat((input, layer_output), dim=1)
             elif self.connection_type == 'concat_input':
                 input = torch.cat((input_orig, layer_output), dim=1)
+
+        self.hidden_state = torch.stack(hidden)
+        self.cell_state = torch.stack(cell)
         return input
 
     def reset(self):
-        for layer in self.layers:
-            layer.reset()
+        self.hidden_state = None
+        self.cell_state = None
 
 
 class DenseGaussianVariable(object):
 
-    def __init__(self, batch_size, n_variables, const_prior_var, n_input, update_form, posterior_form='gaussian', learn_prior=True):
+    # preallocated (state, gradient) buffers for the approximate posterior parameters, see set_state_buffers
+    _state_buffers = None
+
+    # the PosteriorStateArena holding the buffers, if any, see write_state
+    _state_arena = None
+
+    # handles of the hooks copying the mean and log variance gradients into the gradient buffers
+    _grad_hooks = None
+
+    def __init__(self, n_variables, const_prior_var, n_input, update_form, posterior_form='gaussian', learn_prior=True):
 
-        self.batch_size = batch_size
         self.n_variables = n_variables
         assert update_form in ['direct', 'highway'], 'Latent variable update form not found.'
         self.update_form = update_form
@@ -368,60 +880,107 @@ class DenseGaussianVariable(object):
         self.learn_prior = learn_prior
 
         if self.learn_prior:
-            self.prior_mean = Dense(n_input[1], self.n_variables)
+            self.prior_mean = self.head(n_input[1])
             self.prior_log_var = None
             if not const_prior_var:
-                self.prior_log_var = Dense(n_input[1], self.n_variables)
-        self.posterior_mean = Dense(n_input[0], self.n_variables)
+                self.prior_log_var = self.head(n_input[1])
+        self.posterior_mean = self.head(n_input[0])
         if self.posterior_form == 'gaussian':
-            self.posterior_log_var = Dense(n_input[0], self.n_variables)
+            self.posterior_log_var = self.head(n_input[0])
 
         if self.update_form == 'highway':
-            self.posterior_mean_gate = Dense(n_input[0], self.n_variables, 'sigmoid')
+            self.posterior_mean_gate = self.head(n_input[0], 'sigmoid')
             if self.posterior_form == 'gaussian':
-                self.posterior_log_var_gate = Dense(n_input[0], self.n_variables, 'sigmoid')
+                self.posterior_log_var_gate = self.head(n_input[0], 'sigmoid')
 
         self.posterior = self.init_dist(self.posterior_form)
         self.prior = self.init_dist()
         if self.learn_prior and const_prior_var:
             self.prior.log_var_trainable()
 
+    def head(self, n_in, non_linearity=None):
+        """
+        Creates a layer that outputs one of the distribution parameters (or update gates).
+        :param n_in: the input size of the layer
+        :param non_linearity: the non-linearity of the layer
+        :return: a Dense layer with n_variables outputs
+        """
+        return Dense(n_in, self.n_variables, non_linearity)
+
+    def apply_heads(self, heads, input):
+        """
+        Applies several heads to the same input.
+        :param heads: list of layers, as given by posterior_heads or prior_heads
+        :param input: the input to the heads
+        :return: list of outputs of size (batch_size x n_variables), one per head
+        """
+        return fused_dense(heads, input)
+
     def init_dist(self, form='gaussian'):
         """
-        Initializes a distribution.
+        Initializes a distribution, with a singleton batch dimension that broadcasts to any batch size.
         :param form: the form of the distribution, either Gaussian or point estimate (Dirac delta).
         :return: the initialized distribution
         """
         if form == 'gaussian':
-            return DiagonalGaussian(self.n_variables, Variable(torch.zeros(self.batch_size, self.n_variables)),
-                                    Variable(torch.zeros(self.batch_size, self.n_variables)))
+            return DiagonalGaussian(self.n_variables, Variable(torch.zeros(1, self.n_variables)),
+                                    Variable(torch.zeros(1, self.n_variables)))
         elif form == 'point_estimate':
-            return PointEstimate(Variable(torch.zeros(self.batch_size, self.n_variables)))
+            return PointEstimate(Variable(torch.zeros(1, self.n_variables)))
         else:
             raise Exception('Distribution form not found.')
 
+    def posterior_heads(self):
+        """
+        Gets the layers that output the approximate posterior parameters (and update gates).
+        :return: list of Dense layers, in the order mean, log variance, mean gate, log variance gate
+        """
+        heads = [self.posterior_mean]
+        if self.posterior_form == 'gaussian':
+            heads.append(self.posterior_log_var)
+        if self.update_form == 'highway':
+            heads.append(self.posterior_mean_gate)
+            if self.posterior_form == 'gaussian':
+                heads.append(self.posterior_log_var_gate)
+        return heads
+
+    def prior_heads(self):
+        """
+        Gets the layers that output the prior parameters.
+        :return: list of Dense layers, in the order mean, log variance
+        """
+        heads = [self.prior_mean]
+        if self.prior_log_var is not None:
+            heads.append(self.prior_log_var)
+        return heads
+
     def encode(self, input):
         """
         Encode the input into an estimate of / update to the approximate posterior parameters.
         :param input: the input to the variable
         :return: tensor of approximate posterior samples of size (batch_size x 1 x n_variables)
         """
-        # encode the mean and log variance, update, return sample
-        mean = self.posterior_mean(input)
+        # encode the mean and log variance (and gates) with a single matmul, update, return sample
+        heads = self.apply_heads(self.posterior_heads(), input)
+        mean = heads.pop(0)
         if self.posterior_form == 'gaussian':
-            log_var = torch.clamp(self.posterior_log_var(input), -15., 15.)
+            log_var = torch.clamp(heads.pop(0), -15., 15.)
         if self.update_form == 'highway':
-            mean_gate = self.posterior_mean_gate(input)
+            mean_gate = heads.pop(0)
             if self.posterior_form == 'gaussian':
-                log_var_gate = self.posterior_log_var_gate(input)
-            mean = mean_gate * self.posterior.mean.detach() + (1 - mean_gate) * mean
+                log_var_gate = heads.pop(0)
+            previous_mean = self.posterior.mean.detach()
+            mean = mean_gate * previous_mean + (1 - mean_gate) * mean
             if self.posterior_form == 'gaussian':
-                log_var = torch.clamp(log_var_gate * self.posterior.log_var.detach() + (1 - log_var_gate) * log_var, -15., 15.)
+                previous_log_var = self.posterior.log_var.detach()
+                log_var = torch.clamp(log_var_gate * previous_log_var + (1 - log_var_gate) * log_var, -15., 15.)
+        self.release_state_grad(0)
         self.posterior.mean = mean
-        self.posterior.mean.retain_grad()
+        self.retain_state_grad(self.posterior.mean, 0)
         if self.posterior_form == 'gaussian':
+            self.release_state_grad(1)
             self.posterior.log_var = log_var
-            self.posterior.log_var.retain_grad()
+            self.retain_state_grad(self.posterior.log_var, 1)
         return self.posterior.sample(resample=True)
 
     def decode(self, input, n_samples, generate=False):
@@ -434,20 +993,31 @@ class DenseGaussianVariable(object):
         """
         if self.learn_prior:
             # reshape samples into batch dimension
-            batch_size = input.size()[0]
-            sample_size = input.size()[1]
-            data_size = input.size()[2]
-            input = input.view(-1, data_size)
-            mean = self.prior_mean(input).view(batch_size, sample_size, -1)
-            self.prior.mean = mean
-            if self.prior_log_var is not None:
-                log_var = self.prior_log_var(input).view(batch_size, sample_size, -1)
-                self.prior.log_var = log_var
-        if generate:
-            sample = self.prior.sample(n_samples=n_samples, resample=True)
-        else:
-            sample = self.posterior.sample(n_samples=n_samples, resample=True)
-        return sample
+            self.set_prior(input.view(-1, input.size()[2]), n_samples)
+        return self.draw_samples(input.size()[0], n_samples, generate)
+
+    def draw_samples(self, batch_size, n_samples, generate=False):
+        """
+        Draws samples from the prior or the approximate posterior. A prior that is not learned
+        has no batch dimension, so its samples are drawn at the batch size of the input from above.
+        :param batch_size: the batch size of the input from above
+        :param n_samples: number of samples to draw
+        :param generate: whether to sample from the prior or the approximate posterior
+        :return: tensor of samples of size (batch_size x n_samples x n_variables)
+        """
+        dist = self.prior if generate else self.posterior
+        return dist.sample(n_samples=n_samples, resample=True, batch_size=batch_size)
+
+    def set_prior(self, input, n_samples):
+        """
+        Computes the prior parameters from the input from above.
+        :param input: the input from above, with samples in the batch dimension
+        :param n_samples: number of samples in the input
+        """
+        heads = self.apply_heads(self.prior_heads(), input)
+        self.prior.mean = heads[0].contiguous().view(-1, n_samples, self.n_variables)
+        if self.prior_log_var is not None:
+            self.prior.log_var = heads[1].contiguous().view(-1, n_samples, self.n_variables)
 
     def error(self, averaged=True):
         """
@@ -455,15 +1025,11 @@ class DenseGaussianVariable(object):
         :param averaged: whether to average over samples
         :return: the error
         """
-        sample = self.posterior.sample()
-        n_samples = sample.size()[1]
-        prior_mean = self.prior.mean.detach()
-        if len(prior_mean.data.shape) == 2:
-            prior_mean = prior_mean.unsqueeze(1).repeat(1, n_samples, 1)
+        error = self.posterior.sample() - match_samples(self.prior.mean.detach())
         if averaged:
-            return (sample - prior_mean).mean(dim=1)
+            return error.mean(dim=1)
         else:
-            return sample - prior_mean
+            return error
 
     def norm_error(self, averaged=True):
         """
@@ -471,15 +1037,9 @@ class DenseGaussianVariable(object):
         :param averaged: whether to average over samples
         :return: the normalized error
         """
-        sample = self.posterior.sample()
-        n_samples = sample.size()[1]
-        prior_mean = self.prior.mean.detach()
-        if len(prior_mean.data.shape) == 2:
-            prior_mean = prior_mean.unsqueeze(1).repeat(1, n_samples, 1)
-        prior_log_var = self.prior.log_var.detach()
-        if len(prior_log_var.data.shape) == 2:
-            prior_log_var = prior_log_var.unsqueeze(1).repeat(1, n_samples, 1)
-        n_error = (sample - prior_mean) / torch.exp(prior_log_var + 1e-7)
+        prior_mean = match_samples(self.prior.mean.detach())
+        prior_log_var = match_samples(self.prior.log_var.detach())
+        n_error = (self.posterior.sample() - prior_mean) / torch.exp(prior_log_var + 1e-7)
         if averaged:
             n_error = n_error.mean(dim=1)
         return n_error
@@ -494,44 +1054,168 @@ class DenseGaussianVariable(object):
 
     def analytical_kl(self):
         """
-        Calculates the analytical KL divergence between two Gaussian distributions.
-        WARNING: currently assumes a standard Normal for the prior
+        Calculates the analytical KL divergence between the approximate posterior and prior Gaussian distributions.
+        If the prior depends on samples from the level above, the KL is evaluated for each prior sample,
+        so that averaging over the sample dimension only averages over the prior samples.
         :return: KL divergence of size (batch_size x n_samples x n_variables)
         """
-        n_samples = self.posterior.sample().size()[1]
-        kl = -0.5 * (1 + self.posterior.log_var - torch.pow(self.posterior.mean, 2) - torch.exp(self.posterior.log_var))
-        return kl.unsqueeze(1).repeat(1, n_samples, 1)
-
-    def reset(self, mean=None, log_var=None, from_prior=True):
+        sample_size = self.posterior.sample().size()
+        post_mean, post_log_var = match_samples(self.posterior.mean), match_samples(self.posterior.log_var)
+        prior_mean, prior_log_var = match_samples(self.prior.mean), match_samples(self.prior.log_var)
+        kl = 0.5 * (prior_log_var - post_log_var - 1. + (torch.exp(post_log_var) + torch.pow(post_mean - prior_mean, 2)) / torch.exp(prior_log_var))
+        if kl.size()[1] != sample_size[1]:
+            kl = kl.expand(*sample_size)
+        return kl
+
+    def reset(self, mean=None, log_var=None, from_prior=True, batch_size=None):
         """
         Resets the approximate posterior estimate.
         :param mean: value to set as the new mean
         :param log_var: value to set as the new log variance
         :param from_prior: whether to initialize using the prior
+        :param batch_size: the batch size of the estimate when initializing from a prior without a batch dimension
         :return: None
         """
         if from_prior:
-            mean = self.prior.mean.data.clone()
-            log_var = self.prior.log_var.data.clone()
+            mean, log_var = self.prior.mean.data, self.prior.log_var.data
             if len(mean.shape) == 3:
                 mean = mean.mean(dim=1)
             if len(log_var.shape) == 3:
                 log_var = log_var.mean(dim=1)
+            if batch_size is not None:
+                mean = mean.expand(batch_size, self.n_variables)
+                log_var = log_var.expand(batch_size, self.n_variables)
+            if self._state_buffers is None:
+                # the state buffers are written in place, so only copy the prior if there are none
+                mean, log_var = mean.clone(), log_var.clone()
         self.reset_mean(mean)
         if self.posterior_form == 'gaussian':
             self.reset_log_var(log_var)
 
+    def set_state_buffers(self, state, grads, arena=None):
+        """
+        Stores the approximate posterior parameters and their gradients in preallocated buffers.
+        :param state: list of (batch_size x n_variables) tensors for the mean (and log variance), or None to
+                      keep the parameters in their own tensors
+        :param grads: list of (batch_size x n_variables) tensors for the corresponding gradients
+        :param arena: the PosteriorStateArena the buffers belong to, which renews the state buffer, see write_state
+        :return: None
+        """
+        if self._state_buffers is not None:
+            for index in range(len(self._state_buffers[1])):
+                self.release_state_grad(index)
+        self._state_buffers = (state, grads) if state is not None else None
+        self._state_arena = arena
+
+    def renew_state_buffers(self, state):
+        """
+        Replaces the state buffers, keeping the gradient buffers. Parameters already bound onto the old state
+        buffers keep them.
+        :param state: list of (batch_size x n_variables) tensors for the mean (and log variance)
+        :return: None
+        """
+        self._state_buffers = (state, self._state_buffers[1])
+
+    def write_state(self, index, value=None):
+        """
+        Writes a value into a state buffer. Parameters bound onto the state buffer may have been saved by graphs
+        that are yet to be backpropagated, so the arena first moves the state into a fresh buffer, rather than
+        writing into their storage.
+        :param index: 0 for the mean, 1 for the log variance
+        :param value: the value to write, defaults to zero
+        :return: the state buffer
+        """
+        if self._state_arena is not None and self._state_arena.state_bound:
+            self._state_arena.renew_state()
+        state = self._state_buffers[0][index]
+        if value is None:
+            state.zero_()
+        else:
+            state.copy_(value)
+        return state
+
+    def bind_state(self, index, value=None):
+        """
+        Writes a value into a state buffer and binds a new leaf Variable onto the buffer as the (trainable)
+        posterior parameter. The parameter's gradient is accumulated in place into the matching gradient buffer.
+        :param index: 0 for the mean, 1 for the log variance
+        :param value: the value to write, defaults to zero
+        :return: None
+        """
+        self.release_state_grad(index)
+        state, grad = self.write_state(index, value), self._state_buffers[1][index]
+        param = Variable(state, requires_grad=True)
+        if self._state_arena is not None:
+            self._state_arena.state_bound = True
+        param.grad = Variable(grad.zero_(), volatile=True)
+        if index == 0:
+            self.posterior.mean = param
+        else:
+            self.posterior.log_var = param
+        self.posterior._sample = None
+
+    def retain_state_grad(self, param, index):
+        """
+        Keeps the gradient of a (non-leaf) posterior parameter after the backward pass. With state buffers, the
+        encoded parameter is copied into the state buffer, and its gradient into the (zeroed) gradient buffer.
+        :param param: the posterior parameter
+        :param index: 0 for the mean, 1 for the log variance
+        :return: None
+        """
+        if self._state_buffers is None:
+            param.retain_grad()
+        else:
+            self.write_state(index, param.data)
+            grad = self._state_buffers[1][index].zero_()
+
+            def copy_grad(param_grad):
+                grad.copy_(param_grad.data)
+
+            self._grad_hooks[index] = param.register_hook(copy_grad)
+
+    def release_state_grad(self, index):
+        """
+        Detaches the gradient buffer from the current posterior parameter before it is replaced, so that later
+        backward passes through earlier iterations (for instance with error encodings) do not write into it.
+        :param index: 0 for the mean, 1 for the log variance
+        :return: None
+        """
+        if self._state_buffers is None:
+            return
+        if self._grad_hooks is None:
+            self._grad_hooks = [None, None]
+        if self._grad_hooks[index] is not None:
+            self._grad_hooks[index].remove()
+            self._grad_hooks[index] = None
+        param = self.posterior.mean if index == 0 else self.posterior.log_var
+        grad = self._state_buffers[1][index]
+        if param is not None and param.grad is not None and param.grad.data.data_ptr() == grad.data_ptr():
+            # a parameter bound by bind_state, which accumulates into the buffer
+            param.grad = None
+
     def reset_mean(self, value):
-        self.posterior.reset_mean(value)
+        if self._state_buffers is not None:
+            self.bind_state(0, value)
+        else:
+            self.posterior.reset_mean(value)
 
     def reset_log_var(self, value):
-        self.posterior.reset_log_var(value)
+        if self._state_buffers is not None:
+            self.bind_state(1, value)
+        else:
+            self.posterior.reset_log_var(value)
 
     def trainable_mean(self):
-        self.posterior.mean_trainable()
+        if self._state_buffers is not None:
+            self.bind_state(0, self.posterior.mean.data)
+        else:
+            self.posterior.mean_trainable()
 
     def trainable_log_var(self):
-        self.posterior.log_var_trainable()
+        if self._state_buffers is not None:
+            self.bind_state(1, self.posterior.log_var.data)
+        else:
+            self.posterior.log_var_trainable()
 
     def not_trainable_mean(self):
         self.posterior.mean_not_trainable()
@@ -556,6 +1240,15 @@ class DenseGaussianVariable(object):
             if self.posterior_form == 'gaussian':
                 self.posterior_log_var_gate.eval()
 
+    def freeze_for_inference(self):
+        """
+        Folds batch norm statistics into the posterior and prior heads for inference.
+        :return: None
+        """
+        freeze_layers(*self.posterior_heads())
+        if self.learn_prior:
+            freeze_layers(*self.prior_heads())
+
     def train(self):
         """
         Puts the variable into train mode.
@@ -636,11 +1329,41 @@ class DenseGaussianVariable(object):
         """
         return self.posterior.state_parameters()
 
+    def named_modules(self):
+        """
+        Gets the posterior and prior heads (and update gates) by name, for the state dict.
+        :return: List of (name, module) pairs.
+        """
+        modules = [('posterior_mean', self.posterior_mean)]
+        if self.posterior_form == 'gaussian':
+            modules.append(('posterior_log_var', self.posterior_log_var))
+        if self.update_form == 'highway':
+            modules.append(('posterior_mean_gate', self.posterior_mean_gate))
+            if self.posterior_form == 'gaussian':
+                modules.append(('posterior_log_var_gate', self.posterior_log_var_gate))
+        if self.learn_prior:
+            modules.append(('prior_mean', self.prior_mean))
+            if self.prior_log_var is not None:
+                modules.append(('prior_log_var', self.prior_log_var))
+        return modules
+
+    def named_variables(self):
+        """
+        Gets the trainable variables that are not part of a module by name, for the state dict.
+        :return: List of (name, variable) pairs.
+        """
+        if self.learn_prior and self.prior_log_var is None:
+            return [('prior.log_var', self.prior.log_var)]
+        return []
+
     def state_gradients(self):
         """
         Gets the state (approximate posterior) gradients.
         :return: List containing approximate posterior mean (and possibly log variance) gradients.
         """
+        if self._state_buffers is not None:
+            # copies, as the next backward pass overwrites the buffers
+            return [Variable(grad.clone()) for grad in self._state_buffers[1]]
         assert self.posterior.mean.grad is not None, 'State gradients are None.'
         grads = [self.posterior.mean.grad.detach()]
         if self.posterior_form == 'gaussian':
@@ -650,107 +1373,68 @@ class DenseGaussianVariable(object):
         return grads
 
 
-class ConvGaussianVariable(object):
-
-    def __init__(self, batch_size, n_variable_channels, filter_size, const_prior_var, n_input, update_form, learn_prior=True):
-
-        self.batch_size = batch_size
-        self.n_variable_channels = n_variable_channels
-        assert update_form in ['direct', 'highway'], 'Variable update form not found.'
-        self.update_form = update_form
-        self.learn_prior = learn_prior
-
-        if self.learn_prior:
-            self.prior_mean = Conv(n_input[1], filter_size, self.n_variable_channels)
-            self.prior_log_var = None
-            if not const_prior_var:
-                self.prior_log_var = Conv(n_input[1], filter_size, self.n_variable_channels)
-        self.posterior_mean = Conv(n_input[0], filter_size, self.n_variable_channels)
-        self.posterior_log_var = Conv(n_input[0], filter_size, self.n_variable_channels)
-
-        if self.update_form == 'highway':
-            self.posterior_mean_gate = Conv(n_input[0], filter_size, self.n_variable_channels, 'sigmoid')
-            self.posterior_log_var_gate = Conv(n_input[0], filter_size, self.n_variable_channels, 'sigmoid')
-
-        self.posterior = DiagonalGaussian()
-        self.prior = DiagonalGaussian()
-        if self.learn_prior and const_prior_var:
-            self.prior.log_var_trainable()
-
-    def encode(self, input):
-        # encode the mean and log variance, update, return sample
-        mean, log_var = self.posterior_mean(input), self.posterior_log_var(input)
-        if self.update_form == 'highway':
-            mean_gate = self.posterior_mean_gate(input)
-            log_var_gate = self.posterior_log_var_gate(input)
-            mean = mean_gate * self.posterior.mean + (1 - mean_gate) * mean
-            log_var = log_var_gate * self.posterior.log_var + (1 - log_var_gate) * log_var
-        self.posterior.mean, self.posterior.log_var = mean, log_var
-        return self.posterior.sample()
-
-    def decode(self, input, generate=False):
-        # decode the mean and log variance, update, return sample
-        mean, log_var = self.prior_mean(input), self.prior_log_var(input)
-        self.prior.mean, self.prior.log_var = mean, log_var
-        sample = self.prior.sample() if generate else self.posterior.sample()
-        return sample
-
-    def error(self):
-        return self.posterior.sample() - self.prior.mean
-
-    def norm_error(self):
-        return self.error() / (torch.exp(self.prior.log_var) + 1e-7)
-
-    def KL_divergence(self):
-        return self.posterior.log_prob(self.posterior.sample()) - self.prior.log_prob(self.posterior.sample())
-
-    def reset(self):
-        self.reset_mean()
-        self.reset_log_var()
-
-    def reset_mean(self):
-        self.posterior.reset_mean()
-
-    def reset_log_var(self):
-        self.posterior.reset_log_var()
+class ConvGaussianVariable(DenseGaussianVariable):
 
-    def trainable_mean(self, trainable=True):
-        self.posterior.mean_trainable(trainable)
+    """
+    Gaussian latent variable arranged as (n_variable_channels x height x width) maps, with convolutional heads.
+    The parameters and samples are stored flattened to (batch_size x n_variables), so the distributions,
+    KL divergences, resetting, and state buffers are those of DenseGaussianVariable.
+    """
 
-    def trainable_log_var(self, trainable=True):
-        self.posterior.log_var_trainable(trainable)
+    def __init__(self, n_variable_channels, spatial_size, filter_size, const_prior_var, n_input, update_form,
+                 posterior_form='gaussian', learn_prior=True):
 
-    def cuda(self, device_id=0):
-        # place all modules on the GPU
-        self.prior_mean.cuda(device_id)
-        self.prior_log_var.cuda(device_id)
-        self.posterior_mean.cuda(device_id)
-        self.posterior_log_var.cuda(device_id)
-        if self.update_form == 'highway':
-            self.posterior_mean_gate.cuda(device_id)
-            self.posterior_log_var_gate.cuda(device_id)
-        self.prior.cuda(device_id)
-        self.posterior.cuda(device_id)
+        self.n_variable_channels = n_variable_channels
+        self.spatial_size = tuple(spatial_size)
+        self.filter_size = filter_size
+        n_variables = n_variable_channels * self.spatial_size[0] * self.spatial_size[1]
+        super(ConvGaussianVariable, self).__init__(n_variables, const_prior_var, n_input, update_form,
+                                                   posterior_form, learn_prior)
 
-    def parameters(self):
-        pass
+    def head(self, n_in, non_linearity=None):
+        """
+        Creates a layer that outputs one of the distribution parameters (or update gates).
+        :param n_in: the number of input channels of the layer
+        :param non_linearity: the non-linearity of the layer
+        :return: a Conv layer with n_variable_channels output channels
+        """
+        return Conv(n_in, self.filter_size, self.n_variable_channels, non_linearity)
 
-    def encoder_parameters(self):
-        pass
+    def apply_heads(self, heads, input):
+        """
+        Applies several heads to the same input maps.
+        :param heads: list of layers, as given by posterior_heads or prior_heads
+        :param input: the (batch_size x n_channels x height x width) input to the heads
+        :return: list of flattened outputs of size (batch_size x n_variables), one per head
+        """
+        return [output.contiguous().view(-1, self.n_variables) for output in fused_conv(heads, input)]
 
-    def decoder_parameters(self):
-        pass
+    def to_map(self, input):
+        """
+        Reshapes flattened variables into maps.
+        :param input: tensor of size (batch_size x n_variables)
+        :return: tensor of size (batch_size x n_variable_channels x height x width)
+        """
+        return input.contiguous().view(-1, self.n_variable_channels, self.spatial_size[0], self.spatial_size[1])
 
-    def state_parameters(self):
-        return self.posterior.state_parameters()
+    def decode(self, input, n_samples, generate=False):
+        """
+        Generates a sample from the prior or the approximate posterior.
+        :param input: the (batch_size * n_samples x n_channels x height x width) input from above if learning the prior
+        :param n_samples: number of samples to draw
+        :param generate: whether to sample from the prior or the approximate posterior
+        :return: tensor of samples of size (batch_size x n_samples x n_variables)
+        """
+        if self.learn_prior:
+            self.set_prior(input, n_samples)
+        return self.draw_samples(input.size()[0] // n_samples, n_samples, generate)
 
 
 class DenseLatentLevel(object):
 
-    def __init__(self, batch_size, encoder_arch, decoder_arch, n_latent, n_det, encoding_form, const_prior_var,
+    def __init__(self, encoder_arch, decoder_arch, n_latent, n_det, encoding_form, const_prior_var,
                  variable_update_form, posterior_form='gaussian', learn_prior=True):
 
-        self.batch_size = batch_size
         self.n_latent = n_latent
         self.encoding_form = encoding_form
 
@@ -761,7 +1445,7 @@ class DenseLatentLevel(object):
 
         variable_input_sizes = (encoder_arch['n_units'], decoder_arch['n_units'])
 
-        self.latent = DenseGaussianVariable(self.batch_size, self.n_latent, const_prior_var, variable_input_sizes,
+        self.latent = DenseGaussianVariable(self.n_latent, const_prior_var, variable_input_sizes,
                                             variable_update_form, posterior_form, learn_prior)
         self.deterministic_encoder = Dense(variable_input_sizes[0], n_det[0]) if n_det[0] > 0 else None
         self.deterministic_decoder = Dense(variable_input_sizes[1], n_det[1]) if n_det[1] > 0 else None
@@ -911,8 +1595,8 @@ class DenseLatentLevel(object):
     def kl_divergence(self):
         return self.latent.kl_divergence()
 
-    def reset(self, mean=None, log_var=None, from_prior=True):
-        self.latent.reset(mean=mean, log_var=log_var, from_prior=from_prior)
+    def reset(self, mean=None, log_var=None, from_prior=True, batch_size=None):
+        self.latent.reset(mean=mean, log_var=log_var, from_prior=from_prior, batch_size=batch_size)
 
     def trainable_state(self):
         self.latent.trainable_mean()
@@ -928,11 +1612,23 @@ class DenseLatentLevel(object):
         self.encoder.eval()
         self.decoder.eval()
         self.latent.eval()
+        if self.deterministic_encoder:
+            self.deterministic_encoder.eval()
+        if self.deterministic_decoder:
+            self.deterministic_decoder.eval()
 
     def train(self):
         self.encoder.train()
         self.decoder.train()
         self.latent.train()
+        if self.deterministic_encoder:
+            self.deterministic_encoder.train()
+        if self.deterministic_decoder:
+            self.deterministic_decoder.train()
+
+    def freeze_for_inference(self):
+        freeze_layers(self.encoder, self.decoder, self.deterministic_encoder, self.deterministic_decoder)
+        self.latent.freeze_for_inference()
 
     def cuda(self, device_id=0):
         # place all modules on the GPU
@@ -969,110 +1665,188 @@ class DenseLatentLevel(object):
     def state_gradients(self):
         return self.latent.state_gradients()
 
+    def named_modules(self):
+        modules = [('encoder', self.encoder), ('decoder', self.decoder),
+                   ('deterministic_encoder', self.deterministic_encoder),
+                   ('deterministic_decoder', self.deterministic_decoder)]
+        modules = [(name, module) for name, module in modules if module is not None]
+        modules.extend([('latent.' + name, module) for name, module in self.latent.named_modules()])
+        return modules
 
-class ConvLatentLevel(object):
-    pass
+    def named_variables(self):
+        return [('latent.' + name, variable) for name, variable in self.latent.named_variables()]
 
 
-class RecurrentLatentLevel(object):
+class ConvLatentLevel(DenseLatentLevel):
 
-    def __init__(self, batch_size, encoder_arch, decoder_arch, n_latent, n_det, encoding_form, const_prior_var,
-                 variable_update_form, posterior_form='gaussian', learn_prior=True):
+    """
+    Latent level with a convolutional encoder, decoder, and latent variable, operating on
+    (batch_size x n_channels x height x width) maps. The encoder downsamples the input from
+    below with a strided convolution and the decoder upsamples the input from above.
+    """
+
+    def __init__(self, encoder_arch, decoder_arch, n_latent, spatial_size, n_det, encoding_form,
+                 const_prior_var, variable_update_form, posterior_form='gaussian', learn_prior=True):
 
-        self.batch_size = batch_size
         self.n_latent = n_latent
         self.encoding_form = encoding_form
 
-        self.encoder = MultiLayerRecurrent(**encoder_arch)
-        self.decoder = MultiLayerPerceptron(**decoder_arch)
-
-        variable_input_sizes = (encoder_arch['n_units'], decoder_arch['n_units'])
-
-        self.latent = DenseGaussianVariable(self.batch_size, self.n_latent, const_prior_var, variable_input_sizes,
-                                            variable_update_form, posterior_form, learn_prior)
-        self.deterministic_encoder = Dense(variable_input_sizes[0], n_det[0]) if n_det[0] > 0 else None
-        self.deterministic_decoder = Dense(variable_input_sizes[1], n_det[1]) if n_det[1] > 0 else None
+        encoder_arch = dict(encoder_arch)
+        decoder_arch = dict(decoder_arch)
+        n_in, stride = encoder_arch.pop('n_in'), encoder_arch.pop('stride')
+        filter_size = encoder_arch['filter_size']
+        self.input_conv = Conv(n_in, filter_size, encoder_arch['n_filters'], encoder_arch['non_linearity'],
+                               encoder_arch['batch_norm'], encoder_arch['weight_norm'], stride=stride)
+        n_state_channels = n_latent * self.n_encoding_maps(encoding_form, 'in', posterior_form)
+        self.encoder = MultiLayerConv(encoder_arch['n_filters'] + n_state_channels, **encoder_arch)
+        self.upsample = decoder_arch.pop('upsample')
+        self.decoder = MultiLayerConv(**decoder_arch)
+
+        variable_input_sizes = (self.encoder.n_out, self.decoder.n_out)
+
+        self.latent = ConvGaussianVariable(self.n_latent, spatial_size, filter_size, const_prior_var,
+                                           variable_input_sizes, variable_update_form, posterior_form, learn_prior)
+        self.deterministic_encoder = Conv(variable_input_sizes[0], filter_size, n_det[0]) if n_det[0] > 0 else None
+        self.deterministic_decoder = Conv(variable_input_sizes[1], filter_size, n_det[1]) if n_det[1] > 0 else None
+
+    @staticmethod
+    def n_encoding_maps(encoding_form, in_out, posterior_form='gaussian'):
+        """
+        Counts the maps, each with one channel per latent channel, added by the encoding forms.
+        :param encoding_form: list of encoding forms
+        :param in_out: 'in' for the encoder input, 'out' for the output to the level above
+        :param posterior_form: the form of the approximate posterior
+        :return: the number of maps
+        """
+        n_maps = 0
+        for form in encoding_form:
+            if in_out == 'out':
+                n_maps += form in ['posterior', 'bottom_error', 'bottom_norm_error']
+            elif form in ['top_error', 'top_norm_error', 'mean', 'log_var', 'var']:
+                n_maps += 1
+            elif form.endswith('gradient'):
+                single = 'mean_gradient' in form or 'log_var_gradient' in form or posterior_form != 'gaussian'
+                n_maps += 1 if single else 2
+        return n_maps
+
+    def encoding_maps(self, form, in_out, input):
+        """
+        Gets the maps for one encoding form, each of size (batch_size x n_latent x height x width).
+        Gradients are l2 normalized over channels at each location, or layer normalized over the batch.
+        :param form: the encoding form
+        :param in_out: 'in' for the encoder input, 'out' for the output to the level above
+        :param input: the posterior sample maps (for 'out')
+        :return: list of maps
+        """
+        to_map = self.latent.to_map
+        if in_out == 'out':
+            if form == 'posterior':
+                return [input]
+            if form == 'bottom_error':
+                return [to_map(self.latent.error())]
+            if form == 'bottom_norm_error':
+                return [to_map(self.latent.norm_error())]
+            return []
+        if form == 'top_error':
+            return [to_map(self.latent.error())]
+        if form == 'top_norm_error':
+            return [to_map(self.latent.norm_error())]
+        if form == 'mean':
+            return [to_map(self.latent.posterior.mean.detach())]
+        if form == 'log_var':
+            return [to_map(self.latent.posterior.log_var.detach())]
+        if form == 'var':
+            return [to_map(torch.exp(self.latent.posterior.log_var.detach()))]
+        if form.endswith('gradient'):
+            grads = [to_map(grad) for grad in self.state_gradients()]
+            if 'mean_gradient' in form:
+                grads = grads[:1]
+            elif 'log_var_gradient' in form:
+                grads = grads[1:]
+            if form.startswith('l2_norm'):
+                return [grad / (torch.norm(grad, 2, 1, True) + 1e-5) for grad in grads]
+            if form.startswith('layer_norm'):
+                return [(grad - grad.mean(dim=0, keepdim=True)) / (grad.std(dim=0, keepdim=True) + 1e-5) for grad in grads]
+            if form == 'log_gradient':
+                return [torch.log(grad.abs() + 1e-5) for grad in grads]
+            if form == 'scaled_log_gradient':
+                return [torch.clamp(torch.log(grad.abs() + 1e-5) * 10., min=-5.) for grad in grads]
+            if form == 'sign_gradient':
+                return [torch.sign(grad) for grad in grads]
+            return grads
+        return []
 
     def get_encoding(self, input, in_out):
-        encoding = input if in_out == 'in' else None
-        if 'posterior' in self.encoding_form and in_out == 'out':
-            encoding = input
-        if ('top_error' in self.encoding_form and in_out == 'in') or ('bottom_error' in self.encoding_form and in_out == 'out'):
-            error = self.latent.error()
-            encoding = error if encoding is None else torch.cat((encoding, error), 1)
-        if ('top_norm_error' in self.encoding_form and in_out == 'in') or ('bottom_norm_error' in self.encoding_form and in_out == 'out'):
-            norm_error = self.latent.norm_error()
-            encoding = norm_error if encoding is None else torch.cat((encoding, norm_error), 1)
-        if 'gradient' in self.encoding_form and in_out == 'in':
-            pass
-        return encoding
+        maps = [input] if in_out == 'in' else []
+        for form in self.encoding_form:
+            maps.extend(self.encoding_maps(form, in_out, input))
+        return maps[0] if len(maps) == 1 else torch.cat(maps, 1)
 
     def encode(self, input):
-        encoded = self.encoder(self.get_encoding(input, 'in'))
-        output = self.get_encoding(self.latent.encode(encoded), 'out')
+        # downsample the input, encode it with the state encodings, concatenate any deterministic units
+        encoded = self.encoder(self.get_encoding(self.input_conv(input), 'in'))
+        sample = self.latent.to_map(self.latent.encode(encoded).mean(dim=1))
+        output = self.get_encoding(sample, 'out')
         if self.deterministic_encoder:
             det = self.deterministic_encoder(encoded)
             output = torch.cat((det, output), 1)
         return output
 
-    def decode(self, input, generate=False):
-        # decode the input, sample the latent variable, concatenate any deterministic units
+    def decode(self, input, n_samples, generate=False):
+        # upsample the input, sample the latent variable, concatenate any deterministic units
+        # the input and output maps have samples in the batch dimension
+        if self.upsample > 1:
+            input = F.upsample(input, scale_factor=self.upsample, mode='nearest')
         decoded = self.decoder(input)
-        sample = self.latent.decode(decoded, generate=generate)
+        sample = self.latent.to_map(self.latent.decode(decoded, n_samples, generate=generate))
         if self.deterministic_decoder:
             det = self.deterministic_decoder(decoded)
             sample = torch.cat((sample, det), 1)
         return sample
 
-    def kl_divergence(self):
-        return self.latent.kl_divergence()
-
-    def reset(self, from_prior=True):
-        self.latent.reset(from_prior)
-        self.encoder.reset()
-
-    def trainable_state(self):
-        self.latent.trainable_mean()
-        self.latent.trainable_log_var()
-
     def eval(self):
-        self.encoder.eval()
-        self.decoder.eval()
-        self.latent.eval()
+        super(ConvLatentLevel, self).eval()
+        self.input_conv.eval()
 
     def train(self):
-        self.encoder.train()
-        self.decoder.train()
-        self.latent.train()
+        super(ConvLatentLevel, self).train()
+        self.input_conv.train()
 
-    def cuda(self, device_id=0):
-        # place all modules on the GPU
-        self.encoder.cuda(device_id)
-        self.decoder.cuda(device_id)
-        self.latent.cuda(device_id)
-        if self.deterministic_encoder:
-            self.deterministic_encoder.cuda(device_id)
-        if self.deterministic_decoder:
-            self.deterministic_decoder.cuda(device_id)
+    def freeze_for_inference(self):
+        super(ConvLatentLevel, self).freeze_for_inference()
+        freeze_layers(self.input_conv)
 
-    def parameters(self):
-        return self.encoder_parameters() + self.decoder_parameters()
+    def cuda(self, device_id=0):
+        super(ConvLatentLevel, self).cuda(device_id)
+        self.input_conv.cuda(device_id)
 
     def encoder_parameters(self):
-        encoder_params = []
-        encoder_params.extend(list(self.encoder.parameters()))
-        if self.deterministic_encoder:
-            encoder_params.extend(list(self.deterministic_encoder.parameters()))
-        encoder_params.extend(list(self.latent.encoder_parameters()))
-        return encoder_params
+        return list(self.input_conv.parameters()) + super(ConvLatentLevel, self).encoder_parameters()
 
-    def decoder_parameters(self):
-        decoder_params = []
-        decoder_params.extend(list(self.decoder.parameters()))
-        if self.deterministic_decoder:
-            decoder_params.extend(list(self.deterministic_decoder.parameters()))
-        decoder_params.extend(list(self.latent.decoder_parameters()))
-        return decoder_params
+    def named_modules(self):
+        return [('input_conv', self.input_conv)] + super(ConvLatentLevel, self).named_modules()
 
-    def state_parameters(self):
-        return self.latent.state_parameters()
+
+class RecurrentLatentLevel(DenseLatentLevel):
+
+    """Latent level with a recurrent encoder, whose state is kept across inference iterations until reset."""
+
+    def __init__(self, encoder_arch, decoder_arch, n_latent, n_det, encoding_form, const_prior_var,
+                 variable_update_form, posterior_form='gaussian', learn_prior=True):
+
+        self.n_latent = n_latent
+        self.encoding_form = encoding_form
+
+        self.encoder = MultiLayerRecurrent(**encoder_arch)
+        self.decoder = MultiLayerPerceptron(**decoder_arch)
+
+        variable_input_sizes = (self.encoder.n_out, decoder_arch['n_units'])
+
+        self.latent = DenseGaussianVariable(self.n_latent, const_prior_var, variable_input_sizes,
+                                            variable_update_form, posterior_form, learn_prior)
+        self.deterministic_encoder = Dense(variable_input_sizes[0], n_det[0]) if n_det[0] > 0 else None
+        self.deterministic_decoder = Dense(variable_input_sizes[1], n_det[1]) if n_det[1] > 0 else None
+
+    def reset(self, mean=None, log_var=None, from_prior=True, batch_size=None):
+        super(RecurrentLatentLevel, self).reset(mean=mean, log_var=log_var, from_prior=from_prior, batch_size=batch_size)
+        self.encoder.reset()
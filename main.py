@@ -1,9 +1,13 @@
 from lib.models import get_model
 from util.data.load_data import load_data
 from util.optimizers import get_optimizers
-from util.train_val import train, run
+from util.train_val import train, train_epoch, run
 from util.plotting import init_plot, save_env
-from util.logs import init_log, save_checkpoint
+from util.logs import init_log, save_checkpoint, restore_rng_state
+from util.cpu import configure_cpu
+from util.distributed import init_distributed, is_distributed, broadcast_parameters, reseed_for_rank
+from util.timing import PhaseTimer
+from util.memory import MemoryProfiler
 import sys
 import os
 import time
@@ -16,6 +20,9 @@ arg_parser.add_argument('--model_type', default='single_level', help='model type
 arg_parser.add_argument('--inference_type', default='iterative', help='inference type, standard or iterative')
 arg_parser.add_argument('--data_path', default='', help='path to data directory root')
 arg_parser.add_argument('--log_path', default='', help='path to log directory root')
+arg_parser.add_argument('--cuda_device', default='', help='GPU to run on, or cpu, overrides the config if given')
+arg_parser.add_argument('--numa_node', default='', help='NUMA node to run on (CPU), overrides the config if given')
+arg_parser.add_argument('--rank', type=int, default=0, help='rank of this worker process in distributed training')
 args = arg_parser.parse_args()
 
 path_to_config = os.path.join(os.getcwd(), 'cfg', args.dataset, args.model_type, args.inference_type)
@@ -24,48 +31,98 @@ from config import train_config, arch
 
 train_config['data_path'] = args.data_path
 train_config['log_root'] = args.log_path
+if args.cuda_device != '':
+    train_config['cuda_device'] = None if args.cuda_device == 'cpu' else int(args.cuda_device)
+if args.numa_node != '':
+    train_config['numa_node'] = int(args.numa_node)
+if train_config['cuda_device'] is None:
+    worker_init_fn = configure_cpu(train_config)
+else:
+    worker_init_fn = None
 
+# in distributed training, only the first worker logs, plots, validates, and saves checkpoints
+if is_distributed(train_config):
+    init_distributed(train_config, args.rank)
+is_master = args.rank == 0
 
 log_root = train_config['log_root']
-log_path, log_dir = init_log(log_root, train_config)
-print 'Experiment: ' + log_dir
+resume = train_config['resume_experiment'] != '' and train_config['resume_experiment'] is not None
+if is_master or resume:
+    log_path, log_dir = init_log(log_root, train_config)
+    print 'Experiment: ' + log_dir
 
 global vis
-vis, handle_dict = init_plot(train_config, arch, env=log_dir)
+if is_master:
+    vis, handle_dict = init_plot(train_config, arch, env=log_dir, log_path=log_path)
 
 # load data, labels
 data_path = train_config['data_path']
 train_loader, val_loader, label_names = load_data(train_config['dataset'], data_path, train_config['batch_size'],
-                                                  cuda_device=train_config['cuda_device'])
+                                                  cuda_device=train_config['cuda_device'],
+                                                  num_workers=train_config['num_workers'],
+                                                  worker_init_fn=worker_init_fn, rank=args.rank,
+                                                  world_size=train_config['world_size'])
 
 # construct model
 model = get_model(train_config, arch, train_loader)
+broadcast_parameters(model, train_config)
+
+# time the phases of each epoch (and sample their memory), writing a trace per epoch
+phase_timer = None
+if (train_config['phase_timing'] or train_config['memory_profiling']) and is_master:
+    timer_type = MemoryProfiler if train_config['memory_profiling'] else PhaseTimer
+    phase_timer = timer_type(train_config['cuda_device'], synchronize=train_config['phase_timing_sync'])
+    model.phase_timer = phase_timer
+    if not os.path.exists(os.path.join(log_path, 'traces')):
+        os.makedirs(os.path.join(log_path, 'traces'))
 
 # get optimizers
 (enc_opt, enc_scheduler), (dec_opt, dec_scheduler), start_epoch = get_optimizers(train_config, arch, model)
+if resume:
+    restore_rng_state(train_config['cuda_device'])
+    reseed_for_rank(train_config)
 
 for epoch in range(start_epoch+1, 2000):
     print 'Epoch: ' + str(epoch+1)
     # train
     tic = time.time()
     model.train()
-    train(model, train_config, arch, train_loader, epoch+1, handle_dict, (enc_opt, dec_opt))
+    if not is_master:
+        train_epoch(model, train_config, arch, train_loader, epoch+1, (enc_opt, dec_opt))
+        enc_scheduler.step()
+        dec_scheduler.step()
+        continue
+    if phase_timer is not None:
+        phase_timer.reset()
+        phase_timer.set_category('train')
+    output_dict, _ = train(model, train_config, arch, train_loader, epoch+1, handle_dict, (enc_opt, dec_opt))
     toc = time.time()
     print 'Training Time: ' + str(toc - tic)
+    print 'Throughput (examples/s): ' + str(output_dict['throughput'])
     # validation
     tic = time.time()
     visualize = False
     eval = False
     if epoch % train_config['display_iter'] == train_config['display_iter']-1:
-        save_checkpoint(model, (enc_opt, dec_opt), epoch)
         visualize = True
     if epoch % train_config['eval_iter'] == train_config['eval_iter']-1:
         eval = True
-    model.eval()
+    model.freeze_for_inference()
+    if phase_timer is not None:
+        phase_timer.set_category('val')
     _, averages, _ = run(model, train_config, arch, val_loader, epoch+1, handle_dict, vis=visualize, eval=eval, label_names=label_names)
     toc = time.time()
     print 'Validation Time: ' + str(toc - tic)
     print 'ELBO: ' + str(averages[0])
+    if phase_timer is not None:
+        print phase_timer.summary_table()
+        if train_config['memory_profiling']:
+            print phase_timer.memory_table()
+        phase_timer.save_trace(os.path.join(log_path, 'traces', 'epoch_' + str(epoch+1) + '.json'))
+    if visualize:
+        # written in the background, keeping the last n_checkpoints and the one with the best validation ELBO
+        save_checkpoint(model, (enc_opt, dec_opt), (enc_scheduler, dec_scheduler), epoch, train_config['cuda_device'],
+                        metric=averages[0])
     save_env()
     enc_scheduler.step()
     dec_scheduler.step()
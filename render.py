@@ -0,0 +1,17 @@
+from util.figures import render
+import time
+import argparse
+
+arg_parser = argparse.ArgumentParser()
+arg_parser.add_argument('--log_path', default='', help='experiment log directory, or log directory root of several experiments')
+arg_parser.add_argument('--n_processes', type=int, default=4, help='number of rendering processes')
+arg_parser.add_argument('--format', default='png', help='figure format, png or svg')
+arg_parser.add_argument('--watch', type=float, default=0., help='if positive, render again every this many seconds')
+args = arg_parser.parse_args()
+
+while True:
+    n_rendered = render(args.log_path, n_processes=args.n_processes, figure_format=args.format)
+    print 'Rendered ' + str(n_rendered) + ' figure sets.'
+    if args.watch <= 0.:
+        break
+    time.sleep(args.watch)
@@ -0,0 +1,111 @@
+import os
+import ctypes
+import multiprocessing
+import torch
+
+
+def parse_cpu_list(cpu_list):
+    """
+    Parses a Linux cpu list, for instance '0-3,8-11'.
+    :param cpu_list: the cpu list string
+    :return: list of core indices
+    """
+    cores = []
+    for part in cpu_list.strip().split(','):
+        if '-' in part:
+            start, end = part.split('-')
+            cores.extend(range(int(start), int(end) + 1))
+        elif part != '':
+            cores.append(int(part))
+    return cores
+
+
+def node_cores(numa_node):
+    """
+    Gets the cores of a NUMA node.
+    :param numa_node: the index of the NUMA node
+    :return: list of core indices
+    """
+    with open('/sys/devices/system/node/node' + str(numa_node) + '/cpulist', 'r') as cpu_list:
+        return parse_cpu_list(cpu_list.read())
+
+
+def available_cores():
+    """
+    Gets the cores that this process is allowed to run on.
+    :return: list of core indices
+    """
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    if os.path.exists('/proc/self/status'):
+        with open('/proc/self/status', 'r') as status:
+            for line in status:
+                if line.startswith('Cpus_allowed_list:'):
+                    return parse_cpu_list(line.split(':')[1])
+    return range(multiprocessing.cpu_count())
+
+
+def set_affinity(cores):
+    """
+    Restricts the calling thread, and the threads it creates afterwards, to a set of cores.
+    :param cores: list of core indices
+    :return: None
+    """
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cores)
+        return
+    libc = ctypes.CDLL('libc.so.6', use_errno=True)
+    mask = (ctypes.c_ulong * 16)()
+    n_bits = 8 * ctypes.sizeof(ctypes.c_ulong)
+    for core in cores:
+        mask[core // n_bits] |= 1 << (core % n_bits)
+    if libc.sched_setaffinity(0, ctypes.sizeof(mask), ctypes.byref(mask)) != 0:
+        raise OSError(ctypes.get_errno(), 'Could not set the affinity to cores ' + str(cores) + '.')
+
+
+def split_cores(train_config):
+    """
+    Splits the available cores, restricted to the configured NUMA node if any, between the
+    data loader workers and the compute threads. If there are too few cores, they are shared.
+    :param train_config: the train config, with num_workers, n_threads, and numa_node
+    :return: (list of worker cores, list of compute cores)
+    """
+    cores = available_cores()
+    if train_config['numa_node'] is not None:
+        numa_cores = set(node_cores(train_config['numa_node']))
+        cores = [core for core in cores if core in numa_cores]
+    assert len(cores) > 0, 'No cores available.'
+    n_workers = train_config['num_workers']
+    if n_workers == 0:
+        worker_cores, compute_cores = [], cores
+    elif n_workers < len(cores):
+        worker_cores, compute_cores = cores[:n_workers], cores[n_workers:]
+    else:
+        worker_cores, compute_cores = cores, cores
+    if train_config['n_threads'] is not None:
+        compute_cores = compute_cores[:train_config['n_threads']]
+    return worker_cores, compute_cores
+
+
+def configure_cpu(train_config):
+    """
+    Sets up CPU execution. The compute thread pool is sized from n_threads, or to the compute cores if not set.
+    If pin_threads is set, the compute threads and each data loader worker are pinned to separate cores,
+    on the NUMA node given by numa_node if set, so that runs sharing a host can each be placed on a node
+    (memory is then allocated locally on first touch).
+    :param train_config: the train config
+    :return: the worker_init_fn for the data loaders, None if not pinning
+    """
+    worker_cores, compute_cores = split_cores(train_config)
+    n_threads = train_config['n_threads'] if train_config['n_threads'] is not None else len(compute_cores)
+    torch.set_num_threads(n_threads)
+    if not train_config['pin_threads']:
+        return None
+    set_affinity(compute_cores)
+    if len(worker_cores) == 0:
+        return None
+
+    def pin_worker(worker_id):
+        set_affinity([worker_cores[worker_id % len(worker_cores)]])
+
+    return pin_worker
@@ -4,16 +4,20 @@ import torch
 import torchvision
 from torch.utils.data import TensorDataset, DataLoader
 from sparse_dataset import SparseDataset
+from resumable_sampler import ResumableSampler
 
 
 def load_torch_data(load_data_func):
     """Wrapper around load_data to instead use pytorch data loaders."""
 
-    def torch_loader(dataset, data_path, batch_size, shuffle=True, cuda_device=None, num_workers=1):
+    def torch_loader(dataset, data_path, batch_size, shuffle=True, cuda_device=None, num_workers=1, worker_init_fn=None,
+                     rank=0, world_size=1):
         (train_data, val_data), (train_labels, val_labels), label_names = load_data_func(dataset, data_path)
 
-        kwargs = {'num_workers': num_workers, 'pin_memory': True} if cuda_device is not None else {}
-        kwargs['drop_last'] = True
+        # pinned memory only speeds up host to GPU copies
+        kwargs = {'num_workers': num_workers, 'pin_memory': cuda_device is not None}
+        if worker_init_fn is not None:
+            kwargs['worker_init_fn'] = worker_init_fn
 
         if type(train_data) == numpy.ndarray:
             train_dataset = TensorDataset(torch.from_numpy(train_data), torch.from_numpy(train_labels))
@@ -28,7 +32,9 @@ def load_torch_data(load_data_func):
             train_dataset = torchvision.datasets.ImageFolder(train_data)
             val_dataset = torchvision.datasets.ImageFolder(val_data)
 
-        train_loader = DataLoader(train_dataset, batch_size=batch_size, shuffle=shuffle, **kwargs)
+        # reshuffled with set_epoch, and each worker process trains on its own shard
+        train_sampler = ResumableSampler(train_dataset, shuffle=shuffle, rank=rank, world_size=world_size)
+        train_loader = DataLoader(train_dataset, batch_size=batch_size, sampler=train_sampler, **kwargs)
         val_loader = DataLoader(val_dataset, batch_size=batch_size, shuffle=False, **kwargs)
 
         return train_loader, val_loader, label_names
@@ -0,0 +1,58 @@
+import math
+import torch
+from torch.utils.data.sampler import Sampler
+
+
+class ResumableSampler(Sampler):
+    """
+    Samples a dataset in an order given by a seed and the epoch, so that the order of an epoch can be
+    reproduced, and training can resume part way through an epoch (see set_start). In distributed
+    training, each worker process samples its own shard of the dataset, as in DistributedSampler.
+
+    data_source: the dataset
+    shuffle: whether to shuffle the dataset each epoch
+    rank: the rank of this worker process
+    world_size: the number of worker processes
+    seed: the seed of the orders, drawn from the torch random number generator if not given
+    """
+
+    def __init__(self, data_source, shuffle=True, rank=0, world_size=1, seed=None):
+        self.data_source = data_source
+        self.shuffle = shuffle
+        self.rank = rank
+        self.world_size = world_size
+        if seed is None:
+            # the shards of the worker processes must come from the same order
+            seed = 0 if world_size > 1 else int(torch.LongTensor(1).random_(0, 2 ** 31)[0])
+        self.seed = seed
+        self.epoch = 0
+        self.start = 0
+        self.n_samples = int(math.ceil(len(data_source) * 1.0 / world_size))
+
+    def indices(self):
+        """Gets the indices of this worker's shard of the epoch, in order."""
+        if self.shuffle:
+            generator = torch.Generator()
+            generator.manual_seed(self.seed + self.epoch)
+            indices = torch.randperm(len(self.data_source), generator=generator).tolist()
+        else:
+            indices = range(len(self.data_source))
+        # pad with the first indices to divide evenly into shards
+        total_size = self.n_samples * self.world_size
+        indices += indices[:(total_size - len(indices))]
+        return indices[self.rank:total_size:self.world_size]
+
+    def __iter__(self):
+        return iter(self.indices()[self.start:])
+
+    def __len__(self):
+        return self.n_samples - self.start
+
+    def set_epoch(self, epoch):
+        """Sets the epoch, which changes the order, and starts it from the beginning."""
+        self.epoch = epoch
+        self.start = 0
+
+    def set_start(self, start):
+        """Skips the first start indices of the current epoch, which have already been trained on."""
+        self.start = start
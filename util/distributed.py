@@ -0,0 +1,97 @@
+import random
+import numpy as np
+import torch
+import torch.distributed as dist
+
+
+def init_distributed(train_config, rank):
+    """
+    Joins the group of worker processes for data-parallel training, over gloo. The processes meet at
+    dist_url, for instance a file on a file system shared by all hosts ('file:///shared/path/rendezvous'),
+    which must not exist before the run. Each worker draws different samples and binarizations.
+    :param train_config: the train config, with world_size and dist_url
+    :param rank: the rank of this process, from 0 to world_size - 1
+    :return: None
+    """
+    dist.init_process_group('gloo', init_method=train_config['dist_url'], world_size=train_config['world_size'],
+                            rank=rank)
+    torch.manual_seed(torch.initial_seed() + rank)
+
+
+def is_distributed(train_config):
+    """Whether training is split across several worker processes."""
+    return train_config['world_size'] > 1
+
+
+def is_master(train_config):
+    """Whether this is the first worker process, which logs and saves checkpoints, or the only process."""
+    return not is_distributed(train_config) or dist.get_rank() == 0
+
+
+def reseed_for_rank(train_config):
+    """
+    Reseeds the random number generators of the workers other than the first after they are restored from a
+    checkpoint, which holds the first worker's states. The seed is drawn from the restored state and offset by
+    the rank, as in init_distributed, so that the workers again draw different samples and binarizations,
+    and do so reproducibly when resuming.
+    :param train_config: the train config
+    :return: None
+    """
+    if not is_distributed(train_config) or dist.get_rank() == 0:
+        return
+    seed = np.random.randint(2 ** 30) + dist.get_rank()
+    torch.manual_seed(seed)
+    np.random.seed(seed)
+    random.seed(seed)
+
+
+def broadcast_parameters(model, train_config):
+    """
+    Copies the parameters and buffers (batch norm running statistics) of the first worker to all workers,
+    so that they start equal. The tensors are sent in the order of their names, which is the same on all workers.
+    :param model: the model
+    :param train_config: the train config
+    :return: None
+    """
+    if not is_distributed(train_config):
+        return
+    state_dict = model.state_dict()
+    for name in sorted(state_dict.keys()):
+        dist.broadcast(state_dict[name], 0)
+
+
+def all_reduce_gradients(params, train_config):
+    """
+    Averages the gradients of a set of parameters across the workers, with a single all-reduce over a
+    flattened copy. Called by every worker before the same optimizer step, so that the workers stay equal.
+    :param params: list of parameters, as given by encoder_parameters or decoder_parameters
+    :param train_config: the train config
+    :return: None
+    """
+    if not is_distributed(train_config):
+        return
+    grads = [param.grad.data for param in params if param.grad is not None]
+    if len(grads) == 0:
+        return
+    flat_grads = torch.cat([grad.contiguous().view(-1) for grad in grads])
+    dist.all_reduce(flat_grads)
+    flat_grads /= train_config['world_size']
+    offset = 0
+    for grad in grads:
+        grad.copy_(flat_grads[offset:offset + grad.numel()].view_as(grad))
+        offset += grad.numel()
+
+
+def average_across_workers(values, train_config):
+    """
+    Averages metrics across the workers.
+    :param values: list of floats
+    :param train_config: the train config
+    :return: array of the averaged values
+    """
+    values = np.array(values, dtype=float)
+    if not is_distributed(train_config):
+        return values
+    values = torch.from_numpy(values).float()
+    dist.all_reduce(values)
+    return values.numpy().astype(float) / train_config['world_size']
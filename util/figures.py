@@ -0,0 +1,274 @@
+import os
+import json
+import cPickle as pickle
+import numpy as np
+from multiprocessing import Pool
+
+from logs import read_metric, vis_store_file
+from vis_store import VisualizationStore
+
+
+def image_grid(images, n_columns=None):
+    """
+    Tiles images into a grid.
+    :param images: array of size (n_images x height x width x channels), channels-last as in the data loaders
+    :param n_columns: the number of columns, square if not given
+    :return: array of size (grid height x grid width x channels), with values in [0, 1]
+    """
+    n_images, height, width, n_channels = images.shape
+    if n_columns is None:
+        n_columns = int(np.ceil(np.sqrt(n_images)))
+    n_rows = int(np.ceil(n_images * 1. / n_columns))
+    grid = np.ones((n_rows * (height + 1) - 1, n_columns * (width + 1) - 1, n_channels))
+    for index in range(n_images):
+        row, column = index // n_columns, index % n_columns
+        grid[row * (height + 1):row * (height + 1) + height, column * (width + 1):column * (width + 1) + width] = \
+            np.clip(images[index], 0., 255.) / 255.
+    return grid
+
+
+def save_image_grid(images, file_name, n_columns=None):
+    """Saves images tiled into a grid to an image file."""
+    import matplotlib.pyplot as plt
+    grid = image_grid(images, n_columns)
+    if grid.shape[-1] == 1:
+        plt.imsave(file_name, grid[:, :, 0], cmap='gray', vmin=0., vmax=1.)
+    else:
+        plt.imsave(file_name, grid)
+
+
+def save_curves(curves, file_name, title='', xlabel='', ylabel='', log_scale=False):
+    """
+    Saves line plots to an image file.
+    :param curves: list of (x, y, label)
+    """
+    import matplotlib.pyplot as plt
+    figure = plt.figure(figsize=(6, 4))
+    for x, y, label in curves:
+        plt.plot(x, y, label=label)
+    if log_scale:
+        plt.xscale('log')
+        plt.yscale('symlog')
+    plt.title(title)
+    plt.xlabel(xlabel)
+    plt.ylabel(ylabel)
+    plt.legend(fontsize='small')
+    figure.tight_layout()
+    figure.savefig(file_name)
+    plt.close(figure)
+
+
+def save_heatmap(values, file_name, title=''):
+    """Saves a matrix as a heatmap to an image file."""
+    import matplotlib.pyplot as plt
+    figure = plt.figure(figsize=(5, 4))
+    plt.imshow(values, cmap='viridis', interpolation='nearest')
+    plt.colorbar()
+    plt.title(title)
+    figure.tight_layout()
+    figure.savefig(file_name)
+    plt.close(figure)
+
+
+def render_metrics(metric_path, figure_path, figure_format):
+    """Renders the train and validation metric curves over epochs, as in initialize_plots."""
+    names = sorted(file_name[:-len('.metric')] for file_name in os.listdir(metric_path) if file_name.endswith('.metric'))
+    series = dict((name, read_metric(metric_path, name)) for name in names)
+    for metric, title, sign in [('elbo', 'ELBO', -1.), ('cond_log_like', 'Conditional Log Likelihood', -1.),
+                                ('kl_level', 'KL Divergence', 1.)]:
+        curves = []
+        for name in names:
+            mode, _, metric_name = name.partition('_')
+            if metric_name.startswith(metric) and len(series[name]) > 0:
+                label = 'Train' if mode == 'train' else 'Validation'
+                if metric == 'kl_level':
+                    label += ', Level ' + metric_name.split('_')[-1]
+                curves.append((series[name]['epoch'], sign * series[name]['value'], label))
+        if len(curves) > 0:
+            save_curves(curves, os.path.join(figure_path, metric + '.' + figure_format), title=title,
+                        xlabel='Epochs', ylabel=('-' if sign < 0 else '') + title + ' (Nats)', log_scale=True)
+
+
+def pickle_loader(epoch_path, data_file):
+    """Gets a function loading the visualizations of an epoch dumped as pickles, before the visualization store."""
+    def load(name):
+        if name == 'data':
+            return pickle.load(open(data_file, 'r')) if data_file is not None else None
+        if name.startswith('posterior_level_'):
+            posterior = load('posterior')
+            level = int(name.split('_')[-1])
+            return posterior[level] if posterior is not None and level < len(posterior) else None
+        file_name = os.path.join(epoch_path, name + '.p')
+        return pickle.load(open(file_name, 'r')) if os.path.exists(file_name) else None
+    return load
+
+
+def store_loader(store, epoch):
+    """Gets a function loading the visualizations of an epoch from a VisualizationStore."""
+    def load(name):
+        if name not in store.names():
+            return None
+        return store.read(name, None if name in ['data', 'labels'] else epoch).astype(float)
+    return load
+
+
+def render_epoch(source, epoch, data_file, figure_path, figure_format):
+    """
+    Renders the visualizations logged by log_vis for an epoch: reconstructions, samples, reconstructions and
+    errors over inference iterations, metrics over inference iterations, and posterior covariance matrices.
+    :param source: the visualization store file, or the epoch directory of pickles of older experiments
+    :param epoch: the epoch
+    :param data_file: the pickled data batch of older experiments, None with the store
+    """
+    store = None
+    if os.path.isdir(source):
+        load = pickle_loader(source, data_file)
+    else:
+        store = VisualizationStore(source, 'r')
+        load = store_loader(store, epoch)
+    try:
+        render_loaded_epoch(load, str(epoch), figure_path, figure_format)
+    finally:
+        if store is not None:
+            store.close()
+
+
+def render_loaded_epoch(load, epoch, figure_path, figure_format):
+    extension = '.' + figure_format
+    reconstructions = load('reconstructions')
+    save_image_grid(reconstructions[:, -1], os.path.join(figure_path, 'reconstructions' + extension))
+    save_image_grid(load('samples'), os.path.join(figure_path, 'samples' + extension))
+
+    n_iterations = reconstructions.shape[1]
+    if n_iterations > 1:
+        # one row per example, one column per inference iteration
+        save_image_grid(reconstructions.reshape([-1] + list(reconstructions.shape[2:])),
+                        os.path.join(figure_path, 'reconstructions_over_iterations' + extension), n_columns=n_iterations)
+        data = load('data')
+        if data is not None:
+            errors = np.expand_dims(data[:reconstructions.shape[0]], 1) - reconstructions
+            # shifted so that zero error is mid-gray
+            save_image_grid(((errors + 255.) / 2.).reshape([-1] + list(reconstructions.shape[2:])),
+                            os.path.join(figure_path, 'errors_over_iterations' + extension), n_columns=n_iterations)
+        iterations = np.arange(n_iterations)
+        curves = [(iterations, load('elbo').mean(axis=0), 'ELBO'),
+                  (iterations, load('cond_log_like').mean(axis=0), 'log p(x | z)')]
+        level = 0
+        kl = load('kl_level_0')
+        while kl is not None:
+            curves.append((iterations, kl.mean(axis=0), 'KL Divergence, Level ' + str(level)))
+            level += 1
+            kl = load('kl_level_' + str(level))
+        save_curves(curves, os.path.join(figure_path, 'metrics_over_iterations' + extension),
+                    title='Average Metrics During Inference Iterations, Epoch ' + epoch,
+                    xlabel='Inference Iterations', ylabel='Metrics (Nats)')
+
+    level = 0
+    posterior = load('posterior_level_0')
+    while posterior is not None:
+        # posterior mean at the first inference iteration, as in plot_latent_covariance_matrix
+        posterior_mean = posterior[:, 1, 0]
+        posterior_mean_centered = posterior_mean - np.mean(posterior_mean, axis=0)
+        covariance = np.dot(posterior_mean_centered.T, posterior_mean_centered) / posterior_mean_centered.shape[0]
+        save_heatmap(covariance, os.path.join(figure_path, 'covariance_level_' + str(level) + extension),
+                     title='Posterior Covariance, Epoch ' + epoch + ', Level ' + str(level))
+        level += 1
+        posterior = load('posterior_level_' + str(level))
+
+
+def render_job(job):
+    """Runs a rendering job in a worker process, returning an error message if it fails."""
+    import matplotlib
+    matplotlib.use('Agg')
+    render_func, args = job
+    try:
+        if not os.path.exists(args[-2]):
+            os.makedirs(args[-2])
+        globals()[render_func](*args)
+        return None
+    except Exception as error:
+        return render_func + ' ' + str(args[0]) + ': ' + str(error)
+
+
+def source_signature(path):
+    """Gets the (name, size, modification time) of the files under a directory, which change when it is rewritten."""
+    signature = []
+    for file_name in sorted(os.listdir(path)):
+        if os.path.isfile(os.path.join(path, file_name)):
+            stat = os.stat(os.path.join(path, file_name))
+            signature.append([file_name, stat.st_size, stat.st_mtime])
+    return signature
+
+
+def experiment_paths(log_path):
+    """Gets the experiment directories under log_path, or log_path itself if it is an experiment."""
+    if os.path.isdir(os.path.join(log_path, 'metrics')):
+        return [log_path]
+    return [os.path.join(log_path, name) for name in sorted(os.listdir(log_path))
+            if os.path.isdir(os.path.join(log_path, name, 'metrics'))]
+
+
+def render(log_path, n_processes=4, figure_format='png'):
+    """
+    Renders figures of the logged metrics and visualizations of an experiment, or of all experiments in a log root,
+    to figures/ in each experiment directory. Only the metrics and epochs whose logged data changed since the last
+    render are rendered again, as recorded in figures/manifest.json.
+    :param log_path: an experiment directory, or a directory of experiments
+    :param n_processes: the number of rendering processes
+    :param figure_format: 'png' or 'svg'
+    :return: the number of rendered figure sets
+    """
+    jobs = []
+    manifests = dict()
+    for experiment_path in experiment_paths(log_path):
+        figure_root = os.path.join(experiment_path, 'figures')
+        manifest_file = os.path.join(figure_root, 'manifest.json')
+        manifest = json.load(open(manifest_file, 'r')) if os.path.exists(manifest_file) else dict()
+        manifests[manifest_file] = manifest
+
+        jobs_experiment = [('metrics', ('render_metrics', (os.path.join(experiment_path, 'metrics'), figure_root, figure_format)),
+                            [figure_format, source_signature(os.path.join(experiment_path, 'metrics'))])]
+        vis_path = os.path.join(experiment_path, 'visualizations')
+        data_file = os.path.join(vis_path, 'batch_data.p')
+        data_file = data_file if os.path.exists(data_file) else None
+        if os.path.isdir(vis_path):
+            for name in sorted(os.listdir(vis_path)):
+                if name.startswith('epoch_') and os.path.isdir(os.path.join(vis_path, name)):
+                    epoch = int(name.split('_')[-1])
+                    job = ('render_epoch', (os.path.join(vis_path, name), epoch, data_file,
+                                            os.path.join(figure_root, name), figure_format))
+                    jobs_experiment.append((name, job, [figure_format, source_signature(os.path.join(vis_path, name))]))
+        store_file = vis_store_file(experiment_path)
+        if os.path.exists(store_file):
+            try:
+                store = VisualizationStore(store_file, 'r')
+                write_times = [(epoch, store.write_time(epoch)) for epoch in store.epochs()]
+                store.close()
+            except (IOError, OSError, KeyError):
+                # being written by the training process, rendered on a later call
+                write_times = []
+            for epoch, write_time in write_times:
+                name = 'epoch_' + str(epoch)
+                job = ('render_epoch', (store_file, epoch, None, os.path.join(figure_root, name), figure_format))
+                jobs_experiment.append((name, job, [figure_format, write_time]))
+
+        for key, job, signature in jobs_experiment:
+            if manifest.get(key) != signature:
+                jobs.append((job, manifest, key, signature))
+
+    if len(jobs) > 0:
+        pool = Pool(n_processes)
+        errors = pool.map(render_job, [job for job, _, _, _ in jobs])
+        pool.close()
+        pool.join()
+        for (_, manifest, key, signature), error in zip(jobs, errors):
+            if error is None:
+                manifest[key] = signature
+            else:
+                print 'Rendering failed: ' + error
+
+    for manifest_file, manifest in manifests.items():
+        if not os.path.exists(os.path.dirname(manifest_file)):
+            os.makedirs(os.path.dirname(manifest_file))
+        json.dump(manifest, open(manifest_file, 'w'))
+    return len(jobs)
@@ -1,4 +1,8 @@
 import os
+import atexit
+import random
+import threading
+import Queue
 import numpy as np
 import cPickle as pickle
 import dill
@@ -6,17 +10,26 @@ import torch
 from time import strftime
 
 from cfg.config import arch
+from vis_store import VisualizationStore
 
 global log_path
 
+# background writer of the checkpoints of this experiment, see CheckpointWriter
+checkpoint_writer = None
+
+# writer of the metric series of this experiment, see MetricWriter
+metric_writer = None
+
 
 def init_log(log_root, train_config):
     # load/create log directory, format: day_month_year_hour_minutes_seconds
-    global log_path
+    global log_path, checkpoint_writer, metric_writer
 
     if train_config['resume_experiment'] != '' and train_config['resume_experiment'] is not None:
         if os.path.exists(os.path.join(log_root, train_config['resume_experiment'])):
             log_path = os.path.join(log_root, train_config['resume_experiment'])
+            checkpoint_writer = CheckpointWriter(os.path.join(log_path, 'checkpoints'), train_config['n_checkpoints'])
+            metric_writer = MetricWriter(os.path.join(log_path, 'metrics'))
             return log_path, train_config['resume_experiment']
         else:
             raise Exception('Experiment folder ' + train_config['resume_experiment'] + ' not found.')
@@ -28,16 +41,72 @@ def init_log(log_root, train_config):
     os.makedirs(os.path.join(log_path, 'metrics'))
     os.makedirs(os.path.join(log_path, 'visualizations'))
     os.makedirs(os.path.join(log_path, 'checkpoints'))
+    checkpoint_writer = CheckpointWriter(os.path.join(log_path, 'checkpoints'), train_config['n_checkpoints'])
+    metric_writer = MetricWriter(os.path.join(log_path, 'metrics'))
     return log_path, log_dir
 
 
-def update_metric(file_name, value):
-    if os.path.exists(file_name):
-        metric = pickle.load(open(file_name, 'r'))
-        metric.append(value)
-        pickle.dump(metric, open(file_name, 'w'))
-    else:
-        pickle.dump([value], open(file_name, 'w'))
+# fixed-width record of a metric series
+metric_record = np.dtype([('epoch', '<i8'), ('value', '<f8')])
+
+
+def metric_file(metric_path, name):
+    return os.path.join(metric_path, name + '.metric')
+
+
+class MetricWriter(object):
+
+    """
+    Writes metric series as (epoch, value) records of fixed width (metric_record), one file per series in
+    the metrics directory, named <name>.metric. Records are buffered in memory and appended to the files on
+    flush, so each epoch only writes its new records. A crash loses at most the buffered records; a record
+    cut short by a crash during a flush is ignored by read_metric and overwritten by the next flush.
+    """
+
+    def __init__(self, metric_path):
+        self.metric_path = metric_path
+        self.buffers = dict()
+
+    def append(self, name, epoch, value):
+        """
+        Buffers a record of a metric series.
+        :param name: the name of the series, for instance 'train_elbo'
+        :param epoch: the epoch
+        :param value: the value of the metric, a float
+        :return: None
+        """
+        if name not in self.buffers:
+            self.buffers[name] = []
+        self.buffers[name].append((epoch, value))
+
+    def flush(self):
+        """Appends the buffered records to the files of their series."""
+        for name, records in self.buffers.items():
+            file_name = metric_file(self.metric_path, name)
+            if not os.path.exists(file_name) and os.path.exists(os.path.join(self.metric_path, name + '.p')):
+                # continue the series of an experiment logged as a pickled list
+                records = pickle.load(open(os.path.join(self.metric_path, name + '.p'), 'r')) + records
+            size = os.path.getsize(file_name) if os.path.exists(file_name) else 0
+            with open(file_name, 'r+b' if size > 0 else 'wb') as metric_output:
+                # overwrite a partial record, left by a crash during a flush
+                metric_output.seek(size - size % metric_record.itemsize)
+                metric_output.truncate()
+                metric_output.write(np.array(records, dtype=metric_record).tobytes())
+        self.buffers = dict()
+
+
+def read_metric(metric_path, name):
+    """
+    Memory-maps a metric series written by MetricWriter, without reading the file.
+    :param metric_path: the metrics directory of an experiment
+    :param name: the name of the series, for instance 'val_elbo'
+    :return: read-only array of metric_record, with fields 'epoch' and 'value'
+    """
+    file_name = metric_file(metric_path, name)
+    n_records = os.path.getsize(file_name) // metric_record.itemsize
+    if n_records == 0:
+        return np.zeros(0, dtype=metric_record)
+    return np.memmap(file_name, dtype=metric_record, mode='r', shape=(n_records,))
 
 
 def log_train(func):
@@ -46,55 +115,62 @@ def log_train(func):
 
     def log_func(model, train_config, arch, data, epoch, optimizers):
         output_dict = func(model, train_config, arch, data, epoch, optimizers)
-        update_metric(os.path.join(log_path, 'metrics', 'train_elbo.p'), (epoch, output_dict['avg_elbo']))
-        update_metric(os.path.join(log_path, 'metrics', 'train_cond_log_like.p'), (epoch, output_dict['avg_cond_log_like']))
+        metric_writer.append('train_elbo', epoch, output_dict['avg_elbo'])
+        metric_writer.append('train_cond_log_like', epoch, output_dict['avg_cond_log_like'])
         for level in range(len(model.levels)):
-            update_metric(os.path.join(log_path, 'metrics', 'train_kl_level_' + str(level) + '.p'), (epoch, output_dict['avg_kl'][level]))
+            metric_writer.append('train_kl_level_' + str(level), epoch, output_dict['avg_kl'][level])
+        metric_writer.flush()
         return output_dict
 
     return log_func
 
 
+def vis_store_file(experiment_path):
+    """Gets the file of the visualization store of an experiment, see VisualizationStore."""
+    return os.path.join(experiment_path, 'visualizations', 'visualizations.h5')
+
+
 def log_vis(func):
     """Wrapper to log metrics and visualizations."""
     global log_path
 
     def log_func(model, train_config, arch, data_loader, epoch, vis=False, eval=False):
         output_dict = func(model, train_config, arch, data_loader, vis=vis, eval=eval)
-        update_metric(os.path.join(log_path, 'metrics', 'val_elbo.p'), (epoch, np.mean(output_dict['total_elbo'][:, -1], axis=0)))
-        update_metric(os.path.join(log_path, 'metrics', 'val_cond_log_like.p'), (epoch, np.mean(output_dict['total_cond_log_like'][:, -1], axis=0)))
+        metric_writer.append('val_elbo', epoch, np.mean(output_dict['total_elbo'][:, -1], axis=0))
+        metric_writer.append('val_cond_log_like', epoch, np.mean(output_dict['total_cond_log_like'][:, -1], axis=0))
         for level in range(len(model.levels)):
-            update_metric(os.path.join(log_path, 'metrics', 'val_kl_level_' + str(level) + '.p'), (epoch, np.mean(output_dict['total_kl'][level][:, -1], axis=0)))
+            metric_writer.append('val_kl_level_' + str(level), epoch, np.mean(output_dict['total_kl'][level][:, -1], axis=0))
+        metric_writer.flush()
 
         if vis:
-            epoch_path = os.path.join(log_path, 'visualizations', 'epoch_' + str(epoch))
-            if not os.path.exists(epoch_path):
-                os.makedirs(epoch_path)
+            vis_path = os.path.join(log_path, 'visualizations')
+            if not os.path.exists(vis_path):
+                os.makedirs(vis_path)
 
             batch_size = train_config['batch_size']
             n_iterations = train_config['n_iterations']
             batch, labels = next(iter(data_loader))
-            if epoch == train_config['display_iter']:
-                # save the data on the first display iteration
-                pickle.dump(batch.numpy(), open(os.path.join(log_path, 'visualizations', 'batch_data.p'), 'w'))
-                pickle.dump(labels.numpy(), open(os.path.join(log_path, 'visualizations', 'batch_labels.p'), 'w'))
             data_shape = list(batch.size())[1:]
 
-            pickle.dump(output_dict['total_elbo'][:batch_size], open(os.path.join(epoch_path, 'elbo.p'), 'w'))
-            pickle.dump(output_dict['total_cond_log_like'][:batch_size], open(os.path.join(epoch_path, 'cond_log_like.p'), 'w'))
+            arrays = dict()
+            arrays['elbo'] = output_dict['total_elbo'][:batch_size]
+            arrays['cond_log_like'] = output_dict['total_cond_log_like'][:batch_size]
             for level in range(len(model.levels)):
-                pickle.dump(output_dict['total_kl'][level][:batch_size], open(os.path.join(epoch_path, 'kl_level_' + str(level) + '.p'), 'w'))
-
-            pickle.dump(output_dict['total_posterior'][:batch_size], open(os.path.join(epoch_path, 'posterior.p'), 'w'))
-            pickle.dump(output_dict['total_prior'][:batch_size], open(os.path.join(epoch_path, 'prior.p'), 'w'))
-            recon = output_dict['total_recon'][:batch_size, :].reshape([batch_size, n_iterations+1]+data_shape)
-            pickle.dump(recon, open(os.path.join(epoch_path, 'reconstructions.p'), 'w'))
-
-            samples = output_dict['samples'].reshape([batch_size]+data_shape)
-            pickle.dump(samples, open(os.path.join(epoch_path, 'samples.p'), 'w'))
-
+                arrays['kl_level_' + str(level)] = output_dict['total_kl'][level][:batch_size]
+                arrays['posterior_level_' + str(level)] = output_dict['total_posterior'][level][:batch_size]
+                arrays['prior_level_' + str(level)] = output_dict['total_prior'][level][:batch_size]
+            arrays['reconstructions'] = output_dict['total_recon'][:batch_size, :].reshape([batch_size, n_iterations+1]+data_shape)
+            arrays['samples'] = output_dict['samples'].reshape([batch_size]+data_shape)
             if arch['n_latent'][0] == 2 and len(arch['n_latent']) == 1:
-                pickle.dump(output_dict['optimization_surface'], open(os.path.join(epoch_path, 'optimization_surface.p'), 'w'))
+                for name, surface in output_dict['optimization_surface'].items():
+                    arrays['optimization_surface_' + name] = surface
+
+            store = VisualizationStore(vis_store_file(log_path), 'a')
+            # the data batch is the same every display iteration, stored once
+            store.write_constant('data', batch.numpy())
+            store.write_constant('labels', labels.numpy())
+            store.append(epoch, arrays)
+            store.close()
 
         if eval:
             eval_epoch_path = os.path.join(log_path, 'metrics', 'epoch_' + str(epoch))
@@ -107,10 +183,198 @@ def log_vis(func):
     return log_func
 
 
-def save_checkpoint(model, opt, epoch):
-    global log_path
-    torch.save(model, os.path.join(log_path, 'checkpoints', 'epoch_'+str(epoch)+'_model.ckpt'), pickle_module=dill)
-    torch.save(tuple(opt), os.path.join(log_path, 'checkpoints', 'epoch_'+str(epoch)+'_opt.ckpt'))
+def snapshot(state):
+    """
+    Copies the tensors of a (nested) state dict to the CPU, so that training can go on while it is written.
+    :param state: tensor or array, or dict, list, or tuple of tensors, arrays, and other values
+    :return: the copied state
+    """
+    if torch.is_tensor(state):
+        return state.cpu() if state.is_cuda else state.clone()
+    if isinstance(state, np.ndarray):
+        return state.copy()
+    if isinstance(state, dict):
+        return {key: snapshot(value) for key, value in state.items()}
+    if isinstance(state, (list, tuple)):
+        return type(state)(snapshot(value) for value in state)
+    return state
+
+
+def rng_state(cuda_device):
+    """Gets the states of the torch, numpy, and python random number generators."""
+    state = {'torch': torch.get_rng_state(), 'numpy': np.random.get_state(), 'random': random.getstate()}
+    if cuda_device is not None:
+        state['cuda'] = torch.cuda.get_rng_state(cuda_device)
+    return state
+
+
+def set_rng_state(state, cuda_device):
+    """Sets the states of the random number generators, as given by rng_state."""
+    torch.set_rng_state(state['torch'])
+    np.random.set_state(state['numpy'])
+    random.setstate(state['random'])
+    if cuda_device is not None and 'cuda' in state:
+        torch.cuda.set_rng_state(state['cuda'], cuda_device)
+
+
+def checkpoint_file(checkpoint_path, epoch):
+    return os.path.join(checkpoint_path, 'epoch_' + str(epoch) + '.ckpt')
+
+
+def step_checkpoint_file(checkpoint_path):
+    return os.path.join(checkpoint_path, 'step.ckpt')
+
+
+def atomic_save(obj, file_name):
+    """Saves to a temporary file in the same directory, then renames it, so the file is never partly written."""
+    temp_file_name = os.path.join(os.path.dirname(file_name), '.' + os.path.basename(file_name) + '.tmp')
+    with open(temp_file_name, 'wb') as temp_file:
+        torch.save(obj, temp_file)
+        temp_file.flush()
+        os.fsync(temp_file.fileno())
+    os.rename(temp_file_name, file_name)
+
+
+class CheckpointWriter(object):
+
+    """
+    Writes checkpoints on a background thread. Each write of an epoch checkpoint keeps the n_checkpoints most
+    recent epoch checkpoints, plus the one with the highest metric (validation ELBO), and removes the others.
+    The metric of each kept checkpoint is recorded in index.p in the checkpoint directory. Step checkpoints,
+    taken part way through an epoch, replace the previous one.
+    """
+
+    def __init__(self, checkpoint_path, n_checkpoints):
+        self.checkpoint_path = checkpoint_path
+        self.n_checkpoints = n_checkpoints
+        self.index_file = os.path.join(checkpoint_path, 'index.p')
+        self.metrics = pickle.load(open(self.index_file, 'r')) if os.path.exists(self.index_file) else dict()
+        self.error = None
+        # holds at most one pending checkpoint, so that at most two snapshots are in memory
+        self.queue = Queue.Queue(maxsize=1)
+        self.thread = threading.Thread(target=self._write_loop)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def write(self, checkpoint, epoch, metric=None):
+        """
+        Queues a checkpoint to be written, waiting if the previous one is still being written.
+        :param checkpoint: dict of CPU tensors and values, see snapshot
+        :param epoch: the epoch of the checkpoint
+        :param metric: the metric used to keep the best checkpoint (higher is better), None if not measured
+        :return: None
+        """
+        self.raise_error()
+        self.queue.put((checkpoint, checkpoint_file(self.checkpoint_path, epoch), epoch, metric))
+
+    def write_step(self, checkpoint):
+        """
+        Queues a step checkpoint to be written, replacing the previous one.
+        :param checkpoint: dict of CPU tensors and values, see snapshot
+        :return: None
+        """
+        self.raise_error()
+        self.queue.put((checkpoint, step_checkpoint_file(self.checkpoint_path), None, None))
+
+    def wait(self):
+        """Waits for the queued checkpoints to be written."""
+        self.queue.join()
+        self.raise_error()
+
+    def close(self):
+        """Waits for the queued checkpoints to be written, then stops the background thread."""
+        self.queue.put(None)
+        self.thread.join()
+        self.raise_error()
+
+    def raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise Exception('Checkpoint could not be written: ' + str(error))
+
+    def _write_loop(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                break
+            checkpoint, file_name, epoch, metric = item
+            try:
+                atomic_save(checkpoint, file_name)
+                if epoch is not None:
+                    self.metrics[epoch] = metric
+                    self.remove_old_checkpoints()
+            except Exception as error:
+                self.error = error
+            finally:
+                self.queue.task_done()
+
+    def remove_old_checkpoints(self):
+        epochs = sorted(self.metrics.keys())
+        keep = set(epochs[-self.n_checkpoints:])
+        measured = [epoch for epoch in epochs if self.metrics[epoch] is not None]
+        if len(measured) > 0:
+            keep.add(max(measured, key=lambda epoch: self.metrics[epoch]))
+        for epoch in epochs:
+            if epoch not in keep:
+                del self.metrics[epoch]
+        # record the kept checkpoints before removing, so that the index never lists a missing file
+        temp_index_file = os.path.join(self.checkpoint_path, '.index.p.tmp')
+        pickle.dump(self.metrics, open(temp_index_file, 'w'))
+        os.rename(temp_index_file, self.index_file)
+        for epoch in epochs:
+            if epoch not in keep and os.path.exists(checkpoint_file(self.checkpoint_path, epoch)):
+                os.remove(checkpoint_file(self.checkpoint_path, epoch))
+
+
+def save_checkpoint(model, optimizers, schedulers, epoch, cuda_device, metric=None):
+    """
+    Saves a checkpoint of the model parameters and buffers, optimizer states, scheduler states, random number
+    generator states, and epoch. The state is copied to the CPU here and written on a background thread.
+    :param model: the model
+    :param optimizers: tuple of (encoder optimizer, decoder optimizer)
+    :param schedulers: tuple of (encoder scheduler, decoder scheduler)
+    :param epoch: the epoch
+    :param cuda_device: the GPU of the model, None for the CPU
+    :param metric: the validation ELBO, used to keep the best checkpoint
+    :return: None
+    """
+    scheduler_states = [{key: value for key, value in scheduler.__dict__.items() if key != 'optimizer'}
+                        for scheduler in schedulers]
+    checkpoint = {'epoch': epoch,
+                  'model': snapshot(model.state_dict()),
+                  'optimizers': [snapshot(optimizer.state_dict()) for optimizer in optimizers],
+                  'schedulers': snapshot(scheduler_states),
+                  'rng_state': rng_state(cuda_device)}
+    checkpoint_writer.write(checkpoint, epoch, metric)
+
+
+def save_step_checkpoint(model, optimizers, epoch, train_state, cuda_device):
+    """
+    Saves a checkpoint part way through an epoch, from which training resumes at the next batch. Only the
+    most recent step checkpoint is kept. It has the model, optimizer, and random number generator states,
+    as in save_checkpoint, and the state of the partially trained epoch.
+    :param model: the model
+    :param optimizers: tuple of (encoder optimizer, decoder optimizer)
+    :param epoch: the epoch being trained, numbered from 1 as in train_val.train_epoch
+    :param train_state: dict of the state of the epoch, see train_val.train_epoch
+    :param cuda_device: the GPU of the model, None for the CPU
+    :return: None
+    """
+    # the epoch of a checkpoint is the last one completed, numbered from 0 as in save_checkpoint
+    checkpoint = {'epoch': epoch - 2,
+                  'model': snapshot(model.state_dict()),
+                  'optimizers': [snapshot(optimizer.state_dict()) for optimizer in optimizers],
+                  'rng_state': rng_state(cuda_device),
+                  'train_state': snapshot(train_state)}
+    checkpoint_writer.write_step(checkpoint)
+
+
+@atexit.register
+def wait_for_checkpoints():
+    """Waits for the pending checkpoint writes, called on exit."""
+    if checkpoint_writer is not None:
+        checkpoint_writer.close()
 
 
 def get_last_epoch():
@@ -119,16 +383,82 @@ def get_last_epoch():
     for r, d, f in os.walk(os.path.join(log_path, 'checkpoints')):
         for ckpt_file_name in f:
             if ckpt_file_name[0] == 'e':
-                epoch = int(ckpt_file_name.split('_')[1])
+                # epoch_<epoch>.ckpt, or epoch_<epoch>_model.ckpt and epoch_<epoch>_opt.ckpt for pickled checkpoints
+                epoch = int(ckpt_file_name.split('.')[0].split('_')[1])
                 if epoch > last_epoch:
                     last_epoch = epoch
     return last_epoch
 
 
-def load_opt_checkpoint(epoch=-1):
+# (file name, checkpoint) of the last loaded checkpoint, which is loaded for both the model and the optimizers
+_loaded_checkpoint = (None, None)
+
+
+def load_checkpoint(epoch=-1):
+    """
+    Loads a checkpoint saved by save_checkpoint or save_step_checkpoint, with all tensors on the CPU.
+    :param epoch: the epoch of the checkpoint, -1 for the last, which is the step checkpoint if it is
+                  part way through the epoch after the last epoch checkpoint
+    :return: dict of the checkpoint, None if the experiment only has pickled model and optimizer checkpoints
+    """
+    global _loaded_checkpoint
+    if epoch == -1:
+        epoch = get_last_epoch()
+        file_name = step_checkpoint_file(os.path.join(log_path, 'checkpoints'))
+        if os.path.exists(file_name):
+            if _loaded_checkpoint[0] != file_name:
+                _loaded_checkpoint = (file_name, torch.load(file_name, map_location=device_map_location(None)))
+            if _loaded_checkpoint[1]['epoch'] >= epoch:
+                return _loaded_checkpoint[1]
+    file_name = checkpoint_file(os.path.join(log_path, 'checkpoints'), epoch)
+    if not os.path.exists(file_name):
+        return None
+    if _loaded_checkpoint[0] != file_name:
+        _loaded_checkpoint = (file_name, torch.load(file_name, map_location=device_map_location(None)))
+    return _loaded_checkpoint[1]
+
+
+def restore_rng_state(cuda_device, epoch=-1):
+    """Restores the random number generator states from a checkpoint, if it has them."""
+    checkpoint = load_checkpoint(epoch)
+    if checkpoint is not None:
+        set_rng_state(checkpoint['rng_state'], cuda_device)
+
+
+# whether the state of a partially trained epoch has been taken from the resumed step checkpoint
+_train_state_taken = False
+
+
+def resumed_train_state(epoch):
+    """
+    Gets the state of the partially trained epoch of the resumed step checkpoint, on the first call only.
+    :param epoch: the epoch about to be trained
+    :return: dict of the state of the epoch, with the random number generator states, None if not resuming
+             part way through this epoch
+    """
+    global _train_state_taken
+    if _train_state_taken or checkpoint_writer is None:
+        return None
+    _train_state_taken = True
+    checkpoint = load_checkpoint()
+    if checkpoint is None or 'train_state' not in checkpoint or checkpoint['train_state']['epoch'] != epoch:
+        return None
+    return dict(checkpoint['train_state'], rng_state=checkpoint['rng_state'])
+
+
+def device_map_location(cuda_device):
+    """Maps checkpoint storages onto the given GPU, or onto the CPU if cuda_device is None."""
+    if cuda_device is None:
+        return lambda storage, location: storage
+    return {'cuda:0': 'cuda:' + str(cuda_device), 'cuda:1': 'cuda:' + str(cuda_device),
+            'cpu': 'cuda:' + str(cuda_device)}
+
+
+def load_opt_checkpoint(epoch=-1, cuda_device=0):
     if epoch == -1:
         epoch = get_last_epoch()
-    enc_opt, dec_opt = torch.load(os.path.join(log_path, 'checkpoints', 'epoch_'+str(epoch)+'_opt.ckpt'))
+    enc_opt, dec_opt = torch.load(os.path.join(log_path, 'checkpoints', 'epoch_'+str(epoch)+'_opt.ckpt'),
+                                  map_location=device_map_location(cuda_device))
     return enc_opt, dec_opt, epoch
 
 
@@ -136,5 +466,4 @@ def load_model_checkpoint(epoch=-1, cuda_device=0):
     if epoch == -1:
         epoch = get_last_epoch()
     return torch.load(os.path.join(log_path, 'checkpoints', 'epoch_'+str(epoch)+'_model.ckpt'),
-                      map_location={'cuda:0': 'cuda:' + str(cuda_device), 'cuda:1': 'cuda:' + str(cuda_device),
-                                    'cpu': 'cuda:' + str(cuda_device)})
+                      map_location=device_map_location(cuda_device))
@@ -0,0 +1,154 @@
+import os
+import torch
+
+from timing import PhaseTimer
+
+megabyte = 1024. * 1024.
+
+
+def host_memory():
+    """
+    Gets the resident set size of this process and its peak, from /proc (Linux).
+    :return: (rss, peak rss) in bytes, or (None, None) if not available
+    """
+    if not os.path.exists('/proc/self/status'):
+        return None, None
+    rss = peak_rss = None
+    with open('/proc/self/status', 'r') as status:
+        for line in status:
+            if line.startswith('VmRSS:'):
+                rss = int(line.split()[1]) * 1024
+            elif line.startswith('VmHWM:'):
+                peak_rss = int(line.split()[1]) * 1024
+    return rss, peak_rss
+
+
+def reset_host_peak():
+    """Resets the peak resident set size of this process to its current size, where the kernel allows it."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+    except (IOError, OSError):
+        pass
+
+
+class DeviceMemory(object):
+    """
+    Samples the GPU memory of this process: the memory allocated to tensors, from the torch allocator if it
+    keeps statistics (torch.cuda.memory_allocated), or otherwise the memory held by the process, allocator
+    cache included, from NVML (pip install nvidia-ml-py). The peak is the largest sample since reset, or the
+    allocator's peak.
+
+    cuda_device: the GPU, None for the CPU
+    """
+
+    def __init__(self, cuda_device):
+        self.cuda_device = cuda_device
+        self.nvml_handle = None
+        self.peak = None
+        if cuda_device is not None and not hasattr(torch.cuda, 'memory_allocated'):
+            try:
+                import pynvml
+                pynvml.nvmlInit()
+                self.nvml_handle = pynvml.nvmlDeviceGetHandleByIndex(cuda_device)
+            except Exception:
+                self.nvml_handle = None
+
+    def allocated(self):
+        """Gets the memory used on the GPU, in bytes, None if it is not available."""
+        if self.cuda_device is None:
+            return None
+        if hasattr(torch.cuda, 'memory_allocated'):
+            return torch.cuda.memory_allocated(self.cuda_device)
+        if self.nvml_handle is not None:
+            import pynvml
+            for process in pynvml.nvmlDeviceGetComputeRunningProcesses(self.nvml_handle):
+                if process.pid == os.getpid():
+                    return process.usedGpuMemory
+        return None
+
+    def sample(self):
+        """Gets the memory used on the GPU and its peak since reset, in bytes, None if not available."""
+        allocated = self.allocated()
+        if allocated is not None:
+            self.peak = allocated if self.peak is None else max(self.peak, allocated)
+        if hasattr(torch.cuda, 'max_memory_allocated') and self.cuda_device is not None:
+            return allocated, torch.cuda.max_memory_allocated(self.cuda_device)
+        return allocated, self.peak
+
+    def reset(self):
+        if self.cuda_device is not None and hasattr(torch.cuda, 'reset_max_memory_allocated'):
+            torch.cuda.reset_max_memory_allocated(self.cuda_device)
+        self.peak = None
+
+
+class MemoryProfiler(PhaseTimer):
+    """
+    A PhaseTimer that also samples the GPU memory and host resident set size at the end of each phase, so that
+    the memory allocated by the encoding, decoding, and backward passes of each level can be told apart. The
+    memory added by a phase is the change since the end of the previous phase. The samples are aggregated
+    until reset, as the largest values of each phase, see memory_table, and are added to the trace as counters.
+    """
+
+    def __init__(self, cuda_device=None, synchronize=False, max_events=100000):
+        self.device_memory = DeviceMemory(cuda_device)
+        super(MemoryProfiler, self).__init__(cuda_device, synchronize, max_events)
+
+    def reset(self):
+        super(MemoryProfiler, self).reset()
+        # (category, name, level) -> largest [device, device added, device peak, rss, rss added, rss peak]
+        self.memory = dict()
+        self.memory_events = []
+        self.device_memory.reset()
+        reset_host_peak()
+        self.last_sample = self.sample()
+
+    def sample(self):
+        """Gets the (device, device peak, rss, rss peak) memory in bytes, with None where not available."""
+        device, device_peak = self.device_memory.sample()
+        rss, rss_peak = host_memory()
+        return device, device_peak, rss, rss_peak
+
+    def record(self, name, start, end, level=None):
+        super(MemoryProfiler, self).record(name, start, end, level)
+        device, device_peak, rss, rss_peak = sample = self.sample()
+        added = lambda now, last: None if now is None or last is None else now - last
+        values = [device, added(device, self.last_sample[0]), device_peak, rss, added(rss, self.last_sample[2]), rss_peak]
+        self.last_sample = sample
+        key = (self.category, name, level)
+        if key not in self.memory:
+            self.memory[key] = values
+        else:
+            self.memory[key] = [value if largest is None else (largest if value is None else max(largest, value))
+                                for largest, value in zip(self.memory[key], values)]
+        if len(self.memory_events) < self.max_events:
+            self.memory_events.append((self.category, end, device, rss))
+
+    def peak(self):
+        """Gets the peak device and host memory since reset, in bytes, None where not available."""
+        _, device_peak, _, rss_peak = self.sample()
+        return device_peak, rss_peak
+
+    def trace(self):
+        trace = super(MemoryProfiler, self).trace()
+        for category, end, device, rss in self.memory_events:
+            args = dict()
+            if device is not None:
+                args['device (MB)'] = device / megabyte
+            if rss is not None:
+                args['rss (MB)'] = rss / megabyte
+            trace['traceEvents'].append({'name': 'memory', 'cat': category, 'ph': 'C', 'pid': 0,
+                                         'ts': (end - self.reset_time) * 1e6, 'args': args})
+        return trace
+
+    def memory_table(self):
+        """Formats the largest memory samples of each phase as a table, in MB."""
+        columns = ['Device', '+Device', 'Peak dev.', 'RSS', '+RSS', 'Peak RSS']
+        lines = ['Phase (MB)'.ljust(28) + ''.join(column.rjust(11) for column in columns)]
+        for category, name, level, _, _, _ in sorted(self.summary(), key=lambda row: (row[0], row[1], row[2])):
+            label = category + '/' + name + ('' if level is None else ' ' + str(level))
+            values = self.memory[(category, name, level)]
+            lines.append(label.ljust(28) + ''.join(('-' if value is None else '%.1f' % (value / megabyte)).rjust(11)
+                                                   for value in values))
+        return '\n'.join(lines)
+
@@ -1,6 +1,6 @@
 import torch.optim as opt
 from torch.optim.lr_scheduler import ExponentialLR
-from logs import load_opt_checkpoint
+from logs import load_opt_checkpoint, load_checkpoint
 
 
 def set_gpu_recursive(var, gpu_id):
@@ -41,16 +41,28 @@ def get_optimizers(train_config, arch, model):
         dec_opt = opt.Adam(decoder_params, lr=train_config['decoder_learning_rate'])
 
     epoch = -1
+    checkpoint = None
     if train_config['resume_experiment'] != '' and train_config['resume_experiment'] is not None:
-        # load the old optimizers and update the optimizer state dictionaries
+        # load the optimizer state dictionaries, from the pickled optimizers of older experiments
         # epoch is used to set the learning rate schedulers and where to resume training
-        old_enc_opt, old_dec_opt, epoch = load_opt_checkpoint()
-        enc_opt.load_state_dict(old_enc_opt.state_dict())
-        enc_opt.state = set_gpu_recursive(enc_opt.state, train_config['cuda_device'])
-        dec_opt.load_state_dict(old_dec_opt.state_dict())
-        dec_opt.state = set_gpu_recursive(dec_opt.state, train_config['cuda_device'])
+        checkpoint = load_checkpoint()
+        if checkpoint is not None:
+            enc_opt.load_state_dict(checkpoint['optimizers'][0])
+            dec_opt.load_state_dict(checkpoint['optimizers'][1])
+            epoch = checkpoint['epoch']
+        else:
+            old_enc_opt, old_dec_opt, epoch = load_opt_checkpoint(cuda_device=train_config['cuda_device'])
+            enc_opt.load_state_dict(old_enc_opt.state_dict())
+            dec_opt.load_state_dict(old_dec_opt.state_dict())
+        if train_config['cuda_device'] is not None:
+            enc_opt.state = set_gpu_recursive(enc_opt.state, train_config['cuda_device'])
+            dec_opt.state = set_gpu_recursive(dec_opt.state, train_config['cuda_device'])
 
     enc_sched = ExponentialLR(enc_opt, 0.999, last_epoch=epoch)
     dec_sched = ExponentialLR(dec_opt, 0.999, last_epoch=epoch)
+    if checkpoint is not None and 'schedulers' in checkpoint:
+        # step checkpoints have no scheduler states, their schedulers are set from the epoch alone
+        for scheduler, scheduler_state in zip([enc_sched, dec_sched], checkpoint['schedulers']):
+            scheduler.__dict__.update(scheduler_state)
 
     return (enc_opt, enc_sched), (dec_opt, dec_sched), epoch
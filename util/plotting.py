@@ -1,3 +1,10 @@
+import os
+import json
+import time
+import atexit
+import threading
+import Queue
+from collections import OrderedDict
 import visdom
 import numpy as np
 # from sklearn.decomposition import PCA
@@ -5,18 +12,181 @@ import numpy as np
 
 global vis
 
-
-def init_plot(train_config, arch, env='main', port=8097):
-    vis = initialize_env(env, port)
+# background sender of the plotting calls, see Plotter
+plotter = None
+
+
+class FileSink(object):
+
+    """
+    Stand-in for the visdom client, which appends each plotting call to a file as a line of JSON instead
+    of sending it to a server. The calls can be sent to visdom later with replay_plots.
+    """
+
+    def __init__(self, file_name, env='main'):
+        self.file_name = file_name
+        self.env = env
+
+    def __getattr__(self, method):
+        def record(*args, **kwargs):
+            with open(self.file_name, 'a') as plot_file:
+                plot_file.write(json.dumps([method, args, kwargs], default=to_json) + '\n')
+        return record
+
+
+def to_json(value):
+    """Converts numpy arrays and numbers for json."""
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError(repr(value) + ' is not JSON serializable')
+
+
+def replay_plots(file_name, env='main', port=8097):
+    """
+    Sends the plotting calls recorded by a FileSink to a visdom server.
+    :param file_name: the file written by the FileSink
+    :param env: the visdom environment
+    :param port: the port of the visdom server
+    :return: None
+    """
+    client = visdom.Visdom(port=port, env=env)
+    for line in open(file_name, 'r'):
+        method, args, kwargs = json.loads(line)
+        if method == 'save':
+            continue
+        args = [np.array(arg) if isinstance(arg, list) else arg for arg in args]
+        getattr(client, method)(*args, **kwargs)
+
+
+class Plotter(object):
+
+    """
+    Makes the plotting calls to the visdom client (or a FileSink) on a background thread, fed by a bounded
+    queue, so that training does not wait on the plotting server. Window ids are chosen here rather than by
+    the server. Trace updates are buffered and sent on flush, as one request per window. If the queue is full,
+    other plots are dropped, and trace updates stay buffered until the next flush, keeping every other point
+    of a trace once it has more than max_points buffered points.
+    """
+
+    def __init__(self, client, queue_size=100, max_points=100):
+        self.client = client
+        self.queue = Queue.Queue(maxsize=queue_size)
+        self.max_points = max_points
+        # window -> trace name -> (list of x, list of y)
+        self.traces = OrderedDict()
+        self.n_windows = 0
+        self.n_dropped = self.n_failed = 0
+        self.save_queued = False
+        self.thread = threading.Thread(target=self._send_loop)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def new_window(self):
+        """Gets the id of a new window."""
+        self.n_windows += 1
+        return 'window_' + str(self.n_windows)
+
+    def send(self, method, *args, **kwargs):
+        """
+        Queues a call to a method of the client, or drops it if the queue is full.
+        :return: whether the call was queued
+        """
+        try:
+            self.queue.put_nowait((method, args, kwargs))
+            return True
+        except Queue.Full:
+            self.n_dropped += 1
+            return False
+
+    def update_trace(self, X, Y, win, name):
+        """Buffers points of a trace, to be sent on flush."""
+        if win not in self.traces:
+            self.traces[win] = OrderedDict()
+        if name not in self.traces[win]:
+            self.traces[win][name] = ([], [])
+        x, y = self.traces[win][name]
+        x.extend(np.asarray(X).reshape(-1).tolist())
+        y.extend(np.asarray(Y).reshape(-1).tolist())
+        if len(x) > self.max_points:
+            # downsample, keeping the last point
+            self.traces[win][name] = (x[::-1][::2][::-1], y[::-1][::2][::-1])
+
+    def flush(self):
+        """Queues the buffered trace updates, one request per window (and set of x values)."""
+        for win in list(self.traces.keys()):
+            groups = OrderedDict()
+            for name, (x, y) in self.traces[win].items():
+                groups.setdefault(tuple(x), []).append((name, y))
+            requests = []
+            for x, named_ys in groups.items():
+                names = [name for name, _ in named_ys]
+                Y = np.column_stack([y for _, y in named_ys])
+                X = np.column_stack([x for _ in named_ys])
+                if len(names) == 1:
+                    Y, X = Y[:, 0], X[:, 0]
+                requests.append((Y, X, names))
+            if self.queue.maxsize - self.queue.qsize() < len(requests):
+                # keep buffering under backpressure
+                continue
+            for Y, X, names in requests:
+                self.send('line', Y, X, win=win, update='append', opts=dict(legend=names))
+            del self.traces[win]
+
+    def save(self, envs):
+        """Queues a save of the environments, unless one is already queued."""
+        if not self.save_queued:
+            self.save_queued = self.send('save', envs)
+
+    def close(self, timeout=30.):
+        """Sends the buffered trace updates, and waits up to timeout seconds for the queued calls."""
+        self.flush()
+        deadline = time.time() + timeout
+        while self.queue.unfinished_tasks > 0 and time.time() < deadline:
+            time.sleep(0.1)
+        if self.n_dropped > 0 or self.n_failed > 0:
+            print 'Plotting: ' + str(self.n_dropped) + ' plots dropped, ' + str(self.n_failed) + ' failed.'
+
+    def _send_loop(self):
+        while True:
+            method, args, kwargs = self.queue.get()
+            if method == 'save':
+                self.save_queued = False
+            try:
+                getattr(self.client, method)(*args, **kwargs)
+            except Exception:
+                self.n_failed += 1
+            finally:
+                self.queue.task_done()
+
+
+@atexit.register
+def close_plots():
+    """Sends the remaining plots, called on exit."""
+    if plotter is not None:
+        plotter.close()
+
+
+def init_plot(train_config, arch, env='main', port=8097, log_path=None):
+    vis = initialize_env(env, port, train_config['plot_sink'], log_path, train_config['plot_queue_size'])
     plot_config(train_config, arch)
     handle_dict = initialize_plots(train_config, arch)
     return vis, handle_dict
 
 
-def initialize_env(env='main', port=8097):
-    """Creates a visdom environment."""
-    global vis
-    vis = visdom.Visdom(port=port, env=env)
+def initialize_env(env='main', port=8097, sink='visdom', log_path=None, queue_size=100):
+    """
+    Creates a visdom environment, or a file sink that records the plots to plots.jsonl in the log directory.
+    """
+    global vis, plotter
+    if sink == 'visdom':
+        vis = visdom.Visdom(port=port, env=env)
+    elif sink == 'file':
+        vis = FileSink(os.path.join(log_path, 'plots.jsonl'), env=env)
+    else:
+        raise Exception('Plot sink ' + str(sink) + ' not found.')
+    plotter = Plotter(vis, queue_size=queue_size)
     return vis
 
 
@@ -106,7 +276,7 @@ def initialize_plots(train_config, arch):
 def save_env():
     """Saves the visdom environment."""
     global vis
-    vis.save([vis.env])
+    plotter.save([vis.env])
 
 
 def plot_config(train_config, arch):
@@ -119,8 +289,10 @@ def plot_config(train_config, arch):
     for arch_item in arch:
         model_string += str(arch_item) + ' = ' + str(arch[arch_item]) + ', '
 
-    config_win = vis.text(config_string)
-    model_win = vis.text(model_string)
+    config_win = plotter.new_window()
+    plotter.send('text', config_string, win=config_win)
+    model_win = plotter.new_window()
+    plotter.send('text', model_string, win=model_win)
     return config_win, model_win
 
 
@@ -132,7 +304,8 @@ def plot_images(imgs, caption=''):
     if imgs.shape[-1] == 3 or imgs.shape[-1] == 1:
         imgs = imgs.transpose((0, 3, 1, 2))
     opts = dict(caption=caption)
-    win = vis.images(np.clip(imgs, 0, 255), opts=opts)
+    win = plotter.new_window()
+    plotter.send('images', np.clip(imgs, 0, 255), win=win, opts=opts)
     return win
 
 
@@ -140,7 +313,8 @@ def plot_video(video, fps=1):
     """Wraps visdom's video function."""
     global vis
     opts = dict(fps=int(fps))
-    win = vis.video(video, opts=opts)
+    win = plotter.new_window()
+    plotter.send('video', video, win=win, opts=opts)
     return win
 
 
@@ -149,23 +323,29 @@ def plot_line(Y, X=None, legend=None, win=None, title='', xlabel='', ylabel='',
     global vis
     opts = dict(title=title, xlabel=xlabel, ylabel=ylabel, legend=legend, xtype=xformat, ytype=yformat)
     if win is None:
-        win = vis.line(Y, X, opts=opts)
+        win = plotter.new_window()
+        plotter.send('line', Y, X, win=win, opts=opts)
     else:
-        win = vis.line(Y, X, win=win, opts=opts, update='append')
+        plotter.send('line', Y, X, win=win, opts=opts, update='append')
     return win
 
 
 def update_trace(Y, X, win, name):
-    """Wraps visdom's updateTrace function."""
-    global vis
-    vis.updateTrace(X, Y, win=win, name=name)
+    """Wraps visdom's updateTrace function. The points are sent with the window's other updates on flush_plots."""
+    plotter.update_trace(X, Y, win, name)
+
+
+def flush_plots():
+    """Sends the buffered trace updates."""
+    plotter.flush()
 
 
 def plot_scatter(X, Y=None, legend=None, title='', xlabel='', ylabel='', markersize=5):
     """Wraps visdom's scatter function."""
     global vis
     opts = dict(title=title, xlabel=xlabel, ylabel=ylabel, markersize=markersize, legend=legend)
-    win = vis.scatter(X, Y, opts=opts)
+    win = plotter.new_window()
+    plotter.send('scatter', X, Y, win=win, opts=opts)
     return win
 
 
@@ -291,7 +471,8 @@ def plot_latent_covariance_matrix(posterior_mean, epoch, level):
     posterior_mean = posterior_mean.reshape((-1, np.prod(posterior_mean.shape[1:])))
     posterior_mean_centered = posterior_mean - np.mean(posterior_mean, axis=0)
     covariance = np.dot(posterior_mean_centered.T, posterior_mean_centered) / posterior_mean_centered.shape[0]
-    vis.heatmap(covariance, opts=dict(title='Posterior Covariance, Epoch ' + str(epoch) + ', Level ' + str(level)))
+    plotter.send('heatmap', covariance, win=plotter.new_window(),
+                 opts=dict(title='Posterior Covariance, Epoch ' + str(epoch) + ', Level ' + str(level)))
 
 
 def plot_output_variance(cond_like, epoch, handle_dict):
@@ -309,6 +490,7 @@ def plot_train(func):
         plot_param_grad_mags(output_dict['avg_param_grad_mags'], epoch, handle_dict)
         plot_state_grad_mags(output_dict['avg_state_grad_mags'], epoch, handle_dict)
         plot_opt_lr(optimizers, epoch, handle_dict)
+        flush_plots()
         return output_dict, handle_dict
     return plotting_func
 
@@ -358,5 +540,6 @@ def plot_model_vis(func):
                 # plot errors over inference iterations
                 plot_errors_over_iterations(output_dict['total_recon'][:batch_size], next(iter(data_loader))[0].cpu().numpy(), epoch)
 
+        flush_plots()
         return output_dict, averages, handle_dict
     return plotting_func
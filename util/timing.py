@@ -0,0 +1,148 @@
+import json
+import time
+import torch
+
+
+class NullPhase(object):
+    """Context of a phase when timing is disabled, which does nothing."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+# shared by all disabled phases, so that disabled timing allocates nothing
+null_phase = NullPhase()
+
+
+def phase(timer, name, level=None):
+    """
+    Times a phase of training or inference with a PhaseTimer, if timing is enabled:
+        with phase(model.phase_timer, 'encode', level):
+            ...
+    :param timer: the PhaseTimer, or None if timing is disabled
+    :param name: the name of the phase
+    :param level: the latent level of the phase, None if the phase is not per level
+    :return: the context of the phase
+    """
+    if timer is None:
+        return null_phase
+    return timer.phase(name, level)
+
+
+def record(timer, name, start, level=None):
+    """Records a phase that started at start (from time.time()) and ends now, if timing is enabled."""
+    if timer is not None:
+        timer.record(name, start, time.time(), level)
+
+
+class Phase(object):
+
+    def __init__(self, timer, name, level):
+        self.timer = timer
+        self.name = name
+        self.level = level
+        self.start = None
+
+    def __enter__(self):
+        self.timer.synchronize()
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.timer.synchronize()
+        self.timer.record(self.name, self.start, time.time(), self.level)
+        return False
+
+
+class PhaseTimer(object):
+    """
+    Times the phases of training and inference (data fetch, host to device transfer, preprocessing, encoding and
+    decoding per level, losses, backward passes, optimizer steps, and device to host transfers), and aggregates
+    them until reset, for instance over an epoch. The phases are timed where they are called, see phase, on the
+    timer set as the model's phase_timer. GPU operations run asynchronously, so their time is attributed to the
+    phase that waits for them (usually a device to host transfer), unless synchronize is set, which waits for
+    the GPU at the start and end of each phase, at the cost of the overlap of host and GPU work.
+
+    cuda_device: the GPU the model runs on, None for the CPU
+    synchronize: whether to wait for the GPU at the start and end of each phase
+    max_events: the number of phases kept for the trace, after which phases are only aggregated
+    """
+
+    def __init__(self, cuda_device=None, synchronize=False, max_events=100000):
+        self.cuda_device = cuda_device
+        self.synchronize_device = synchronize and cuda_device is not None
+        self.max_events = max_events
+        self.category = 'train'
+        self.reset()
+
+    def reset(self):
+        """Clears the timed phases, for instance at the start of an epoch."""
+        self.events = []
+        # (category, name, level) -> [count, total time]
+        self.totals = dict()
+        self.reset_time = time.time()
+
+    def set_category(self, category):
+        """Sets the category of the following phases, for instance 'train' or 'val'."""
+        self.category = category
+
+    def synchronize(self):
+        if self.synchronize_device:
+            torch.cuda.synchronize()
+
+    def phase(self, name, level=None):
+        return Phase(self, name, level)
+
+    def record(self, name, start, end, level=None):
+        """Records a phase from start to end, in seconds from the epoch."""
+        key = (self.category, name, level)
+        if key not in self.totals:
+            self.totals[key] = [0, 0.]
+        self.totals[key][0] += 1
+        self.totals[key][1] += end - start
+        if len(self.events) < self.max_events:
+            self.events.append((self.category, name, level, start, end))
+
+    def trace(self):
+        """
+        Gets the timed phases in the Chrome trace event format, viewed in chrome://tracing or Perfetto, with
+        a row (thread) per category.
+        :return: dict of trace events
+        """
+        categories = sorted(set(category for category, _, _, _, _ in self.events))
+        trace_events = []
+        for tid, category in enumerate(categories):
+            trace_events.append({'name': 'thread_name', 'ph': 'M', 'pid': 0, 'tid': tid, 'args': {'name': category}})
+        for category, name, level, start, end in self.events:
+            event = {'name': name if level is None else name + '_level_' + str(level), 'cat': category, 'ph': 'X',
+                     'ts': (start - self.reset_time) * 1e6, 'dur': (end - start) * 1e6, 'pid': 0,
+                     'tid': categories.index(category)}
+            if level is not None:
+                event['args'] = {'level': level}
+            trace_events.append(event)
+        return {'traceEvents': trace_events, 'displayTimeUnit': 'ms'}
+
+    def save_trace(self, file_name):
+        """Writes the timed phases to a Chrome trace event file (.json)."""
+        json.dump(self.trace(), open(file_name, 'w'))
+
+    def summary(self):
+        """
+        Gets the aggregated phases.
+        :return: list of (category, name, level, count, total time, mean time), in order of category and total time
+        """
+        rows = [(category, name, level, count, total, total / count)
+                for (category, name, level), (count, total) in self.totals.items()]
+        return sorted(rows, key=lambda row: (row[0], -row[4]))
+
+    def summary_table(self):
+        """Formats the aggregated phases as a table, with each phase's share of the time since reset."""
+        wall_time = max(time.time() - self.reset_time, 1e-9)
+        lines = ['Phase'.ljust(28) + 'Count'.rjust(9) + 'Total (s)'.rjust(12) + 'Mean (ms)'.rjust(12) + '% Time'.rjust(9)]
+        for category, name, level, count, total, mean in self.summary():
+            label = category + '/' + name + ('' if level is None else ' ' + str(level))
+            lines.append(label.ljust(28) + str(count).rjust(9) + ('%.3f' % total).rjust(12) +
+                         ('%.3f' % (1e3 * mean)).rjust(12) + ('%.1f' % (100. * total / wall_time)).rjust(9))
+        return '\n'.join(lines)
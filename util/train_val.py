@@ -2,81 +2,122 @@ import torch
 from torch.autograd import Variable
 import numpy as np
 import scipy.misc
+import time
 from random import shuffle
 
 # from cfg.config import train_config, arch
 
-from logs import log_train, log_vis
+from logs import log_train, log_vis, save_step_checkpoint, resumed_train_state, set_rng_state
 from plotting import plot_images, plot_line, plot_train, plot_model_vis
+from distributed import all_reduce_gradients, average_across_workers, is_master, reseed_for_rank
+from timing import phase, record
 
 
-def train_on_batch(model, batch, n_iterations, optimizers, train_config, arch, train_enc=True, train_dec=True):
+def train_on_batch(model, batch, n_iterations, optimizers, train_config, arch, train_enc=True, train_dec=True,
+                   n_accumulated=0, step=True, loss_scale=1.):
+    """
+    Trains the model on a batch, or on one micro-batch of a larger batch with gradient accumulation.
+    :param n_accumulated: number of micro-batches whose gradients have been accumulated since the last step
+    :param step: whether to step the optimizers after this batch, see step_optimizers
+    :param loss_scale: weight of the (averaged) losses in the backward passes, the micro-batch's share of the
+                       examples of the optimizer step, see accumulate_and_step
+    """
 
     output_dict = dict()
+    timer = model.phase_timer
 
     enc_opt, dec_opt = optimizers
-    # initialize the posterior estimate from the prior
-    enc_opt.zero_grad()
-    model.decode(generate=True)
-    model.reset_state()
-
-    # if 'gradient' in arch['encoding_form']\
-    #         or 'log_gradient' in arch['encoding_form']\
-    #         or 'scaled_log_gradient' in arch['encoding_form']\
-    #         or 'sign_gradient' in arch['encoding_form']:
-    #     # initialize state gradients
-    model.decode()
-    elbo = model.elbo(batch, averaged=True)
-    (-elbo).backward(retain_graph=True)
-
-    # keep track of state gradient magnitudes
-    approx_post_grads = np.zeros((n_iterations + 1, len(model.levels), 2))
-    for level_num, level in enumerate(model.levels):
-        grads = level.state_gradients()
-        approx_post_grads[0, level_num, 0] = grads[0].abs().mean().data.cpu().numpy()[0]
-        if len(grads) > 1:
-            approx_post_grads[0, level_num, 1] = grads[1].abs().mean().data.cpu().numpy()[0]
-
-    model.not_trainable_state()
-    # inference iterations
-
-    for it in range(n_iterations - 1):
-        model.encode(batch)
-        model.decode()
-        elbo = model.elbo(batch, averaged=True)
-        (-elbo).backward(retain_graph=True)
-
-        for level_num, level in enumerate(model.levels):
-            grads = level.state_gradients()
-            approx_post_grads[it+1, level_num, 0] = grads[0].abs().mean().data.cpu().numpy()[0]
-            if len(grads) > 1:
-                approx_post_grads[it+1, level_num, 1] = grads[1].abs().mean().data.cpu().numpy()[0]
-
-        if not train_config['average_gradient'] or arch['encoder_type'] in ['em', 'EM']:
-            if train_enc:
-                enc_opt.step()
+    # decoder gradients are only used on the final iteration, so exclude the
+    # decoder parameters from autograd during the inner inference iterations
+    model.not_trainable_decoder()
+    try:
+        # initialize the posterior estimate from the prior
+        if n_accumulated == 0:
             enc_opt.zero_grad()
+        model.decode(generate=True, batch_size=batch.size()[0])
+        model.reset_state(batch_size=batch.size()[0])
+
+        # if 'gradient' in arch['encoding_form']\
+        #         or 'log_gradient' in arch['encoding_form']\
+        #         or 'scaled_log_gradient' in arch['encoding_form']\
+        #         or 'sign_gradient' in arch['encoding_form']:
+        #     # initialize state gradients
+        model.decode()
+        with phase(timer, 'losses'):
+            elbo = model.elbo(batch, averaged=True)
+        with phase(timer, 'inner_backward'):
+            (-elbo * loss_scale).backward(retain_graph=True)
+
+        # keep track of state gradient magnitudes
+        approx_post_grads = np.zeros((n_iterations + 1, len(model.levels), 2))
+        approx_post_grads[0] = model.state_gradient_magnitudes()
+
+        model.not_trainable_state()
+        # inference iterations
+
+        for it in range(n_iterations - 1):
+            model.encode(batch)
+            model.decode()
+            with phase(timer, 'losses'):
+                elbo = model.elbo(batch, averaged=True)
+            with phase(timer, 'inner_backward'):
+                (-elbo * loss_scale).backward(retain_graph=True)
+
+            approx_post_grads[it+1] = model.state_gradient_magnitudes()
+
+            if not train_config['average_gradient'] or arch['encoder_type'] in ['em', 'EM']:
+                with phase(timer, 'optimizer_step'):
+                    if train_enc:
+                        all_reduce_gradients(model.encoder_parameters(), train_config)
+                        enc_opt.step()
+                    enc_opt.zero_grad()
+    finally:
+        # also on errors, so that the decoder is not left frozen
+        model.trainable_decoder()
 
     # final iteration
-    dec_opt.zero_grad()
+    if n_accumulated == 0:
+        dec_opt.zero_grad()
     model.encode(batch)
     model.decode()
 
-    elbo, cond_log_like, kl = model.losses(batch, averaged=True)
-    (-elbo).backward()
+    with phase(timer, 'losses'):
+        elbo, cond_log_like, kl = model.losses(batch, averaged=True)
+    with phase(timer, 'final_backward'):
+        (-elbo * loss_scale).backward()
 
-    for level_num, level in enumerate(model.levels):
-        grads = level.state_gradients()
-        approx_post_grads[-1, level_num, 0] = grads[0].abs().mean().data.cpu().numpy()[0]
-        if len(grads) > 1:
-            approx_post_grads[-1, level_num, 1] = grads[1].abs().mean().data.cpu().numpy()[0]
+    approx_post_grads[-1] = model.state_gradient_magnitudes()
 
     output_dict['state_grad_mags'] = approx_post_grads
+    output_dict['param_grad_mags'] = None
+    if step:
+        output_dict['param_grad_mags'] = step_optimizers(model, optimizers, n_iterations, train_config, train_enc,
+                                                         train_dec)
+
+    with phase(timer, 'device_to_host'):
+        output_dict['elbo'] = elbo.data.cpu().numpy()[0]
+        output_dict['cond_log_like'] = cond_log_like.data.cpu().numpy()[0]
+        for level in range(len(kl)):
+            kl[level] = kl[level].data.cpu().numpy()[0]
+    output_dict['kl'] = kl
+
+    return output_dict
+
+
+def step_optimizers(model, optimizers, n_iterations, train_config, train_enc=True, train_dec=True):
+    """
+    Averages the encoder gradients over the inference iterations if average_gradient is set, and the gradients
+    across any other workers, then steps the optimizers. Accumulated micro-batch gradients are already weighted
+    by the micro-batches' shares of the examples, see accumulate_and_step.
+    :return: array of the average parameter gradient magnitudes, size ((n_levels + 1) x 2)
+    """
+    enc_opt, dec_opt = optimizers
 
     # divide encoder gradients
-    if train_config['average_gradient']:
+    if train_config['average_gradient'] and n_iterations > 1:
         for param in model.encoder_parameters():
-            param.grad /= n_iterations
+            if param.grad is not None:
+                param.grad /= n_iterations
 
     # calculate average gradient magnitudes
     def ave_grad_mag(params):
@@ -89,33 +130,31 @@ def train_on_batch(model, batch, n_iterations, optimizers, train_config, arch, t
         return grad_mag / num_params
 
     grad_mags = np.zeros((len(model.levels)+1, 2))
-    for level_num, level in enumerate(model.levels):
-        encoder_grad_mag = ave_grad_mag(level.encoder_parameters())
-        decoder_grad_mag = ave_grad_mag(level.decoder_parameters())
-        grad_mags[level_num, :] = np.array([encoder_grad_mag, decoder_grad_mag])
-    output_decoder_grad_mag = ave_grad_mag(model.output_decoder.parameters())
-    grad_mags[-1, :] = np.array([0., output_decoder_grad_mag])
-    output_dict['param_grad_mags'] = grad_mags
-
-    # update parameters
-    if train_enc:
-        enc_opt.step()
-    if train_dec:
-        dec_opt.step()
-
-    output_dict['elbo'] = elbo.data.cpu().numpy()[0]
-    output_dict['cond_log_like'] = cond_log_like.data.cpu().numpy()[0]
-    for level in range(len(kl)):
-        kl[level] = kl[level].data.cpu().numpy()[0]
-    output_dict['kl'] = kl
+    with phase(model.phase_timer, 'grad_magnitudes'):
+        for level_num, level in enumerate(model.levels):
+            encoder_grad_mag = ave_grad_mag(level.encoder_parameters())
+            decoder_grad_mag = ave_grad_mag(level.decoder_parameters())
+            grad_mags[level_num, :] = np.array([encoder_grad_mag, decoder_grad_mag])
+        output_decoder_grad_mag = ave_grad_mag(model.output_decoder.parameters())
+        grad_mags[-1, :] = np.array([0., output_decoder_grad_mag])
 
-    return output_dict
+    # update parameters, with the gradients averaged across any other workers
+    with phase(model.phase_timer, 'optimizer_step'):
+        if train_enc:
+            all_reduce_gradients(model.encoder_parameters(), train_config)
+            enc_opt.step()
+        if train_dec:
+            all_reduce_gradients(model.decoder_parameters(), train_config)
+            dec_opt.step()
+
+    return grad_mags
 
 
 def run_on_batch(model, batch, n_iterations, train_config, arch, vis=False):
     """Runs the model on a single batch. If visualizing, stores posteriors, priors, and output distributions."""
 
     output_dict = dict()
+    timer = model.phase_timer
 
     batch_shape = list(batch.size())
     total_elbo = np.zeros((batch.size()[0], n_iterations+1))
@@ -128,86 +167,91 @@ def run_on_batch(model, batch, n_iterations, train_config, arch, vis=False):
         # note: cond_like is the network output, reconstructions are the images
         cond_like = np.zeros([batch_shape[0], n_iterations+1, 2] + batch_shape[1:])
         reconstructions = np.zeros([batch_shape[0], n_iterations+1] + batch_shape[1:])
-        posterior = [np.zeros([batch_shape[0], n_iterations+1, 2, model.levels[level].n_latent]) for level in range(len(model.levels))]
-        prior = [np.zeros([batch_shape[0], n_iterations+1, 2, model.levels[level].n_latent]) for level in range(len(model.levels))]
-
-    # initialize the model from the prior
-    model.decode(generate=True)
-    model.reset_state()
-    elbo, cond_log_like, kl = model.losses(batch)
+        posterior = [np.zeros([batch_shape[0], n_iterations+1, 2, model.levels[level].latent.n_variables]) for level in range(len(model.levels))]
+        prior = [np.zeros([batch_shape[0], n_iterations+1, 2, model.levels[level].latent.n_variables]) for level in range(len(model.levels))]
+
+    # only state gradients are needed here, so skip the decoder weight gradients
+    model.not_trainable_decoder()
+    try:
+        # initialize the model from the prior
+        model.decode(generate=True, batch_size=batch.size()[0])
+        model.reset_state(batch_size=batch.size()[0])
+        with phase(timer, 'losses'):
+            elbo, cond_log_like, kl = model.losses(batch)
+
+        with phase(timer, 'device_to_host'):
+            total_elbo[:, 0] = elbo.data.cpu().numpy()
+            total_cond_log_like[:, 0] = cond_log_like.data.cpu().numpy()
+            for level in range(len(kl)):
+                total_kl[level][:, 0] = kl[level].data.cpu().numpy()
 
-    total_elbo[:, 0] = elbo.data.cpu().numpy()
-    total_cond_log_like[:, 0] = cond_log_like.data.cpu().numpy()
-    for level in range(len(kl)):
-        total_kl[level][:, 0] = kl[level].data.cpu().numpy()
-
-    if vis:
-        cond_like[:, 0, 0] = model.output_dist.mean[:, 0].data.cpu().numpy().reshape(batch_shape)
-        reconstructions[:, 0] = model.reconstruction.data.cpu().numpy().reshape(batch_shape)
-        # if model.output_distribution == 'gaussian':
-        #     cond_like[:, 0, 1] = model.output_dist.log_var[:, 0].data.cpu().numpy().reshape(batch_shape)
-        for level in range(len(model.levels)):
-            posterior[level][:, 0, 0, :] = model.levels[level].latent.posterior.mean.data.cpu().numpy()
-            if arch['posterior_form'] == 'gaussian':
-                posterior[level][:, 0, 1, :] = model.levels[level].latent.posterior.log_var.data.cpu().numpy()
-            prior_mean = model.levels[level].latent.prior.mean.data.cpu()
-            prior_log_var = model.levels[level].latent.prior.log_var.data.cpu()
-            if len(prior_mean.shape) == 3:
-                prior_mean = prior_mean.mean(dim=1)
-            if len(prior_log_var.shape) == 3:
-                prior_log_var = prior_log_var.mean(dim=1)
-            prior[level][:, 0, 0, :] = prior_mean.numpy()
-            prior[level][:, 0, 1, :] = prior_log_var.numpy()
-
-    # if 'gradient' in arch['encoding_form'] \
-    #         or 'log_gradient' in arch['encoding_form'] \
-    #         or 'scaled_log_gradient' in arch['encoding_form'] \
-    #         or 'sign_gradient' in arch['encoding_form']:
-    #     # initialize state gradients
-    model.decode()
-    elbo = model.elbo(batch, averaged=True)
-    (-elbo).backward(retain_graph=True)
-
-    model.not_trainable_state()
-
-    # inference iterations
-    for i in range(1, n_iterations+1):
-        model.encode(batch)
-        model.decode()
-        elbo, cond_log_like, kl = model.losses(batch)
-        if 'gradient' in arch['encoding_form'] \
-                or 'log_gradient' in arch['encoding_form'] \
-                or 'scaled_log_gradient' in arch['encoding_form'] \
-                or 'sign_gradient' in arch['encoding_form'] \
-                or 'mean_gradient' in arch['encoding_form'] \
-                or 'l2_norm_mean_gradient' in arch['encoding_form'] \
-                or 'layer_norm_mean_gradient' in arch['encoding_form'] \
-                or 'log_var_gradient' in arch['encoding_form'] \
-                or 'l2_norm_log_var_gradient' in arch['encoding_form'] \
-                or 'layer_norm_log_var_gradient' in arch['encoding_form'] \
-                or 'l2_norm_gradient' in arch['encoding_form']:
-            (-elbo.mean(0)).backward(retain_graph=True)
-        total_elbo[:, i] = elbo.data.cpu().numpy()
-        total_cond_log_like[:, i] = cond_log_like.data.cpu().numpy()
-        for level in range(len(kl)):
-            total_kl[level][:, i] = kl[level].data.cpu().numpy()
         if vis:
             cond_like[:, 0, 0] = model.output_dist.mean[:, 0].data.cpu().numpy().reshape(batch_shape)
-            reconstructions[:, i] = model.reconstruction.data.cpu().numpy().reshape(batch_shape)
+            reconstructions[:, 0] = model.reconstruction.data.cpu().numpy().reshape(batch_shape)
             # if model.output_distribution == 'gaussian':
-            #    cond_like[:, i, 1] = model.output_dist.log_var[0, :].data.cpu().numpy().reshape(batch_shape)
+            #     cond_like[:, 0, 1] = model.output_dist.log_var[:, 0].data.cpu().numpy().reshape(batch_shape)
             for level in range(len(model.levels)):
-                posterior[level][:, i, 0, :] = model.levels[level].latent.posterior.mean.data.cpu().numpy()
+                posterior[level][:, 0, 0, :] = model.levels[level].latent.posterior.mean.data.cpu().numpy()
                 if arch['posterior_form'] == 'gaussian':
-                    posterior[level][:, i, 1, :] = model.levels[level].latent.posterior.log_var.data.cpu().numpy()
+                    posterior[level][:, 0, 1, :] = model.levels[level].latent.posterior.log_var.data.cpu().numpy()
                 prior_mean = model.levels[level].latent.prior.mean.data.cpu()
                 prior_log_var = model.levels[level].latent.prior.log_var.data.cpu()
                 if len(prior_mean.shape) == 3:
                     prior_mean = prior_mean.mean(dim=1)
                 if len(prior_log_var.shape) == 3:
                     prior_log_var = prior_log_var.mean(dim=1)
-                prior[level][:, i, 0, :] = prior_mean.numpy()
-                prior[level][:, i, 1, :] = prior_log_var.numpy()
+                prior[level][:, 0, 0, :] = prior_mean.numpy()
+                prior[level][:, 0, 1, :] = prior_log_var.numpy()
+
+        # if 'gradient' in arch['encoding_form'] \
+        #         or 'log_gradient' in arch['encoding_form'] \
+        #         or 'scaled_log_gradient' in arch['encoding_form'] \
+        #         or 'sign_gradient' in arch['encoding_form']:
+        #     # initialize state gradients
+        model.decode()
+        with phase(timer, 'losses'):
+            elbo = model.elbo(batch, averaged=True)
+        with phase(timer, 'inner_backward'):
+            (-elbo).backward(retain_graph=True)
+
+        model.not_trainable_state()
+
+        # the state gradients are only computed on each iteration if the encoder takes them as input
+        gradient_encoding = any([form.endswith('gradient') for form in arch['encoding_form']])
+
+        # inference iterations
+        for i in range(1, n_iterations+1):
+            model.encode(batch)
+            model.decode()
+            with phase(timer, 'losses'):
+                elbo, cond_log_like, kl = model.losses(batch)
+            if gradient_encoding:
+                with phase(timer, 'inner_backward'):
+                    (-elbo.mean(0)).backward(retain_graph=True)
+            with phase(timer, 'device_to_host'):
+                total_elbo[:, i] = elbo.data.cpu().numpy()
+                total_cond_log_like[:, i] = cond_log_like.data.cpu().numpy()
+                for level in range(len(kl)):
+                    total_kl[level][:, i] = kl[level].data.cpu().numpy()
+            if vis:
+                cond_like[:, 0, 0] = model.output_dist.mean[:, 0].data.cpu().numpy().reshape(batch_shape)
+                reconstructions[:, i] = model.reconstruction.data.cpu().numpy().reshape(batch_shape)
+                # if model.output_distribution == 'gaussian':
+                #    cond_like[:, i, 1] = model.output_dist.log_var[0, :].data.cpu().numpy().reshape(batch_shape)
+                for level in range(len(model.levels)):
+                    posterior[level][:, i, 0, :] = model.levels[level].latent.posterior.mean.data.cpu().numpy()
+                    if arch['posterior_form'] == 'gaussian':
+                        posterior[level][:, i, 1, :] = model.levels[level].latent.posterior.log_var.data.cpu().numpy()
+                    prior_mean = model.levels[level].latent.prior.mean.data.cpu()
+                    prior_log_var = model.levels[level].latent.prior.log_var.data.cpu()
+                    if len(prior_mean.shape) == 3:
+                        prior_mean = prior_mean.mean(dim=1)
+                    if len(prior_log_var.shape) == 3:
+                        prior_log_var = prior_log_var.mean(dim=1)
+                    prior[level][:, i, 0, :] = prior_mean.numpy()
+                    prior[level][:, i, 1, :] = prior_log_var.numpy()
+    finally:
+        model.trainable_decoder()
 
     output_dict['total_elbo'] = total_elbo
     output_dict['total_cond_log_like'] = total_cond_log_like
@@ -264,7 +308,7 @@ def run(model, train_config, arch, data_loader, vis=False, eval=False):
 
     batch_size = train_config['batch_size']
     n_iterations = train_config['n_iterations']
-    n_examples = batch_size * len(iter(data_loader))
+    n_examples = len(data_loader.dataset)
     data_shape = list(next(iter(data_loader))[0].size())[1:]
 
     total_elbo = np.zeros((n_examples, n_iterations+1))
@@ -277,63 +321,73 @@ def run(model, train_config, arch, data_loader, vis=False, eval=False):
         # to capture all of the val set: replace batch_size with n_examples
         total_cond_like = np.zeros([batch_size, n_iterations + 1, 2] + data_shape)
         total_recon = np.zeros([batch_size, n_iterations + 1] + data_shape)
-        total_posterior = [np.zeros([batch_size, n_iterations + 1, 2, model.levels[level].n_latent]) for level in range(len(model.levels))]
-        total_prior = [np.zeros([batch_size, n_iterations + 1, 2, model.levels[level].n_latent]) for level in range(len(model.levels))]
+        total_posterior = [np.zeros([batch_size, n_iterations + 1, 2, model.levels[level].latent.n_variables]) for level in range(len(model.levels))]
+        total_prior = [np.zeros([batch_size, n_iterations + 1, 2, model.levels[level].latent.n_variables]) for level in range(len(model.levels))]
 
+    data_index = 0
+    fetch_start = time.time()
     for batch_index, (batch, labels) in enumerate(data_loader):
+        record(model.phase_timer, 'data_fetch', fetch_start)
         batch = Variable(batch)
         if train_config['cuda_device'] is not None:
-            batch = batch.cuda(train_config['cuda_device'])
+            with phase(model.phase_timer, 'host_to_device'):
+                batch = batch.cuda(train_config['cuda_device'])
 
-        if model.output_distribution == 'bernoulli':
-            batch = 255. * torch.bernoulli(batch / 255.)
-        elif model.output_distribution == 'gaussian':
-            rand_values = torch.rand(tuple(batch.data.shape)) - 0.5
-            if train_config['cuda_device'] is not None:
-                rand_values = Variable(rand_values.cuda(train_config['cuda_device']))
-            else:
-                rand_values = Variable(rand_values)
-            batch = torch.clamp(batch + rand_values, 0., 255.)
+        with phase(model.phase_timer, 'preprocess'):
+            if model.output_distribution == 'bernoulli':
+                batch = 255. * torch.bernoulli(batch / 255.)
+            elif model.output_distribution == 'gaussian':
+                rand_values = torch.rand(tuple(batch.data.shape)) - 0.5
+                if train_config['cuda_device'] is not None:
+                    rand_values = Variable(rand_values.cuda(train_config['cuda_device']))
+                else:
+                    rand_values = Variable(rand_values)
+                batch = torch.clamp(batch + rand_values, 0., 255.)
 
         batch_output = run_on_batch(model, batch, n_iterations, train_config, arch, vis)
 
-        data_index = batch_index * batch_size
-        total_elbo[data_index:data_index + batch_size, :] = batch_output['total_elbo']
-        total_cond_log_like[data_index:data_index + batch_size, :] = batch_output['total_cond_log_like']
+        # the last batch may be smaller
+        n_batch = batch.size()[0]
+        total_elbo[data_index:data_index + n_batch, :] = batch_output['total_elbo']
+        total_cond_log_like[data_index:data_index + n_batch, :] = batch_output['total_cond_log_like']
         for level in range(len(model.levels)):
-            total_kl[level][data_index:data_index + batch_size, :] = batch_output['total_kl'][level]
+            total_kl[level][data_index:data_index + n_batch, :] = batch_output['total_kl'][level]
 
-        total_labels[data_index:data_index + batch_size] = labels.numpy()
+        total_labels[data_index:data_index + n_batch] = labels.numpy()
 
         if vis and batch_index == 0:
-            total_cond_like[data_index:data_index + batch_size] = batch_output['cond_like']
-            total_recon[data_index:data_index + batch_size] = batch_output['reconstructions']
+            total_cond_like[:n_batch] = batch_output['cond_like']
+            total_recon[:n_batch] = batch_output['reconstructions']
             for level in range(len(model.levels)):
-                total_posterior[level][data_index:data_index + batch_size] = batch_output['posterior'][level]
-                total_prior[level][data_index:data_index + batch_size] = batch_output['prior'][level]
+                total_posterior[level][:n_batch] = batch_output['posterior'][level]
+                total_prior[level][:n_batch] = batch_output['prior'][level]
 
         if eval:
             print 'Running Eval...'
-            total_log_like[data_index:data_index + batch_size] = eval_on_batch(model, batch, 5000)
+            total_log_like[data_index:data_index + n_batch] = eval_on_batch(model, batch, 5000)
             print total_log_like[data_index]
 
+        data_index += n_batch
+        fetch_start = time.time()
+
     samples = None
     optimization_surface = None
     if vis:
         # visualize samples from the model
-        model.decode(generate=True)
+        model.decode(generate=True, batch_size=batch_size)
         samples = model.reconstruction.data.cpu().numpy().reshape([batch_size]+data_shape)
 
         # visualize the latent optimization surface
-        if arch['n_latent'][0] == 2 and len(arch['n_latent']) == 1:
+        if model.levels[0].latent.n_variables == 2 and len(model.levels) == 1:
             print 'Visualizing latent space...'
+            batch = next(iter(data_loader))[0]
+            n_batch = batch.size()[0]
             optimization_surface = dict()
-            optimization_surface['elbo'] = np.zeros((batch_size, 200, 200))
-            optimization_surface['kl'] = np.zeros((batch_size, 200, 200))
-            optimization_surface['cond_log_like'] = np.zeros((batch_size, 200, 200))
-            optimization_surface['gradients'] = np.zeros((batch_size, 2, 200, 200))
+            optimization_surface['elbo'] = np.zeros((n_batch, 200, 200))
+            optimization_surface['kl'] = np.zeros((n_batch, 200, 200))
+            optimization_surface['cond_log_like'] = np.zeros((n_batch, 200, 200))
+            optimization_surface['gradients'] = np.zeros((n_batch, 2, 200, 200))
 
-            batch = next(iter(data_loader))[0]
             batch = Variable(batch)
             if train_config['cuda_device'] is not None:
                 batch = batch.cuda(train_config['cuda_device'])
@@ -347,11 +401,13 @@ def run(model, train_config, arch, data_loader, vis=False, eval=False):
                 else:
                     rand_values = Variable(rand_values)
                 batch = torch.clamp(batch + rand_values, 0., 255.)
+            model.decode(generate=True, batch_size=n_batch)
+            model.reset_state(batch_size=n_batch)
             model.trainable_state()
             for i_iter, i in enumerate(np.arange(-5, 5, 0.05)):
                 for j_iter, j in enumerate(np.arange(-5, 5, 0.05)):
                     # set the approximate posterior and evaluate the loss
-                    mean = torch.cat((i * torch.ones(batch_size, 1), j * torch.ones(batch_size, 1)), dim=1)
+                    mean = torch.cat((i * torch.ones(n_batch, 1), j * torch.ones(n_batch, 1)), dim=1)
                     model.levels[0].latent.reset_mean(value=mean)
                     model.decode()
                     elbo, cond_log_like, kl = model.losses(batch)
@@ -373,6 +429,7 @@ def run(model, train_config, arch, data_loader, vis=False, eval=False):
         state = model.state_parameters()
 
         # run expectation steps on each batch
+        data_index = 0
         for batch_index, (batch, labels) in enumerate(data_loader):
             print 'Batch: ' + str(batch_index)
             batch = Variable(batch)
@@ -392,7 +449,8 @@ def run(model, train_config, arch, data_loader, vis=False, eval=False):
             # initialize EM optimizer here so that we don't carry over
             # old optimizer parameters from the last batch
             em_optimizer = torch.optim.SGD(state, 0.01, 0.9)
-            em_elbo[batch_index*batch_size:batch_index*batch_size+batch_size, :] = em_on_batch(model, batch, n_iterations+1, em_optimizer)
+            em_elbo[data_index:data_index + batch.size()[0], :] = em_on_batch(model, batch, n_iterations+1, em_optimizer)
+            data_index += batch.size()[0]
 
     output_dict['total_elbo'] = total_elbo
     output_dict['total_cond_log_like'] = total_cond_log_like
@@ -413,9 +471,53 @@ def run(model, train_config, arch, data_loader, vis=False, eval=False):
 @plot_train
 @log_train
 def train(model, train_config, arch, data_loader, epoch, optimizers):
+    return train_epoch(model, train_config, arch, data_loader, epoch, optimizers)
+
+
+def accumulate_and_step(model, micro_batches, optimizers, train_config, arch):
+    """
+    Trains the model on the micro-batches of one optimizer step, accumulating their gradients. Each micro-batch's
+    losses are weighted by its share of the examples, so that the step is the same as on all of the examples at
+    once, also if the micro-batches differ in size.
+    :param micro_batches: list of the micro-batches
+    :return: list of the output dicts of train_on_batch, the last with the parameter gradient magnitudes
+    """
+    n_examples = sum([micro_batch.size()[0] for micro_batch in micro_batches])
+    batch_outputs = []
+    for n_accumulated, micro_batch in enumerate(micro_batches):
+        for _ in range(train_config['encoder_decoder_train_multiple']-1):
+            train_on_batch(model, micro_batch, train_config['n_iterations'], optimizers, train_config, arch, train_enc=True, train_dec=False)
+        batch_outputs.append(train_on_batch(model, micro_batch, train_config['n_iterations'], optimizers, train_config,
+                                            arch, n_accumulated=n_accumulated, step=n_accumulated == len(micro_batches) - 1,
+                                            loss_scale=micro_batch.size()[0] * 1. / n_examples))
+    return batch_outputs
+
+
+def train_epoch(model, train_config, arch, data_loader, epoch, optimizers):
+    """
+    Trains the model for one epoch, without logging or plotting. In distributed training, every worker
+    calls this on its shard of the data, and the returned averages are over all workers.
+    Each data batch is split into micro-batches of micro_batch_size (if set), and the optimizers step once
+    per n_accumulation micro-batches, so the effective batch size is micro_batch_size * n_accumulation.
+    The micro-batches of a step are gathered, across data batches if need be, before training on them.
+    Every checkpoint_iter optimizer steps (if set), a step checkpoint is saved at the end of a data batch,
+    and a resumed step checkpoint continues the epoch from the next data batch.
+    """
 
     output_dict = dict()
 
+    micro_batch_size = train_config['micro_batch_size']
+    n_accumulation = train_config['n_accumulation']
+    if n_accumulation > 1:
+        # inner encoder steps and extra encoder passes would zero the accumulated gradients
+        assert train_config['average_gradient'] and arch['encoder_type'] not in ['em', 'EM'], \
+            'Gradient accumulation requires average_gradient and an inference model.'
+        assert train_config['encoder_decoder_train_multiple'] == 1, \
+            'Gradient accumulation requires encoder_decoder_train_multiple = 1.'
+
+    # reshuffles the data (or the shards of the worker processes)
+    data_loader.sampler.set_epoch(epoch)
+
     avg_elbo = []
     avg_cond_log_like = []
     avg_kl = [[] for _ in range(len(model.levels))]
@@ -432,43 +534,98 @@ def train(model, train_config, arch, data_loader, epoch, optimizers):
         else:
             model.kl_weight = 1.
 
-    for batch, _ in data_loader:
+    n_micro_batches = n_steps = n_examples = 0
+    # micro-batches of the next optimizer step
+    pending = []
+    elapsed = 0.
+    train_state = resumed_train_state(epoch)
+    if train_state is not None:
+        # continue after the last data batch of the step checkpoint, in the same order
+        data_loader.sampler.seed = train_state['sampler_seed']
+        data_loader.sampler.set_start(train_state['n_examples'])
+        avg_elbo, avg_cond_log_like, avg_kl = train_state['avg_elbo'], train_state['avg_cond_log_like'], train_state['avg_kl']
+        avg_param_grad_mags, avg_state_grad_mags = train_state['avg_param_grad_mags'], train_state['avg_state_grad_mags']
+        n_micro_batches, n_steps, n_examples = train_state['n_micro_batches'], train_state['n_steps'], train_state['n_examples']
+        elapsed = train_state['elapsed']
+    checkpoint_step = n_steps
+    data_iterator = iter(data_loader)
+    if train_state is not None:
+        # after creating the iterator, which draws the seed of the loader workers
+        set_rng_state(train_state['rng_state'], train_config['cuda_device'])
+        reseed_for_rank(train_config)
+
+    def add_outputs(batch_outputs):
+        # adds the outputs of the micro-batches of an optimizer step to the averages
+        for batch_output in batch_outputs:
+            avg_elbo.append(batch_output['elbo'])
+            avg_cond_log_like.append(batch_output['cond_log_like'])
+            for l in range(len(avg_kl)):
+                avg_kl[l].append(batch_output['kl'][l])
+            avg_state_grad_mags[:] += batch_output['state_grad_mags']
+        avg_param_grad_mags[:] += batch_outputs[-1]['param_grad_mags']
+
+    tic = time.time() - elapsed
+    fetch_start = time.time()
+    for batch, _ in data_iterator:
+        record(model.phase_timer, 'data_fetch', fetch_start)
         if train_config['cuda_device'] is not None:
-            batch = Variable(batch.cuda(train_config['cuda_device']))
+            with phase(model.phase_timer, 'host_to_device'):
+                batch = Variable(batch.cuda(train_config['cuda_device']))
         else:
             batch = Variable(batch)
 
-        if model.output_distribution == 'bernoulli':
-            batch = 255. * torch.bernoulli(batch / 255.)
-        elif model.output_distribution == 'gaussian':
-            rand_values = torch.rand(tuple(batch.data.shape)) - 0.5
-            if train_config['cuda_device'] is not None:
-                rand_values = Variable(rand_values.cuda(train_config['cuda_device']))
-            else:
-                rand_values = Variable(rand_values)
-            batch = torch.clamp(batch + rand_values, 0., 255.)
-
-        for _ in range(train_config['encoder_decoder_train_multiple']-1):
-            train_on_batch(model, batch, train_config['n_iterations'], optimizers, train_config, arch, train_enc=True, train_dec=False)
-
-        batch_output = train_on_batch(model, batch, train_config['n_iterations'], optimizers,  train_config, arch)
+        with phase(model.phase_timer, 'preprocess'):
+            if model.output_distribution == 'bernoulli':
+                batch = 255. * torch.bernoulli(batch / 255.)
+            elif model.output_distribution == 'gaussian':
+                rand_values = torch.rand(tuple(batch.data.shape)) - 0.5
+                if train_config['cuda_device'] is not None:
+                    rand_values = Variable(rand_values.cuda(train_config['cuda_device']))
+                else:
+                    rand_values = Variable(rand_values)
+                batch = torch.clamp(batch + rand_values, 0., 255.)
 
-        avg_elbo.append(batch_output['elbo'])
-        avg_cond_log_like.append(batch_output['cond_log_like'])
-        for l in range(len(avg_kl)):
-            avg_kl[l].append(batch_output['kl'][l])
-        avg_param_grad_mags += batch_output['param_grad_mags']
-        avg_state_grad_mags += batch_output['state_grad_mags']
+        micro_batches = batch.split(micro_batch_size) if micro_batch_size is not None else [batch]
+        pending.extend(micro_batches)
+        while len(pending) >= n_accumulation:
+            add_outputs(accumulate_and_step(model, pending[:n_accumulation], optimizers, train_config, arch))
+            pending = pending[n_accumulation:]
+            n_steps += 1
+        n_micro_batches += len(micro_batches)
+        n_examples += batch.size()[0]
+
+        if train_config['checkpoint_iter'] is not None and len(pending) == 0 and \
+                n_steps - checkpoint_step >= train_config['checkpoint_iter'] and is_master(train_config):
+            checkpoint_step = n_steps
+            train_state = {'epoch': epoch, 'sampler_seed': data_loader.sampler.seed,
+                           'avg_elbo': avg_elbo, 'avg_cond_log_like': avg_cond_log_like, 'avg_kl': avg_kl,
+                           'avg_param_grad_mags': avg_param_grad_mags, 'avg_state_grad_mags': avg_state_grad_mags,
+                           'n_micro_batches': n_micro_batches, 'n_steps': n_steps, 'n_examples': n_examples,
+                           'elapsed': time.time() - tic}
+            save_step_checkpoint(model, optimizers, epoch, train_state, train_config['cuda_device'])
+        fetch_start = time.time()
+
+    if len(pending) > 0:
+        # step on the remaining micro-batches of the epoch
+        add_outputs(accumulate_and_step(model, pending, optimizers, train_config, arch))
+        n_steps += 1
+    if train_config['cuda_device'] is not None:
+        torch.cuda.synchronize()
+    elapsed = time.time() - tic
 
     if np.isnan(np.sum(avg_elbo)):
         raise Exception('Nan encountered during training.')
 
     model.kl_weight = 1.
 
-    output_dict['avg_elbo'] = np.mean(avg_elbo)
-    output_dict['avg_cond_log_like'] = np.mean(avg_cond_log_like)
-    output_dict['avg_kl'] = [np.mean(avg_kl[l]) for l in range(len(model.levels))]
-    output_dict['avg_param_grad_mags'] = avg_param_grad_mags/len(iter(data_loader))
-    output_dict['avg_state_grad_mags'] = avg_state_grad_mags/len(iter(data_loader))
+    averages = average_across_workers([np.mean(avg_elbo), np.mean(avg_cond_log_like)] +
+                                      [np.mean(avg_kl[l]) for l in range(len(model.levels))], train_config)
+    output_dict['avg_elbo'] = averages[0]
+    output_dict['avg_cond_log_like'] = averages[1]
+    output_dict['avg_kl'] = list(averages[2:])
+    output_dict['avg_param_grad_mags'] = avg_param_grad_mags/n_steps
+    output_dict['avg_state_grad_mags'] = avg_state_grad_mags/n_micro_batches
+    # training examples per second, summed over any workers
+    output_dict['throughput'] = average_across_workers([n_examples / elapsed], train_config)[0] * train_config['world_size']
 
     return output_dict
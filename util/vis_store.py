@@ -0,0 +1,105 @@
+import time
+import numpy as np
+import h5py
+
+# storage type of each visualization, by name prefix: images in uint8, per example metrics in float32,
+# and distribution parameters in float16
+store_dtypes = [('reconstructions', np.uint8), ('samples', np.uint8), ('data', np.uint8),
+                ('posterior', np.float16), ('prior', np.float16)]
+
+
+def store_dtype(name):
+    for prefix, dtype in store_dtypes:
+        if name.startswith(prefix):
+            return dtype
+    return np.float32
+
+
+class VisualizationStore(object):
+
+    """
+    Stores the visualizations of a run in one HDF5 file, with a dataset per quantity (for instance
+    'reconstructions' or 'posterior_level_0'), each with a leading epoch axis. The datasets are chunked by epoch
+    and example, and gzip compressed, so that one epoch, or one example of one epoch, is read without reading
+    the rest. Images are stored as uint8, and statistics as float32 (metrics) or float16 (distribution
+    parameters). The epochs are listed in the 'epochs' dataset, with their write times in 'write_times'.
+    Datasets without an epoch axis (the data batch) are written with write_constant.
+
+    file_name: the store file
+    mode: 'a' to write, or 'r' to read
+    """
+
+    def __init__(self, file_name, mode='r'):
+        self.file = h5py.File(file_name, mode)
+
+    def epochs(self):
+        """Gets the stored epochs, in the order written."""
+        if 'epochs' not in self.file:
+            return []
+        return self.file['epochs'][:].tolist()
+
+    def epoch_index(self, epoch):
+        epochs = self.epochs()
+        assert epoch in epochs, 'Epoch ' + str(epoch) + ' not found.'
+        return epochs.index(epoch)
+
+    def write_time(self, epoch):
+        """Gets the time at which an epoch was written."""
+        return float(self.file['write_times'][self.epoch_index(epoch)])
+
+    def append(self, epoch, arrays):
+        """
+        Writes the visualizations of an epoch, replacing them if the epoch is already stored.
+        :param epoch: the epoch
+        :param arrays: dict of arrays, each of size (n_examples x ...)
+        :return: None
+        """
+        epochs = self.epochs()
+        index = epochs.index(epoch) if epoch in epochs else len(epochs)
+        for name, array in arrays.items():
+            dtype = store_dtype(name)
+            if dtype == np.uint8:
+                array = np.round(np.clip(array, 0., 255.))
+            array = np.asarray(array).astype(dtype)
+            if name not in self.file:
+                self.file.create_dataset(name, shape=(0,) + array.shape, maxshape=(None,) + array.shape, dtype=dtype,
+                                         chunks=(1, 1) + array.shape[1:], compression='gzip', compression_opts=4,
+                                         shuffle=True)
+            dataset = self.file[name]
+            if dataset.shape[0] <= index:
+                dataset.resize(index + 1, axis=0)
+            dataset[index] = array
+        for name, value in [('epochs', epoch), ('write_times', time.time())]:
+            if name not in self.file:
+                self.file.create_dataset(name, shape=(0,), maxshape=(None,), dtype=np.float64 if name == 'write_times' else np.int64)
+            if self.file[name].shape[0] <= index:
+                self.file[name].resize(index + 1, axis=0)
+            self.file[name][index] = value
+        self.file.flush()
+
+    def write_constant(self, name, array):
+        """Writes a dataset without an epoch axis, if it is not stored yet."""
+        if name not in self.file:
+            self.file.create_dataset(name, data=np.asarray(array).astype(store_dtype(name)), compression='gzip')
+
+    def read(self, name, epoch=None, example=None):
+        """
+        Reads a stored visualization.
+        :param name: the name of the dataset
+        :param epoch: the epoch, None for a dataset without an epoch axis
+        :param example: the index of the example, None for all examples
+        :return: array of size (n_examples x ...), or of one example
+        """
+        dataset = self.file[name]
+        if epoch is None:
+            return dataset[:] if example is None else dataset[example]
+        if example is None:
+            return dataset[self.epoch_index(epoch)]
+        return dataset[self.epoch_index(epoch), example]
+
+    def names(self):
+        """Gets the names of the stored datasets."""
+        return list(self.file.keys())
+
+    def close(self):
+        self.file.close()